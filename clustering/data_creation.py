@@ -3,10 +3,62 @@ data_creation.py
     Functions used to engineer the data used in the prioritization clustering 
 """
 
+import os
+import sys
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
-import geopandas as gpd
-import psycopg2
+# The database modules shared by every folder are in the folder common at the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from db_backend import init_backend, check_cancelled
+
+# Malla Vial (highway corridor grid) and the compact corridor index compiled from it by build_malla_index()
+MALLA_PATH = "Malla_Vial_Integral_Bogota_r2.geojson"
+MALLA_INDEX_PATH = "malla_index"
+
+# Threads that need the corridor index at the same time (e.g., the first requests of the FastAPI app) build it only once
+_malla_lock = threading.Lock()
+
+# Hour blocks (Lissett's version)
+HORARIOS = {
+    0: "Nocturno 22-2",
+    1: "Nocturno 22-2",
+    2: "Nocturno 2-5",
+    3: "Nocturno 2-5",
+    4: "Nocturno 2-5",
+    5: "DiurnoMan 5-8",
+    6: "DiurnoMan 5-8",
+    7: "DiurnoMan 5-8",
+    8: "DiurnoMan 8-12",
+    9: "DiurnoMan 8-12",
+    10: "DiurnoMan 8-12",
+    11: "DiurnoMan 8-12",
+    12: "DiurnoTarde 12-18",
+    13: "DiurnoTarde 12-18",
+    14: "DiurnoTarde 12-18",
+    15: "DiurnoTarde 12-18",
+    16: "DiurnoTarde 12-18",
+    17: "DiurnoTarde 12-18",
+    18: "NocturnoTarde 18-22",
+    19: "NocturnoTarde 18-22",
+    20: "NocturnoTarde 18-22",
+    21: "NocturnoTarde 18-22",
+    22: "Nocturno 22-2",
+    23: "Nocturno 22-2",
+}
+
+# Counts per corridor used for the prioritization clustering. They are stored as int32, which is more than enough for
+# any window
+COUNT_COLUMNS = ["accidentes", "muertes", "heridos", "muertes_vulnerables", "heridos_vulnerables"]
+COUNT_DTYPE = np.int32
+
+# Fixed category dictionaries shared by every DataFrame of the data path: days of week (as written by the data pipeline),
+# hour blocks and degrees of severity (see vulnerable()). The corridor names are shared as well (see corridor_dtype())
+DIA_DTYPE = pd.CategoricalDtype(["LUNES", "MARTES", "MIÉRCOLES", "JUEVES", "VIERNES", "SÁBADO", "DOMINGO"])
+HORARIO_DTYPE = pd.CategoricalDtype(sorted(set(HORARIOS.values())))
+VULNERABLES_DTYPE = pd.CategoricalDtype([0, 1, 2])
 
 def vulnerable(muertesv, heridosv):
     """
@@ -30,37 +82,73 @@ def vulnerable(muertesv, heridosv):
     else:
         return 2
 
-def data_for_clustering(year, month, day):
+def vulnerable_array(muertesv, heridosv):
     """
-    This function creates the DataFrame used for the prioritization clustering. The DataFrame includes 3-year data up
-    to the day defined by the date year-month-day. 
+    This function computes vulnerable() for arrays of killed and injured vulnerable people at once.
 
     Args:
-        year: date argument
-        month: date argument
-        day: date argument
-    
+        muertesv: array with the number of vulnerable killed people
+        heridosv: array with the number of vulnerable injured people
+
     Returns:
-        DataFrame
+        array with the degree of severity (see vulnerable())
     """
+    muertesv = np.asarray(muertesv)
+    heridosv = np.asarray(heridosv)
+    return np.select([(muertesv == 0) & (heridosv == 0), (heridosv > 0) & (muertesv == 0)], [0, 1], 2)
 
-    db_conn = psycopg2.connect(
-        database = "accidents_smb", user = "dev", password = "dev", host = "127.0.0.1", port = "5432"
-    )
+def group_sum(clave, valores):
+    """
+    This function sums the rows of a matrix that share the same integer key.
 
-    ##### 1. Bring highway corridor grid with no CIV duplicates 
-    ##### 2. Bring corridors with accidents (per day of week per hour)
-    ##### 3. Append injured people from accidentes with only injured people (per corridor per day of week per hour)
-    ##### 4. Append killed and injured people from accidents with killed people (per corridor per day of week per hour)
-    ##### 5. Append other relevant info (per corridor per day of week per hour)
+    Args:
+        clave: array with the integer key of each row
+        valores: matrix with the values to sum (one row per key)
 
-    ##################################################
-    ###
-    ### 1. Bring highway corridor grid with no CIV duplicates 
-    ###
-    ##################################################
-    ### We bring the Malla Vial
-    malla = gpd.read_file("Malla_Vial_Integral_Bogota_r2.geojson")
+    Returns:
+        tuple with the sorted unique keys and the matrix of sums (one row per unique key)
+    """
+
+    if len(clave) == 0:
+        return clave, valores
+
+    orden = np.argsort(clave, kind = "stable")
+    clave = clave[orden]
+    inicio = np.flatnonzero(np.r_[True, clave[1:] != clave[:-1]])
+
+    return clave[inicio], np.add.reduceat(valores[orden], inicio, axis = 0)
+
+def save_array(path, array):
+    """
+    This function writes an array into a .npy file. The array is written into a temporary file of the same folder, which
+    then replaces the file, so readers never see a half-written file.
+
+    Args:
+        path: path of the .npy file
+        array: array to write
+    """
+
+    temporal = path + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+    with open(temporal, "wb") as f:
+        np.save(f, array)
+    os.replace(temporal, path)
+
+def build_malla_index(malla_path = MALLA_PATH, index_path = MALLA_INDEX_PATH):
+    """
+    This function compiles the CIV -> MVINOMBRE mapping from the Malla Vial into a compact index stored as three .npy files:
+    civ.npy (sorted CIV values), nombre.npy (position of each corridor name in the name table) and nombres.npy (name
+    table). The files can be memory-mapped, so loading them is much cheaper than parsing the Malla Vial geometries.
+
+    Args:
+        malla_path: path to the Malla Vial GeoJSON file
+        index_path: folder where the index is stored
+    """
+
+    # geopandas is only needed to build the index, so we import it here to keep it out of the import path
+    import geopandas as gpd
+
+    ### We bring the Malla Vial (only the attributes, we don't need the geometries)
+    malla = gpd.read_file(malla_path, columns = ["MVICIV", "MVINOMBRE"], ignore_geometry = True)
     ### We take relevant info from it
     malla_short = malla[["MVICIV", "MVINOMBRE"]].copy()
     ### We rename some columns so that they match with the columns from siniestros
@@ -70,90 +158,193 @@ def data_for_clustering(year, month, day):
     ### A highway corridor with a given CIV might have multiple records in Malla Vial. We must drop duplicates on CIV (caveat:
         ### we keep the first one with whatever info it has on PK_CALZADA) so that we can append MVINOMBRE to accidents
     malla_short_no_dup = malla_short_nonan.drop_duplicates("CIV")
-    malla_short_clean = malla_short_no_dup[malla_short_no_dup["MVINOMBRE"].notna()].copy()
+    malla_short_clean = malla_short_no_dup[malla_short_no_dup["MVINOMBRE"].notna()].sort_values("CIV")
 
-    ##### We delete intermediate info
-    del malla
-    del malla_short
-    del malla_short_nonan
-    del malla_short_no_dup
+    ### We encode the corridor names as positions in a table of unique names
+    codes, nombres = pd.factorize(malla_short_clean["MVINOMBRE"], sort = True)
 
-    ##################################################
-    ###
-    ### 2. Bring corridors with accidents (per day of week per hour)
-    ###
-    ##################################################
-    if len(str(month)) == 1:
-        month = str(0) + str(month)
-    else:
-        month = str(month)
-    if len(str(day)) == 1:
-        day = str(0) + str(day)
-    else:
-        day = str(day)
+    ### civ.npy is written last, since load_malla_arrays() tells from it whether the index exists and is up to date
+    os.makedirs(index_path, exist_ok = True)
+    save_array(os.path.join(index_path, "nombres.npy"), np.asarray(nombres, dtype = str))
+    save_array(os.path.join(index_path, "nombre.npy"), codes.astype(np.int32))
+    save_array(os.path.join(index_path, "civ.npy"), malla_short_clean["CIV"].to_numpy(dtype = np.int64))
 
-    fecha = str(year) + "-" + str(month) + "-" + str(day)
-    fecha2 = str(pd.to_datetime(fecha) - pd.DateOffset(years = 3))[0:10]
+@lru_cache(maxsize = None)
+def load_malla_arrays(malla_path = MALLA_PATH, index_path = MALLA_INDEX_PATH):
+    """
+    This function returns the arrays of the index built by build_malla_index(), reading them once per process. The index is
+    (re)built if it does not exist or if it is older than the Malla Vial file.
 
-    ##### We bring info on accidents
-    query = """
+    Args:
+        malla_path: path to the Malla Vial GeoJSON file
+        index_path: folder where the index is stored
+
+    Returns:
+        tuple with the sorted CIV values, the position of the name of each CIV in the name table and the (sorted) name table
+    """
+
+    civ_path = os.path.join(index_path, "civ.npy")
+    with _malla_lock:
+        if not os.path.exists(civ_path) or (os.path.exists(malla_path) and \
+            os.path.getmtime(malla_path) > os.path.getmtime(civ_path)):
+            build_malla_index(malla_path, index_path)
+
+    civ = np.load(civ_path, mmap_mode = "r")
+    nombre = np.load(os.path.join(index_path, "nombre.npy"), mmap_mode = "r")
+    nombres = np.load(os.path.join(index_path, "nombres.npy"), mmap_mode = "r")
+
+    return np.array(civ), np.array(nombre, dtype = np.int64), np.asarray(nombres, dtype = object)
+
+@lru_cache(maxsize = None)
+def load_malla_index(malla_path = MALLA_PATH, index_path = MALLA_INDEX_PATH):
+    """
+    This function returns the highway corridor grid with no CIV duplicates, i.e., the CIV -> MVINOMBRE mapping from the
+    Malla Vial. The mapping is read from the index built by build_malla_index() once per process (see load_malla_arrays()).
+
+    Args:
+        malla_path: path to the Malla Vial GeoJSON file
+        index_path: folder where the index is stored
+
+    Returns:
+        DataFrame with the columns CIV and MVINOMBRE (categorical, see corridor_dtype())
+    """
+
+    civ, nombre, nombres = load_malla_arrays(malla_path, index_path)
+
+    return pd.DataFrame({"CIV": civ, "MVINOMBRE": pd.Categorical.from_codes(nombre, dtype = corridor_dtype(malla_path, \
+        index_path))})
+
+@lru_cache(maxsize = None)
+def corridor_dtype(malla_path = MALLA_PATH, index_path = MALLA_INDEX_PATH):
+    """
+    This function returns the categorical dtype of the corridor names (MVINOMBRE), whose categories are the sorted name
+    table of the Malla Vial index. It is created once per process, so every DataFrame shares the same name table.
+
+    Args:
+        malla_path: path to the Malla Vial GeoJSON file
+        index_path: folder where the index is stored
+
+    Returns:
+        CategoricalDtype
+    """
+    return pd.CategoricalDtype(load_malla_arrays(malla_path, index_path)[2])
+
+def corridor_codes(civ):
+    """
+    This function looks up the corridor name of each CIV in the Malla Vial index.
+
+    Args:
+        civ: array with the CIV values
+
+    Returns:
+        tuple with a mask of the CIV values that have a name and the codes of their names in corridor_dtype()
+    """
+
+    civ_malla, nombre_malla, _ = load_malla_arrays()
+    civ = np.asarray(civ, dtype = np.int64)
+    if len(civ_malla) == 0:
+        return np.zeros(len(civ), dtype = bool), np.zeros(0, dtype = np.int64)
+
+    posicion = np.searchsorted(civ_malla, civ).clip(max = len(civ_malla) - 1)
+    con_nombre = civ_malla[posicion] == civ
+
+    return con_nombre, nombre_malla[posicion[con_nombre]]
+
+def horario_codes(hora):
+    """
+    This function returns the code of the hour block (see HORARIOS) of each hour in HORARIO_DTYPE.
+
+    Args:
+        hora: array with the hours
+
+    Returns:
+        array with the codes of the hour blocks (-1 for hours with no block)
+    """
+
+    horario_de_hora = np.full(24, -1, dtype = np.int64)
+    for h, horario in HORARIOS.items():
+        horario_de_hora[h] = HORARIO_DTYPE.categories.get_loc(horario)
+    hora = np.asarray(hora, dtype = np.int64)
+
+    return np.where((hora >= 0) & (hora < 24), horario_de_hora[hora.clip(0, 23)], -1)
+
+def compact_counts(cant_siniestros):
+    """
+    This function stores the counts per corridor (CIV) per day of week per hour with compact dtypes: int32 counts and
+    categorical days of week.
+
+    Args:
+        cant_siniestros: DataFrame with the columns CIV, DIA_OCURRENCIA_ACC, HORA_OCURRENCIA_ACC and COUNT_COLUMNS
+
+    Returns:
+        DataFrame
+    """
+
+    dtypes = {columna: COUNT_DTYPE for columna in COUNT_COLUMNS}
+    dtypes["DIA_OCURRENCIA_ACC"] = DIA_DTYPE
+
+    return cant_siniestros.astype(dtypes)
+
+def data_watermark():
+    """
+    This function returns the load watermark of the accidents database, i.e., the latest accident date, the number of
+    accidents stored and the data version (see data_pipeline/migrations/004_version_datos.sql). The watermark changes
+    every time the data pipeline loads a new month of data, re-loads rows or assigns the CIV of accidents.
+
+    Returns:
+        tuple with the latest accident date (FECHA), the number of accidents and the data version
+    """
+
+    watermark = read_query("SELECT MAX(FECHA) AS fecha, COUNT(*) AS filas, (SELECT MAX(VERSION) FROM version_datos) " \
+        "AS version FROM siniestros")
+
+    return tuple(watermark.iloc[0])
+
+def aggregation_queries(fecha, fecha2):
+    """
+    This function returns the queries that bring the info on accidents, injured people and killed people used for the
+    prioritization clustering between the dates fecha2 (excluded) and fecha (included).
+
+    Args:
+        fecha: end date string (yyyy-mm-dd)
+        fecha2: start date string (yyyy-mm-dd)
+
+    Returns:
+        dict with the queries
+    """
+
+    queries = {}
+
+    ##### Accidents
+    queries["accidentes"] = """
     SELECT FORMULARIO, CIV, DIA_OCURRENCIA_ACC, HORA_OCURRENCIA_ACC
     FROM siniestros
-    WHERE substring(FECHA_ACC, 1, 10) > '""" + fecha2 + """' AND
-        substring(FECHA_ACC, 1, 10) <= '""" + fecha + """'
+    WHERE FECHA > '""" + fecha2 + """' AND
+        FECHA <= '""" + fecha + """'
     """
-    accidentes = pd.read_sql(query, con = db_conn)
-    accidentes.columns = accidentes.columns.str.upper()
-    
-    ##### We remove corridors with useless CIV (corridor) info
-    accidentes["CIV"].replace({0: np.nan}, inplace = True)
-    accidentes_nonan = accidentes[accidentes["CIV"].notna()].copy()
-    ##### We groupby() accidents info to count the number of accidents
-    cant_accidentes = accidentes_nonan.groupby(["CIV", "DIA_OCURRENCIA_ACC", "HORA_OCURRENCIA_ACC"]).size().\
-        reset_index(name = "accidentes")
 
-    ##################################################
-    ###
-    ### 3. Append injured people from accidentes with only injured people (per corridor per day of week per hour)
-    ###
-    ##################################################
-    ##### We bring info on accidents with injured people (but not deaths)
-    query = """
+    ##### Injured people from accidents with only injured people (but not deaths)
+    queries["heridos"] = """
     SELECT siniestros.FORMULARIO, siniestros.CIV, siniestros.DIA_OCURRENCIA_ACC, siniestros.HORA_OCURRENCIA_ACC,
         COUNT(conheridos.FORMULARIO) AS heridos
     FROM siniestros
     JOIN conheridos ON conheridos.FORMULARIO = siniestros.FORMULARIO
-    WHERE substring(siniestros.FECHA_ACC, 1, 10) > '""" + fecha2 + """' AND
-        substring(siniestros.FECHA_ACC, 1, 10) <= '""" + fecha + """' AND
+    WHERE siniestros.FECHA > '""" + fecha2 + """' AND
+        siniestros.FECHA <= '""" + fecha + """' AND
         siniestros.GRAVEDAD = 'CON HERIDOS'
     GROUP BY siniestros.FORMULARIO, siniestros.CIV, siniestros.DIA_OCURRENCIA_ACC, siniestros.HORA_OCURRENCIA_ACC
     ORDER BY heridos DESC
     """
-    heridos = pd.read_sql(query, con = db_conn)
-    heridos.columns = heridos.columns.str.upper()
-    heridos.rename({"HERIDOS": "heridos"}, axis = 1, inplace = True)
-    
-    ##### We remove corridors with useless CIV (corridor) info
-    heridos["CIV"].replace({0: np.nan}, inplace = True)
-    heridos_nonan = heridos[heridos["CIV"].notna()].copy()
-    ##### We groupby() injured people info to sum the number of injured people
-    cant_heridos = heridos_nonan.groupby(["CIV", "DIA_OCURRENCIA_ACC", "HORA_OCURRENCIA_ACC"])["heridos"].sum().\
-        reset_index(name = "heridos")
 
-    ##################################################
-    ###
-    ### 4. Append killed and injured people from accidents with killed people (per corridor per day of week per hour)
-    ###
-    ##################################################
-    ##### We bring info on accidents with killed people and append to them the number of injured people
-    query = """
+    ##### Killed people from accidents with killed people and the number of injured people in them
+    queries["muertes"] = """
     WITH fallecidos AS (
         SELECT siniestros.FORMULARIO, siniestros.CIV, siniestros.DIA_OCURRENCIA_ACC, siniestros.HORA_OCURRENCIA_ACC,
             COUNT(confallecidos.FORMULARIO) AS muertes
         FROM siniestros
         JOIN confallecidos on confallecidos.FORMULARIO = siniestros.FORMULARIO
-        WHERE substring(siniestros.FECHA_ACC, 1, 10) > '""" + fecha2 + """' AND
-            substring(siniestros.FECHA_ACC, 1, 10) <= '""" + fecha + """'
+        WHERE siniestros.FECHA > '""" + fecha2 + """' AND
+            siniestros.FECHA <= '""" + fecha + """'
         GROUP BY siniestros.FORMULARIO, siniestros.CIV, siniestros.DIA_OCURRENCIA_ACC, siniestros.HORA_OCURRENCIA_ACC
     )
     SELECT fallecidos.FORMULARIO, fallecidos.CIV, fallecidos.DIA_OCURRENCIA_ACC, fallecidos.HORA_OCURRENCIA_ACC,
@@ -164,64 +355,31 @@ def data_for_clustering(year, month, day):
         fallecidos.muertes
     ORDER BY fallecidos.muertes DESC, heridos DESC
     """
-    muertes = pd.read_sql(query, con = db_conn)
-    muertes.columns = muertes.columns.str.upper()
-    muertes.rename({"MUERTES": "muertes", "HERIDOS": "heridos"}, axis = 1, inplace = True)
-    
-    ##### We remove corridors with useless CIV (corridor) info
-    muertes["CIV"].replace({0: np.nan}, inplace = True)
-    muertes_nonan = muertes[muertes["CIV"].notna()].copy()
-    ##### We groupby() killed and injured people info to sum the number of killed and injured people
-    cant_muertes = muertes_nonan.groupby(["CIV", "DIA_OCURRENCIA_ACC", "HORA_OCURRENCIA_ACC"])[["muertes", "heridos"]].sum().\
-        reset_index()
 
-    ##################################################
-    ###
-    ### 5. Append other relevant info (per corridor per day of week per hour)
-    ###
-    ##################################################
-    ##################################################
-    ### Append injured vulnerable people from accidentes with only injured vulnerable people (per corridor per day of week per
-    ### hour)
-    ##################################################
-    ##### We bring the number of vulnerable road actors injured in accidents
-    query = """
+    ##### Vulnerable road actors injured in accidents with only injured people
+    queries["heridosv"] = """
     SELECT siniestros.FORMULARIO, siniestros.CIV, siniestros.DIA_OCURRENCIA_ACC, siniestros.HORA_OCURRENCIA_ACC, 
         COUNT(conheridos.FORMULARIO) FILTER (WHERE conheridos.CONDICION IN ('PEATON', 'CICLISTA', 'MOTOCICLISTA'))
             AS heridos_vulnerables 
     FROM siniestros
     JOIN conheridos ON conheridos.FORMULARIO = siniestros.FORMULARIO
-    WHERE substring(siniestros.FECHA_ACC, 1, 10) > '""" + fecha2 + """' AND
-        substring(siniestros.FECHA_ACC, 1, 10) <= '""" + fecha + """' AND
+    WHERE siniestros.FECHA > '""" + fecha2 + """' AND
+        siniestros.FECHA <= '""" + fecha + """' AND
         siniestros.GRAVEDAD = 'CON HERIDOS'
     GROUP BY siniestros.FORMULARIO, siniestros.CIV, siniestros.DIA_OCURRENCIA_ACC, siniestros.HORA_OCURRENCIA_ACC
     ORDER BY heridos_vulnerables DESC
     """
-    heridosv = pd.read_sql(query, con = db_conn)
-    heridosv.columns = heridosv.columns.str.upper()
-    heridosv.rename({"HERIDOS_VULNERABLES": "heridos_vulnerables"}, axis = 1, inplace = True)
-    
-    ##### We remove corridors with useless CIV (corridor) info
-    heridosv["CIV"].replace({0: np.nan}, inplace = True)
-    heridosv_nonan = heridosv[heridosv["CIV"].notna()].copy()
-    ##### We groupby() injured vulnerable people info to sum the number of injured vulnerable people
-    cant_heridosv = heridosv_nonan.groupby(["CIV", "DIA_OCURRENCIA_ACC", "HORA_OCURRENCIA_ACC"])["heridos_vulnerables"].sum().\
-        reset_index()
 
-    ##################################################
-    ### Append killed and injured vulnerable people from accidentes with killed vulnerable people (per corridor per day of week
-    ### per hour)
-    ##################################################
-    ##### We bring the number of vulnerable road actors killed and injured in accidents with killed vulnerable people
-    query = """
+    ##### Vulnerable road actors killed and injured in accidents with killed people
+    queries["muertesv"] = """
     WITH fallecidos AS (
         SELECT siniestros.FORMULARIO, siniestros.CIV, siniestros.DIA_OCURRENCIA_ACC, siniestros.HORA_OCURRENCIA_ACC, 
             COUNT(confallecidos.FORMULARIO) FILTER (WHERE confallecidos.CONDICION IN ('PEATON', 'CICLISTA', 'MOTOCICLISTA'))
                 AS muertes_vulnerables 
         FROM siniestros
         JOIN confallecidos ON confallecidos.FORMULARIO = siniestros.FORMULARIO
-        WHERE substring(siniestros.FECHA_ACC, 1, 10) > '""" + fecha2 + """' AND
-            substring(siniestros.FECHA_ACC, 1, 10) <= '""" + fecha + """'
+        WHERE siniestros.FECHA > '""" + fecha2 + """' AND
+            siniestros.FECHA <= '""" + fecha + """'
         GROUP BY siniestros.FORMULARIO, siniestros.CIV, siniestros.DIA_OCURRENCIA_ACC, siniestros.HORA_OCURRENCIA_ACC
     )
     SELECT fallecidos.FORMULARIO, fallecidos.CIV, fallecidos.DIA_OCURRENCIA_ACC, fallecidos.HORA_OCURRENCIA_ACC,
@@ -234,123 +392,336 @@ def data_for_clustering(year, month, day):
         fallecidos.muertes_vulnerables
     ORDER BY fallecidos.muertes_vulnerables DESC, heridos_vulnerables DESC
     """
-    muertesv = pd.read_sql(query, con = db_conn)
-    db_conn.close()
-    
-    muertesv.columns = muertesv.columns.str.upper()
-    muertesv.rename({"MUERTES_VULNERABLES": "muertes_vulnerables", "HERIDOS_VULNERABLES": "heridos_vulnerables"}, axis = 1, \
-        inplace = True)
-    
-    ##### We remove corridors with useless CIV (corridor) info
-    muertesv["CIV"].replace({0: np.nan}, inplace = True)
-    muertesv_nonan = muertesv[muertesv["CIV"].notna()].copy()
-    ##### We groupby() killed vulnerable people info to sum the number of killed vulnerable people
-    cant_muertesv = muertesv_nonan.groupby(["CIV", "DIA_OCURRENCIA_ACC", "HORA_OCURRENCIA_ACC"])[["muertes_vulnerables", \
-        "heridos_vulnerables"]].sum().reset_index()
-
-    ##### We bring everything together, including the corridor names
-    accidentes_malla = pd.merge(cant_accidentes, cant_heridos, how = "left", on = ["CIV", "DIA_OCURRENCIA_ACC", \
-        "HORA_OCURRENCIA_ACC"]).merge(cant_muertes, how = "left", on = ["CIV", "DIA_OCURRENCIA_ACC", "HORA_OCURRENCIA_ACC"]).\
-        merge(cant_heridosv, how = "left", on = ["CIV", "DIA_OCURRENCIA_ACC", "HORA_OCURRENCIA_ACC"]).\
-        merge(cant_muertesv, how = "left", on = ["CIV", "DIA_OCURRENCIA_ACC", "HORA_OCURRENCIA_ACC"]).\
-        merge(malla_short_clean, how = "left", on = "CIV")
-    ##### We remove corridors with no name
-    accidentes_malla_clean = accidentes_malla[accidentes_malla["MVINOMBRE"].notna()].copy()
-    ##### We fill features with 0s when applicable 
-    accidentes_malla_clean.fillna(value = 0, inplace = True)
-    ##### We adjust some features 
-    accidentes_malla_clean["heridos"] = accidentes_malla_clean["heridos_x"] + accidentes_malla_clean["heridos_y"]
-    accidentes_malla_clean["heridos_vulnerables"] = accidentes_malla_clean["heridos_vulnerables_x"] + \
-        accidentes_malla_clean["heridos_vulnerables_y"]
-    accidentes_malla_clean.drop(columns = ["heridos_x", "heridos_y", "heridos_vulnerables_x", "heridos_vulnerables_y"], \
-        axis = 1, inplace = True)
-    accidentes_malla_clean["muertes"] = accidentes_malla_clean["muertes"].astype(int)
-    accidentes_malla_clean["heridos"] = accidentes_malla_clean["heridos"].astype(int)
-    accidentes_malla_clean["muertes_vulnerables"] = accidentes_malla_clean["muertes_vulnerables"].astype(int)
-    accidentes_malla_clean["heridos_vulnerables"] = accidentes_malla_clean["heridos_vulnerables"].astype(int)
-
-    ##### We groupby() to sum all the relevant features
-    info_siniestros = accidentes_malla_clean.groupby(["MVINOMBRE", "DIA_OCURRENCIA_ACC", "HORA_OCURRENCIA_ACC"])\
-        [["accidentes", "muertes", "heridos", "muertes_vulnerables", "heridos_vulnerables"]].sum().reset_index()
 
-    ##### We delete intermediate info
-    del accidentes
-    del accidentes_malla
-    del accidentes_malla_clean
-    del heridos
-    del heridos_nonan
-    del heridosv
-    del heridosv_nonan
-    del muertes
-    del muertes_nonan
-    del muertesv
-    del muertesv_nonan
-    del cant_accidentes
-    del cant_heridos
-    del cant_heridosv
-    del cant_muertes
-    del cant_muertesv
-
-    ##### We create the hour blocks (Lissett's version)
-    d1 = {
-        0: "Nocturno 22-2",
-        1: "Nocturno 22-2",
-        2: "Nocturno 2-5",
-        3: "Nocturno 2-5",
-        4: "Nocturno 2-5",
-        5: "DiurnoMan 5-8",
-        6: "DiurnoMan 5-8",
-        7: "DiurnoMan 5-8",
-        8: "DiurnoMan 8-12",
-        9: "DiurnoMan 8-12",
-        10: "DiurnoMan 8-12",
-        11: "DiurnoMan 8-12",
-        12: "DiurnoTarde 12-18",
-        13: "DiurnoTarde 12-18",
-        14: "DiurnoTarde 12-18",
-        15: "DiurnoTarde 12-18",
-        16: "DiurnoTarde 12-18",
-        17: "DiurnoTarde 12-18",
-        18: "NocturnoTarde 18-22",
-        19: "NocturnoTarde 18-22",
-        20: "NocturnoTarde 18-22",
-        21: "NocturnoTarde 18-22",
-        22: "Nocturno 22-2",
-        23: "Nocturno 22-2",
+    return queries
+
+def read_query(query):
+    """
+    This function runs a query in the backend given by the environment variable ACCIDENTS_DB_BACKEND (see db_backend.py):
+    the accidents database, with a connection borrowed from the pool, or DuckDB over the Parquet snapshots of its tables.
+
+    Args:
+        query: query string
+
+    Returns:
+        DataFrame
+    """
+    return init_backend().read_sql(query)
+
+def read_queries(queries, parallel = None, cancel = None):
+    """
+    This function runs several independent queries. When parallel is True, each query runs at the same time with its own
+    connection borrowed from the pool (or its own DuckDB cursor). Otherwise, they run one after another with a single
+    connection. Queries that have not started when cancel is set are not run (see db_backend.check_cancelled()).
+
+    Args:
+        queries: dict with the queries
+        parallel: whether the queries run at the same time. It defaults to the environment variable DB_PARALLEL_QUERIES
+            (default 1, i.e., True)
+        cancel: threading.Event that is set to cancel the queries (or None)
+
+    Returns:
+        dict with a DataFrame per query
+    """
+
+    if parallel is None:
+        parallel = os.environ.get("DB_PARALLEL_QUERIES", "1") == "1"
+
+    check_cancelled(cancel)
+    if parallel:
+        with ThreadPoolExecutor(max_workers = len(queries)) as executor:
+            futures = {name: executor.submit(read_query, query) for name, query in queries.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    return init_backend().read_many(queries, cancel = cancel)
+
+def corridor_counts_pandas(fecha, fecha2, parallel = None, cancel = None):
+    """
+    This function returns the number of accidents, killed people, injured people, killed vulnerable people and injured
+    vulnerable people per corridor (CIV) per day of week per hour between the dates fecha2 (excluded) and fecha
+    (included). The counts are computed in pandas from the rows brought by the queries in aggregation_queries().
+
+    Args:
+        fecha: end date string (yyyy-mm-dd)
+        fecha2: start date string (yyyy-mm-dd)
+        parallel: whether the queries run at the same time (see read_queries())
+        cancel: threading.Event that is set to cancel the queries (see read_queries())
+
+    Returns:
+        DataFrame
+    """
+
+    ##################################################
+    ###
+    ### 1-2. Bring corridors with accidents, injured and killed people (per day of week per hour)
+    ###
+    ##################################################
+    ##### We bring the info on accidents, injured and killed people (the queries are independent, so they can run at the
+        ##### same time)
+    frames = read_queries(aggregation_queries(fecha, fecha2), parallel = parallel, cancel = cancel)
+
+    ##### Counts brought by each query. The rows of the query on accidents count one accident each. Injured people in
+        ##### accidents with killed people and injured vulnerable people in accidents with killed vulnerable people add up
+        ##### to the ones brought by the queries on accidents with only injured people
+    conteos = {
+        "accidentes": [],
+        "heridos": ["heridos"],
+        "muertes": ["muertes", "heridos"],
+        "heridosv": ["heridos_vulnerables"],
+        "muertesv": ["muertes_vulnerables", "heridos_vulnerables"],
     }
-    info_siniestros["HORARIO"] = info_siniestros["HORA_OCURRENCIA_ACC"].map(d1)
 
-    ##### We keep corridors with deaths 
-    # Create list with corridors that had 0 deaths
-    lstm = info_siniestros.groupby("MVINOMBRE")["muertes"].sum()[info_siniestros.groupby("MVINOMBRE")["muertes"].sum() == 0].\
-        index.to_list()
-    # Create df without such corridors
-    info_siniestrosm = info_siniestros[~info_siniestros["MVINOMBRE"].isin(lstm)]
+    ##### We encode corridor (CIV), day of week and hour as a single integer key. Only the corridors, days and hours with
+        ##### accidents are kept (the other queries only add info to them), so the keys are built from the accidents
+    accidentes = frames["accidentes"]
+    civs = pd.Index(accidentes["civ"].unique()).dropna()
+    dias = pd.Index(accidentes["dia_ocurrencia_acc"].unique()).dropna()
+    horas = pd.Index(accidentes["hora_ocurrencia_acc"].unique()).dropna()
+
+    claves = {}
+    for nombre in conteos:
+        civ = civs.get_indexer(frames[nombre]["civ"])
+        dia = dias.get_indexer(frames[nombre]["dia_ocurrencia_acc"])
+        hora = horas.get_indexer(frames[nombre]["hora_ocurrencia_acc"])
+        ##### We remove corridors with useless CIV (corridor) info and rows with no day of week or hour
+        valida = (civ >= 0) & (dia >= 0) & (hora >= 0) & (frames[nombre]["civ"].to_numpy() != 0)
+        claves[nombre] = np.where(valida, (civ.astype(np.int64) * len(dias) + dia) * len(horas) + hora, -1)
+
+    ##### We sum the counts of every query per key (a single pass over each query, with no groupby() or merge())
+    unicas = pd.Index(np.sort(pd.unique(claves["accidentes"][claves["accidentes"] >= 0])))
+    sumas = np.zeros((len(unicas), len(COUNT_COLUMNS)), dtype = np.int64)
+    for nombre, columnas in conteos.items():
+        posicion = unicas.get_indexer(claves[nombre])
+        valida = posicion >= 0
+        if nombre == "accidentes":
+            sumas[:, 0] += np.bincount(posicion[valida], minlength = len(unicas))
+        for columna in columnas:
+            sumas[:, COUNT_COLUMNS.index(columna)] += np.bincount(posicion[valida], minlength = len(unicas), \
+                weights = frames[nombre][columna].to_numpy()[valida]).astype(np.int64)
+
+    clave = unicas.to_numpy()
+    cant_siniestros = pd.DataFrame(sumas, columns = COUNT_COLUMNS)
+    cant_siniestros.insert(0, "CIV", np.asarray(civs)[clave // (len(dias) * len(horas))].astype(np.int64))
+    cant_siniestros.insert(1, "DIA_OCURRENCIA_ACC", np.asarray(dias, dtype = object)[clave // len(horas) % len(dias)])
+    cant_siniestros.insert(2, "HORA_OCURRENCIA_ACC", np.asarray(horas)[clave % len(horas)].astype(np.int64))
+
+    return compact_counts(cant_siniestros)
+
+def corridor_counts_query(fecha, fecha2):
+    """
+    This function returns a query that computes the same counts as corridor_counts_pandas() in the database, so that only
+    the aggregated rows are transferred. Every accident in the window contributes its injured people once if its
+    severity is 'CON HERIDOS' and once more if it has killed people, which mirrors how corridor_counts_pandas() adds up
+    the injured people from the queries "heridos" and "muertes" (and "heridosv" and "muertesv").
+
+    Args:
+        fecha: end date string (yyyy-mm-dd)
+        fecha2: start date string (yyyy-mm-dd)
+
+    Returns:
+        query string
+    """
+
+    return """
+    WITH ventana AS (
+        SELECT FORMULARIO, CIV, DIA_OCURRENCIA_ACC, HORA_OCURRENCIA_ACC, GRAVEDAD
+        FROM siniestros
+        WHERE FECHA > '""" + fecha2 + """' AND
+            FECHA <= '""" + fecha + """' AND
+            CIV <> 0 AND DIA_OCURRENCIA_ACC IS NOT NULL AND HORA_OCURRENCIA_ACC IS NOT NULL
+    ),
+    heridos AS (
+        SELECT conheridos.FORMULARIO, COUNT(conheridos.FORMULARIO) AS heridos,
+            COUNT(conheridos.FORMULARIO) FILTER (WHERE conheridos.CONDICION IN ('PEATON', 'CICLISTA', 'MOTOCICLISTA'))
+                AS heridos_vulnerables
+        FROM conheridos
+        JOIN ventana ON ventana.FORMULARIO = conheridos.FORMULARIO
+        GROUP BY conheridos.FORMULARIO
+    ),
+    fallecidos AS (
+        SELECT confallecidos.FORMULARIO, COUNT(confallecidos.FORMULARIO) AS muertes,
+            COUNT(confallecidos.FORMULARIO) FILTER (WHERE confallecidos.CONDICION IN ('PEATON', 'CICLISTA', 'MOTOCICLISTA'))
+                AS muertes_vulnerables
+        FROM confallecidos
+        JOIN ventana ON ventana.FORMULARIO = confallecidos.FORMULARIO
+        GROUP BY confallecidos.FORMULARIO
+    ),
+    por_siniestro AS (
+        SELECT ventana.CIV, ventana.DIA_OCURRENCIA_ACC, ventana.HORA_OCURRENCIA_ACC,
+            COALESCE(fallecidos.muertes, 0) AS muertes,
+            COALESCE(fallecidos.muertes_vulnerables, 0) AS muertes_vulnerables,
+            COALESCE(heridos.heridos, 0) AS heridos,
+            COALESCE(heridos.heridos_vulnerables, 0) AS heridos_vulnerables,
+            (CASE WHEN ventana.GRAVEDAD = 'CON HERIDOS' THEN 1 ELSE 0 END) +
+                (CASE WHEN fallecidos.FORMULARIO IS NOT NULL THEN 1 ELSE 0 END) AS veces_heridos
+        FROM ventana
+        LEFT JOIN heridos ON heridos.FORMULARIO = ventana.FORMULARIO
+        LEFT JOIN fallecidos ON fallecidos.FORMULARIO = ventana.FORMULARIO
+    )
+    SELECT CIV, DIA_OCURRENCIA_ACC, HORA_OCURRENCIA_ACC,
+        COUNT(*) AS accidentes,
+        SUM(muertes)::BIGINT AS muertes,
+        SUM(heridos*veces_heridos)::BIGINT AS heridos,
+        SUM(muertes_vulnerables)::BIGINT AS muertes_vulnerables,
+        SUM(heridos_vulnerables*veces_heridos)::BIGINT AS heridos_vulnerables
+    FROM por_siniestro
+    GROUP BY CIV, DIA_OCURRENCIA_ACC, HORA_OCURRENCIA_ACC
+    """
+
+def corridor_counts_sql(fecha, fecha2):
+    """
+    This function returns the same DataFrame as corridor_counts_pandas(), but the counts are computed in the database with
+    a single query (see corridor_counts_query()).
+
+    Args:
+        fecha: end date string (yyyy-mm-dd)
+        fecha2: start date string (yyyy-mm-dd)
+
+    Returns:
+        DataFrame
+    """
+
+    cant_siniestros = read_query(corridor_counts_query(fecha, fecha2))
+    cant_siniestros.rename(columns = {"civ": "CIV", "dia_ocurrencia_acc": "DIA_OCURRENCIA_ACC", \
+        "hora_ocurrencia_acc": "HORA_OCURRENCIA_ACC"}, inplace = True)
+
+    return compact_counts(cant_siniestros)
+
+def corridor_counts_aggregate(fecha, fecha2):
+    """
+    This function returns the same DataFrame as corridor_counts_pandas(), but the counts are summed from the table
+    corredores_diarios, which holds them per corridor per day per hour and is refreshed by the data pipeline (see
+    data_pipeline/migrations/002_corredores_diarios.sql).
+
+    Args:
+        fecha: end date string (yyyy-mm-dd)
+        fecha2: start date string (yyyy-mm-dd)
+
+    Returns:
+        DataFrame
+    """
+
+    query = """
+    SELECT CIV, DIA_OCURRENCIA_ACC, HORA_OCURRENCIA_ACC,
+        SUM(ACCIDENTES)::BIGINT AS accidentes,
+        SUM(MUERTES)::BIGINT AS muertes,
+        SUM(HERIDOS)::BIGINT AS heridos,
+        SUM(MUERTES_VULNERABLES)::BIGINT AS muertes_vulnerables,
+        SUM(HERIDOS_VULNERABLES)::BIGINT AS heridos_vulnerables
+    FROM corredores_diarios
+    WHERE FECHA > '""" + fecha2 + """' AND
+        FECHA <= '""" + fecha + """'
+    GROUP BY CIV, DIA_OCURRENCIA_ACC, HORA_OCURRENCIA_ACC
+    """
+    cant_siniestros = read_query(query)
+    cant_siniestros.rename(columns = {"civ": "CIV", "dia_ocurrencia_acc": "DIA_OCURRENCIA_ACC", \
+        "hora_ocurrencia_acc": "HORA_OCURRENCIA_ACC"}, inplace = True)
+
+    return compact_counts(cant_siniestros)
+
+def clustering_features(cant_siniestros):
+    """
+    This function turns the counts per corridor (CIV) per day of week per hour into the DataFrame used for the
+    prioritization clustering: the counts per corridor name (MVINOMBRE) per hour block (HORARIO) of the corridors with
+    deaths, with the degree of severity of their accidents (see vulnerable()). Corridor names and hour blocks are handled
+    as integer codes, so everything is summed in a single grouped reduction.
+
+    Args:
+        cant_siniestros: DataFrame returned by corridor_counts_pandas(), corridor_counts_sql() or
+            corridor_counts_aggregate()
+
+    Returns:
+        DataFrame with categorical corridor names, hour blocks and degrees of severity and int32 counts
+    """
+
+    ##### We append the corridor names (as codes in the name table of the Malla Vial index) and remove corridors with no name
+    con_nombre, corredor = corridor_codes(cant_siniestros["CIV"])
+    valores = cant_siniestros[COUNT_COLUMNS].to_numpy(np.int64)[con_nombre]
+
+    ##### We create the hour blocks (as codes in the list of hour blocks). Hours with no block get -1
+    horario = horario_codes(cant_siniestros["HORA_OCURRENCIA_ACC"].to_numpy()[con_nombre])
+    bloques = len(HORARIO_DTYPE.categories)
+
+    ##### We keep corridors with deaths
+    muertes = np.bincount(corredor, weights = valores[:, 1], minlength = len(corridor_dtype().categories))
+    conservar = (muertes[corredor] > 0) & (horario >= 0)
+
+    ##### We sum the counts per corridor and time block (day of week seems somewhat irrelevant according to a basic EDA not
+        ##### reported here, so we get rid of it). The name table and the hour blocks are sorted, so the keys are sorted by
+        ##### corridor name and time block
+    clave, sumas = group_sum(corredor[conservar] * bloques + horario[conservar], valores[conservar])
+
+    cluster_df = pd.DataFrame(sumas.astype(COUNT_DTYPE), columns = COUNT_COLUMNS)
+    cluster_df.insert(0, "MVINOMBRE", pd.Categorical.from_codes(clave // bloques, dtype = corridor_dtype()))
+    cluster_df.insert(1, "HORARIO", pd.Categorical.from_codes(clave % bloques, dtype = HORARIO_DTYPE))
+    cluster_df["vulnerables"] = pd.Categorical(vulnerable_array(cluster_df["muertes_vulnerables"], \
+        cluster_df["heridos_vulnerables"]), dtype = VULNERABLES_DTYPE)
+
+    return cluster_df
+
+def data_for_clustering(year, month, day, *, parallel = None, backend = None, years = 3, cancel = None):
+    """
+    This function creates the DataFrame used for the prioritization clustering. The DataFrame includes the given number of
+    years of data (3 by default) up to the day defined by the date year-month-day. 
+
+    Args:
+        year: date argument
+        month: date argument
+        day: date argument
+        parallel: whether the queries run at the same time (see read_queries())
+        backend: "pandas" to compute the counts in pandas, "sql" to compute them in the database or "aggregate" to sum them
+            from the table corredores_diarios. It defaults to the environment variable CLUSTERING_BACKEND (default "pandas")
+        years: number of years of data up to the date (default 3)
+        cancel: threading.Event that is set to cancel the queries (see read_queries()). QueryCancelled is raised before
+            the next query once it is set
+    
+    Returns:
+        DataFrame
+    """
 
-    ##### We groupby() using the corridors, days and time blocks
-    info_siniestrosmh = info_siniestrosm.groupby(["MVINOMBRE", "DIA_OCURRENCIA_ACC", "HORARIO"])[["accidentes", "muertes", \
-        "heridos", "muertes_vulnerables", "heridos_vulnerables"]].sum().reset_index()
+    ##### 1. Bring corridors with accidents (per day of week per hour)
+    ##### 2. Append injured and killed people (per corridor per day of week per hour)
+    ##### 3. Append the corridor names and hour blocks and sum the counts (per corridor name per hour block)
 
     ##################################################
     ###
-    ### Final preparation
+    ### 1-2. Bring corridors with accidents, injured and killed people (per day of week per hour)
     ###
     ##################################################
-    ##### We create the data for the clustering prediction
-    cluster_df = info_siniestrosmh.copy()
+    if len(str(month)) == 1:
+        month = str(0) + str(month)
+    else:
+        month = str(month)
+    if len(str(day)) == 1:
+        day = str(0) + str(day)
+    else:
+        day = str(day)
+
+    fecha = str(year) + "-" + str(month) + "-" + str(day)
+    fecha2 = str(pd.to_datetime(fecha) - pd.DateOffset(years = years))[0:10]
 
-    ##### Day of week seems somewhat irrelevant according to a basic EDA not reported here. We get rid of it
-    # We groupby() using the corridors and time blocks
-    cluster_df = cluster_df.groupby(["MVINOMBRE", "HORARIO"])[["accidentes", "muertes", "heridos", "muertes_vulnerables", \
-        "heridos_vulnerables"]].sum().reset_index()
+    ##### We bring the number of accidents, killed and injured people per corridor (CIV) per day of week per hour. They can be
+        ##### computed in pandas (default), in the database (see corridor_counts_query()) or summed from the table with the
+        ##### daily counts (see corridor_counts_aggregate())
+    if backend is None:
+        backend = os.environ.get("CLUSTERING_BACKEND", "pandas")
+    check_cancelled(cancel)
+    if backend == "sql":
+        cant_siniestros = corridor_counts_sql(fecha, fecha2)
+    elif backend == "aggregate":
+        cant_siniestros = corridor_counts_aggregate(fecha, fecha2)
+    else:
+        cant_siniestros = corridor_counts_pandas(fecha, fecha2, parallel = parallel, cancel = cancel)
+    check_cancelled(cancel)
 
-    cluster_df["vulnerables"] = cluster_df.apply(lambda x: vulnerable(x["muertes_vulnerables"], x["heridos_vulnerables"]), \
-        axis = 1)
-    cluster_df["vulnerables"] = cluster_df["vulnerables"].astype("category")
+    ##################################################
+    ###
+    ### 3. Append the corridor names and hour blocks and sum the counts (per corridor name per hour block)
+    ###
+    ##################################################
+    cluster_df = clustering_features(cant_siniestros)
 
     ##### We delete intermediate info
-    del info_siniestros
-    del info_siniestrosm
-    del info_siniestrosmh
+    del cant_siniestros
 
     return cluster_df
\ No newline at end of file
@@ -0,0 +1,11 @@
+"""
+malla_index.py
+    This script compiles the Malla Vial into the compact corridor index (folder malla_index) used by data_creation.py.
+
+    The index is built automatically the first time data_for_clustering() runs, but running this script after updating
+    Malla_Vial_Integral_Bogota_r2.geojson avoids paying the build cost in the first request served by the FastAPI app
+"""
+
+from data_creation import build_malla_index
+
+build_malla_index()
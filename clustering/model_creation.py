@@ -8,57 +8,56 @@ model_creation.py
     Please check the corresponding notebook to explore some code that allows to check the results
 """
 
-import pandas as pd
-import numpy as np
+import os
+import logging
 from sklearn import preprocessing
-from kmodes.kprototypes import KPrototypes
 import joblib
 from data_creation import data_for_clustering
-
-##### The methodology works by bringing 3-year data. Before running the script, the person who runs it can modify the date
-    ##### information below (year, month, day) and the script would automatically bring the 3-year data up to such date
-cluster_df = data_for_clustering(2022, 9, 30)
-
-##### We remove the corridors and the number of killed and injured vulnerable people to perform the clustering (the basic EDA
-    ##### mentioned in data_creation.py revealed the number of killed and injured vulnerable people were redundant)
-##### We normalize the continuous data 
-cluster_df_norm = cluster_df[["HORARIO", "accidentes", "muertes", "heridos", "vulnerables"]].copy()
-
-del cluster_df
-
-scaler = preprocessing.MinMaxScaler()
-cluster_df_norm[["accidentes", "muertes", "heridos"]] = scaler.fit_transform(cluster_df_norm[["accidentes", "muertes", \
-    "heridos"]])
-
-##### We save the scaler
-joblib.dump(scaler, "scaler.mod")
-
-##### We apply the clustering
-
-# We run the clustering 50 times
-cost = []
-clust = []
-for i in range(50):
-    
-    kproto = KPrototypes(n_clusters = 3, init = "Cao")
-    clusters = kproto.fit_predict(cluster_df_norm, categorical = [0, 4])
-    
-    # Save each model
-    clust.append(kproto)
-    # Save each model's cost
-    cost.append(kproto.cost_)
-
-# Transform the cost list into a numpy array
-costArray = np.array(cost)
-
-# Return the index from the smallest cost
-minIndex = costArray.argmin()
-
-# Retrieve the corresponding model and clusters
-kproto = clust[minIndex]
-clusters = kproto.fit_predict(cluster_df_norm, categorical = [0, 4])
-
-del cost, costArray, clust
-
-##### We save the model
-joblib.dump(kproto, "kprototypes.mod")
\ No newline at end of file
+from model_export import export_model
+from model_training import train_kprototypes
+from model_minibatch import MiniBatchKPrototypes
+
+# The restarts run in separate processes, which import this module, so the script only runs when it is executed directly
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(message)s")
+
+    ##### The methodology works by bringing 3-year data. Before running the script, the person who runs it can modify the date
+        ##### information below (year, month, day) and the script would automatically bring the 3-year data up to such date
+    cluster_df = data_for_clustering(2022, 9, 30)
+
+    ##### We remove the corridors and the number of killed and injured vulnerable people to perform the clustering (the basic EDA
+        ##### mentioned in data_creation.py revealed the number of killed and injured vulnerable people were redundant)
+    ##### We normalize the continuous data 
+    cluster_df_norm = cluster_df[["HORARIO", "accidentes", "muertes", "heridos", "vulnerables"]].copy()
+
+    del cluster_df
+
+    scaler = preprocessing.MinMaxScaler()
+    cluster_df_norm[["accidentes", "muertes", "heridos"]] = scaler.fit_transform(cluster_df_norm[["accidentes", "muertes", \
+        "heridos"]])
+
+    ##### We save the scaler
+    joblib.dump(scaler, "scaler.mod")
+
+    ##### We apply the clustering
+
+    # We run the clustering 50 times in parallel (each run with its own seed) and keep the model with the smallest cost along
+        # with its clusters, so there is no need to fit it again. With TRAINING_MINIBATCH = 1 the model is fitted from chunks
+        # of the data instead, which keeps the memory bounded when the data has many more rows
+    minibatch = os.environ.get("TRAINING_MINIBATCH", "0") == "1"
+    if minibatch:
+        kproto = MiniBatchKPrototypes(n_clusters = 3, chunk_rows = int(os.environ.get("TRAINING_CHUNK_ROWS", 10000)))
+        clusters = kproto.fit_predict(cluster_df_norm, categorical = [0, 4])
+    else:
+        kproto, clusters, cost = train_kprototypes(cluster_df_norm, n_clusters = 3, init = "Cao", restarts = 50)
+
+        del cost
+
+    ##### We save the model
+    joblib.dump(kproto, "kprototypes.mod")
+
+    ##### We export the scaler and the model into the compact artifact used by the FastAPI app
+    if minibatch:
+        kproto.export(scaler)
+    else:
+        export_model(kproto, scaler)
\ No newline at end of file
@@ -0,0 +1,61 @@
+"""
+model_export.py
+    This script exports the saved MinMax scaler and K-Prototypes model into kprototypes.npz, the compact array artifact
+    used by the FastAPI app to predict without kmodes and scikit-learn.
+
+    model_creation.py exports the artifact every time it fits a new model, so this script is only needed to export a model
+    that was fitted before (e.g., the kprototypes.mod and scaler.mod files stored in the repository)
+"""
+
+import numpy as np
+import joblib
+
+def save_artifact(centroides, modas, gamma, categorias, scaler, path = "kprototypes.npz", categorical = (0, 4)):
+    """
+    This function writes the parameters needed to predict with a K-Prototypes model into a .npz file: the numerical
+    centroids, the categorical modes (as positions in the table of categories of each categorical column), the tables of
+    categories, gamma and the min/scale of the MinMax scaler. The file holds plain arrays only, so it is loaded without
+    pickle.
+
+    Args:
+        centroides: matrix with the numerical centroids (one row per cluster)
+        modas: matrix with the codes of the categorical modes (one row per cluster)
+        gamma: weight of the categorical features
+        categorias: list with the categories of each categorical column, in the order of their codes
+        scaler: fitted MinMaxScaler of the continuous features
+        path: path of the .npz file
+        categorical: positions of the categorical features in the data used to fit the model
+    """
+
+    arrays = {
+        "centroides": np.asarray(centroides, dtype = np.float64),
+        "modas": np.asarray(modas, dtype = np.int32),
+        "gamma": np.float64(gamma),
+        "categoricas": np.asarray(categorical, dtype = np.int32),
+        "minimo": np.asarray(scaler.min_, dtype = np.float64),
+        "escala": np.asarray(scaler.scale_, dtype = np.float64),
+    }
+    for i, categorias_i in enumerate(categorias):
+        arrays["categorias_" + str(i)] = np.asarray(list(categorias_i))
+
+    np.savez(path, **arrays)
+
+def export_model(kproto, scaler, path = "kprototypes.npz", categorical = (0, 4)):
+    """
+    This function writes a fitted kmodes K-Prototypes model and its MinMax scaler into a .npz file (see save_artifact()).
+
+    Args:
+        kproto: fitted KPrototypes model
+        scaler: fitted MinMaxScaler of the continuous features
+        path: path of the .npz file
+        categorical: positions of the categorical features in the data used to fit the model
+    """
+
+    centroides, modas = kproto._enc_cluster_centroids
+    # The categories of each column are stored in the order of their codes
+    categorias = [sorted(enc_map, key = enc_map.get) for enc_map in kproto._enc_map]
+
+    save_artifact(centroides, modas, kproto.gamma, categorias, scaler, path, categorical)
+
+if __name__ == "__main__":
+    export_model(joblib.load("kprototypes.mod"), joblib.load("scaler.mod"))
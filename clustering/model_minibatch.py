@@ -0,0 +1,247 @@
+"""
+model_minibatch.py
+    Mini-batch K-Prototypes model, fitted from chunks of the features so the memory used does not grow with the number of
+    rows (e.g., to cluster finer units than corridors and hour blocks)
+"""
+
+import numpy as np
+import pandas as pd
+from model_export import save_artifact
+
+class MiniBatchKPrototypes:
+    """
+    Class that fits a K-Prototypes model from chunks of the (scaled) features, the way mini-batch K-Means does: each chunk
+    is assigned to the current clusters and then moves the numerical centroids towards the mean of its rows, with a step
+    that shrinks with the number of rows the cluster has received, and adds its categories to the frequencies used to pick
+    the modes. Only the centroids, the frequencies of the categories and the tables of categories are kept between chunks.
+
+    The cost of a row for a cluster is the same as in kmodes (squared Euclidean distance to the centroid plus gamma times
+    the number of categorical features that differ from the mode), so the model predicts with the same rule. It can be
+    saved with joblib and used in model_prediction.py, and exported into kprototypes.npz for the FastAPI app.
+    """
+
+    def __init__(self, n_clusters = 3, gamma = None, chunk_rows = 10000, epochs = 3, random_state = 0, \
+        categorical = (0, 4)):
+        """
+        Args:
+            n_clusters: number of clusters
+            gamma: weight of the categorical features. By default it is half the mean standard deviation of the
+                continuous features of the first chunk (the default of kmodes)
+            chunk_rows: number of rows per chunk when fitting a DataFrame
+            epochs: number of passes over the data
+            random_state: seed of the initialization and of the order of the rows of each pass
+            categorical: positions of the categorical features
+        """
+        self.n_clusters = n_clusters
+        self.gamma = gamma
+        self.chunk_rows = chunk_rows
+        self.epochs = epochs
+        self.random_state = random_state
+        self.categorical = list(categorical)
+        self.centroides = None
+
+    def _split(self, chunk, agregar = False):
+        """
+        This method splits a chunk into the matrix of continuous features and the matrix of codes of the categorical
+        features. The codes are the positions in the table of categories of each column (-1 if unseen).
+
+        Args:
+            chunk: DataFrame with the features
+            agregar: whether unseen categories are added to the tables of categories
+
+        Returns:
+            tuple with both matrices
+        """
+
+        numericas = [i for i in range(chunk.shape[1]) if i not in self.categorical]
+        xnum = chunk.iloc[:, numericas].to_numpy(np.float64)
+        xcat = np.empty((len(chunk), len(self.categorical)), dtype = np.int64)
+        for j, i in enumerate(self.categorical):
+            valores = np.asarray(chunk.iloc[:, i])
+            codigos = self.categorias[j].get_indexer(valores)
+            if agregar and (codigos < 0).any():
+                nuevas = pd.Index(pd.unique(valores[codigos < 0]))
+                self.categorias[j] = self.categorias[j].append(nuevas) if len(self.categorias[j]) > 0 else nuevas
+                self.frecuencias[j] = np.pad(self.frecuencias[j], ((0, 0), (0, len(self.categorias[j]) - \
+                    self.frecuencias[j].shape[1])))
+                codigos = self.categorias[j].get_indexer(valores)
+            xcat[:, j] = codigos
+
+        return xnum, xcat
+
+    def _costs(self, xnum, xcat):
+        """
+        This method returns the cost of every row for every cluster.
+
+        Args:
+            xnum: matrix of continuous features
+            xcat: matrix of codes of the categorical features
+
+        Returns:
+            matrix with one row per row of the chunk and one column per cluster
+        """
+        return ((xnum[:, np.newaxis, :] - self.centroides[np.newaxis, :, :]) ** 2).sum(axis = 2) + \
+            self.gamma * (xcat[:, np.newaxis, :] != self.modas[np.newaxis, :, :]).sum(axis = 2)
+
+    def _initialize(self, xnum, xcat):
+        """
+        This method picks the initial centroids and modes among the rows of the first chunk with the k-means++ rule: the
+        first one at random and the next ones with probability proportional to their cost for the closest of the clusters
+        already picked.
+
+        Args:
+            xnum: matrix of continuous features
+            xcat: matrix of codes of the categorical features
+        """
+
+        if self.gamma is None:
+            self.gamma = 0.5 * xnum.std(axis = 0).mean() if xnum.shape[1] > 0 else 1.0
+
+        filas = [self._rng.integers(len(xnum))]
+        minimo = np.full(len(xnum), np.inf)
+        while len(filas) < self.n_clusters:
+            minimo = np.minimum(minimo, ((xnum - xnum[filas[-1]]) ** 2).sum(axis = 1) + self.gamma * \
+                (xcat != xcat[filas[-1]]).sum(axis = 1))
+            total = minimo.sum()
+            filas.append(self._rng.choice(len(xnum), p = minimo / total) if total > 0 else self._rng.integers(len(xnum)))
+
+        self.centroides = xnum[filas].copy()
+        self.modas = xcat[filas].copy()
+        self.cuentas = np.zeros(self.n_clusters, dtype = np.int64)
+
+    def partial_fit(self, chunk):
+        """
+        This method updates the model with a chunk of the (scaled) features.
+
+        Args:
+            chunk: DataFrame with the features
+
+        Returns:
+            the model
+        """
+
+        if self.centroides is None:
+            self._rng = np.random.default_rng(self.random_state)
+            self.categorias = [pd.Index([]) for _ in self.categorical]
+            self.frecuencias = [np.zeros((self.n_clusters, 0), dtype = np.int64) for _ in self.categorical]
+
+        xnum, xcat = self._split(chunk, agregar = True)
+        if len(xnum) == 0:
+            return self
+        if self.centroides is None:
+            self._initialize(xnum, xcat)
+
+        labels = self._costs(xnum, xcat).argmin(axis = 1)
+
+        ##### We move each centroid towards the mean of its rows in the chunk, with step (rows in the chunk) / (rows so far)
+        cuentas = np.bincount(labels, minlength = self.n_clusters)
+        self.cuentas += cuentas
+        sumas = np.column_stack([np.bincount(labels, weights = xnum[:, j], minlength = self.n_clusters) for j in \
+            range(xnum.shape[1])]).reshape(self.n_clusters, xnum.shape[1])
+        con_filas = cuentas > 0
+        self.centroides[con_filas] += (sumas[con_filas] - cuentas[con_filas, np.newaxis] * self.centroides[con_filas]) / \
+            self.cuentas[con_filas, np.newaxis]
+
+        ##### We add the categories of the chunk to the frequencies of each cluster and take the most frequent ones as modes
+        for j in range(len(self.categorical)):
+            n_categorias = self.frecuencias[j].shape[1]
+            self.frecuencias[j] += np.bincount(labels * n_categorias + xcat[:, j], minlength = self.n_clusters * \
+                n_categorias).reshape(self.n_clusters, n_categorias)
+            con_frecuencias = self.frecuencias[j].sum(axis = 1) > 0
+            self.modas[con_frecuencias, j] = self.frecuencias[j][con_frecuencias].argmax(axis = 1)
+
+        return self
+
+    def chunks(self, data, orden = None):
+        """
+        This method splits a DataFrame into chunks of chunk_rows rows.
+
+        Args:
+            data: DataFrame with the features
+            orden: order of the rows (the order of data by default)
+
+        Returns:
+            generator of DataFrames
+        """
+        for desde in range(0, len(data), self.chunk_rows):
+            yield data.iloc[desde:desde + self.chunk_rows] if orden is None else \
+                data.iloc[orden[desde:desde + self.chunk_rows]]
+
+    def fit(self, data, categorical = None):
+        """
+        This method fits the model with epochs passes over the (scaled) features and then computes the labels and the
+        cost of the rows with the final clusters.
+
+        Args:
+            data: DataFrame with the features, whose rows are visited in a different random order in each pass, or a
+                function that returns an iterable of DataFrames (e.g., chunks read from a file) every time it is called
+            categorical: positions of the categorical features (the ones given when the model was created by default)
+
+        Returns:
+            the model
+        """
+
+        if categorical is not None:
+            self.categorical = list(categorical)
+        self.centroides = None
+
+        for epoca in range(self.epochs):
+            # The modes of each pass are taken from the rows assigned in that pass
+            if self.centroides is not None:
+                self.frecuencias = [np.zeros_like(frecuencias) for frecuencias in self.frecuencias]
+            if callable(data):
+                chunks = data()
+            else:
+                rng = np.random.default_rng([self.random_state, epoca])
+                chunks = self.chunks(data, rng.permutation(len(data)))
+            for chunk in chunks:
+                self.partial_fit(chunk)
+
+        labels = []
+        self.cost_ = 0.0
+        for chunk in (data() if callable(data) else self.chunks(data)):
+            costo = self._costs(*self._split(chunk))
+            labels.append(costo.argmin(axis = 1))
+            self.cost_ += costo.min(axis = 1).sum()
+        self.labels_ = np.concatenate(labels) if len(labels) > 0 else np.empty(0, dtype = np.int64)
+
+        return self
+
+    def fit_predict(self, data, categorical = None):
+        """
+        This method fits the model and returns the cluster of each row.
+
+        Args:
+            data: DataFrame with the features (see fit())
+            categorical: positions of the categorical features
+
+        Returns:
+            array with the cluster of each row
+        """
+        return self.fit(data, categorical).labels_
+
+    def predict(self, data, categorical = None):
+        """
+        This method predicts the cluster of each row of the (scaled) features.
+
+        Args:
+            data: DataFrame with the features in the order used to fit the model
+            categorical: positions of the categorical features. It is only accepted to keep the signature of kmodes, the
+                positions given when the model was fitted are used
+
+        Returns:
+            array with the cluster of each row
+        """
+        return np.concatenate([self._costs(*self._split(chunk)).argmin(axis = 1) for chunk in self.chunks(data)] or \
+            [np.empty(0, dtype = np.int64)])
+
+    def export(self, scaler, path = "kprototypes.npz"):
+        """
+        This method writes the model and the MinMax scaler into the array artifact used by the FastAPI app (see
+        model_export.py).
+
+        Args:
+            scaler: fitted MinMaxScaler of the continuous features
+            path: path of the .npz file
+        """
+        save_artifact(self.centroides, self.modas, self.gamma, self.categorias, scaler, path, self.categorical)
@@ -0,0 +1,178 @@
+"""
+model_selection.py
+    This script evaluates a grid of numbers of clusters, initialization methods and gamma values of the K-Prototypes model
+    and writes the cost and silhouette of each one into model_selection.csv, so the choice of model_creation.py (3 clusters,
+    Cao initialization and the default gamma) can be checked again after each data refresh
+"""
+
+import os
+import time
+import logging
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import pandas as pd
+from sklearn import preprocessing
+from sklearn.metrics import silhouette_score
+from sklearn.metrics.pairwise import euclidean_distances
+from kmodes.kprototypes import KPrototypes
+from data_creation import data_for_clustering
+
+logger = logging.getLogger(__name__)
+
+# Feature matrix shared by the worker processes (see sweep()) and the shared memory block that holds it
+_shm = None
+_data = None
+
+def feature_matrix(cluster_df, categorical = (0, 4)):
+    """
+    This function builds the matrix used by the sweep: the continuous features scaled to [0, 1] and the categorical
+    features replaced by their codes, so every worker gets them already encoded.
+
+    Args:
+        cluster_df: DataFrame with the features (HORARIO, accidentes, muertes, heridos, vulnerables)
+        categorical: positions of the categorical features
+
+    Returns:
+        float64 matrix with one column per feature
+    """
+
+    matriz = np.empty(cluster_df.shape, dtype = np.float64)
+    numericas = [i for i in range(cluster_df.shape[1]) if i not in categorical]
+    matriz[:, numericas] = preprocessing.MinMaxScaler().fit_transform(cluster_df.iloc[:, numericas])
+    for i in categorical:
+        matriz[:, i] = pd.Categorical(cluster_df.iloc[:, i]).codes
+
+    return matriz
+
+def _init_worker(nombre, shape):
+    """
+    This function attaches the worker process to the shared feature matrix.
+
+    Args:
+        nombre: name of the shared memory block
+        shape: shape of the feature matrix
+    """
+
+    global _shm, _data
+
+    _shm = SharedMemory(name = nombre)
+    _data = np.ndarray(shape, dtype = np.float64, buffer = _shm.buf)
+
+def silhouette(data, labels, gamma, categorical, muestra, seed):
+    """
+    This function computes the silhouette of the clusters with the dissimilarity of the K-Prototypes model (squared
+    Euclidean distance of the continuous features plus gamma times the number of categorical features that differ) on a
+    random sample of rows, since it needs the dissimilarity of every pair of rows.
+
+    Args:
+        data: feature matrix
+        labels: cluster of each row
+        gamma: weight of the categorical features
+        categorical: positions of the categorical features
+        muestra: maximum number of rows used
+        seed: seed of the sample
+
+    Returns:
+        float (NaN when the sample has a single cluster)
+    """
+
+    filas = np.random.default_rng(seed).permutation(len(data))[:muestra]
+    data = data[filas]
+    labels = labels[filas]
+    if len(np.unique(labels)) < 2:
+        return np.nan
+
+    numericas = [i for i in range(data.shape[1]) if i not in categorical]
+    distancias = euclidean_distances(data[:, numericas], squared = True)
+    for i in categorical:
+        distancias += gamma * (data[:, i][:, np.newaxis] != data[:, i][np.newaxis, :])
+    np.fill_diagonal(distancias, 0)
+
+    return silhouette_score(distancias, labels, metric = "precomputed")
+
+def fit_point(n_clusters, init, gamma, seed, n_init, categorical, muestra):
+    """
+    This function fits the K-Prototypes model for one point of the grid on the shared feature matrix.
+
+    Args:
+        n_clusters: number of clusters
+        init: initialization method ("Cao", "Huang" or "random")
+        gamma: weight of the categorical features (None for the default of kmodes)
+        seed: seed of the random initialization
+        n_init: number of initializations run by kmodes
+        categorical: positions of the categorical features
+        muestra: maximum number of rows used to compute the silhouette
+
+    Returns:
+        dictionary with the point of the grid and its results
+    """
+
+    inicio = time.perf_counter()
+    kproto = KPrototypes(n_clusters = n_clusters, init = init, gamma = gamma, n_init = n_init, random_state = seed)
+    kproto.fit(_data, categorical = list(categorical))
+    segundos = time.perf_counter() - inicio
+
+    return {"n_clusters": n_clusters, "init": init, "gamma": gamma, "gamma_fit": kproto.gamma, "cost": kproto.cost_, \
+        "iterations": kproto.n_iter_, "silhouette": silhouette(_data, kproto.labels_, kproto.gamma, categorical, muestra, \
+        seed), "seconds": segundos}
+
+def sweep(data, n_clusters = range(2, 9), inits = ("Cao", "Huang"), gammas = (None,), seed = 0, workers = None, \
+    n_init = 10, categorical = (0, 4), muestra = 2000):
+    """
+    This function fits the K-Prototypes model for every combination of number of clusters, initialization method and
+    gamma in a pool of processes. The feature matrix is placed once in shared memory, so the processes read the same copy
+    instead of receiving their own.
+
+    Args:
+        data: feature matrix (see feature_matrix())
+        n_clusters: numbers of clusters
+        inits: initialization methods ("Cao", "Huang" or "random")
+        gammas: weights of the categorical features (None for the default of kmodes)
+        seed: seed of the random initialization of every fit
+        workers: number of processes. It defaults to the environment variable TRAINING_WORKERS (default: number of CPUs)
+        n_init: number of initializations run by kmodes in each fit
+        categorical: positions of the categorical features
+        muestra: maximum number of rows used to compute the silhouette
+
+    Returns:
+        DataFrame with one row per combination: cost, silhouette, iterations and seconds
+    """
+
+    workers = workers or int(os.environ.get("TRAINING_WORKERS", os.cpu_count() or 1))
+    data = np.ascontiguousarray(data, dtype = np.float64)
+
+    shm = SharedMemory(create = True, size = max(data.nbytes, 1))
+    try:
+        np.ndarray(data.shape, dtype = np.float64, buffer = shm.buf)[:] = data
+        resultados = []
+        with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (shm.name, data.shape)) \
+            as executor:
+            futures = [executor.submit(fit_point, k, init, gamma, seed, n_init, categorical, muestra) for k, init, gamma \
+                in product(n_clusters, inits, gammas)]
+            for future in futures:
+                resultado = future.result()
+                logger.info("%d clusters, %s, gamma %s: cost %.6f, silhouette %.4f in %.2f s", resultado["n_clusters"], \
+                    resultado["init"], resultado["gamma"], resultado["cost"], resultado["silhouette"], resultado["seconds"])
+                resultados.append(resultado)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return pd.DataFrame(resultados)
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(message)s")
+
+    ##### The date and the grid below can be modified before running the script
+    cluster_df = data_for_clustering(2022, 9, 30)
+    data = feature_matrix(cluster_df[["HORARIO", "accidentes", "muertes", "heridos", "vulnerables"]])
+
+    del cluster_df
+
+    resultados = sweep(data, n_clusters = range(2, 9), inits = ("Cao", "Huang"), gammas = (None, 0.1, 0.5, 1.0))
+
+    ##### We save the results (one cost curve per initialization method and gamma)
+    resultados.sort_values(["init", "gamma", "n_clusters"], na_position = "first").to_csv("model_selection.csv", \
+        index = False)
@@ -0,0 +1,108 @@
+"""
+model_training.py
+    Parallel multi-restart training of the K-Prototypes model used for the prioritization clustering
+"""
+
+import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from kmodes.kprototypes import KPrototypes
+
+logger = logging.getLogger(__name__)
+
+# Data used by the restarts of each worker process. It is sent once per process (see train_kprototypes()) instead of once
+# per restart
+_data = None
+
+def _init_worker(data):
+    """
+    This function keeps the data used by the restarts in the worker process.
+
+    Args:
+        data: DataFrame with the (scaled) features
+    """
+
+    global _data
+
+    _data = data
+
+def fit_restart(seed, n_clusters, init, n_init, categorical):
+    """
+    This function fits the K-Prototypes model once with a given seed on the data of the worker process.
+
+    Args:
+        seed: seed of the random initialization
+        n_clusters: number of clusters
+        init: initialization method ("Cao", "Huang" or "random")
+        n_init: number of initializations run by kmodes in each restart
+        categorical: positions of the categorical features
+
+    Returns:
+        tuple with the fitted model and the number of seconds the fit took
+    """
+
+    inicio = time.perf_counter()
+    kproto = KPrototypes(n_clusters = n_clusters, init = init, n_init = n_init, random_state = seed)
+    kproto.fit(_data, categorical = list(categorical))
+
+    return kproto, time.perf_counter() - inicio
+
+def train_kprototypes(data, n_clusters = 3, init = "Cao", restarts = 50, seed = 0, workers = None, patience = None, \
+    tol = 0.0, n_init = 10, categorical = (0, 4)):
+    """
+    This function fits the K-Prototypes model several times (restarts) in a pool of processes and returns the model with
+    the lowest cost along with its labels, so the best model does not need to be fitted again. Every restart gets its own
+    seed derived from seed, so the training can be reproduced. Only the best model is kept in memory.
+
+    The restarts are checked in the order of their seeds, so early stopping does not depend on which process finishes
+    first: when patience is set, the training stops after patience restarts in a row that do not lower the best cost by
+    more than tol.
+
+    Args:
+        data: DataFrame with the (scaled) features
+        n_clusters: number of clusters
+        init: initialization method ("Cao", "Huang" or "random")
+        restarts: maximum number of restarts
+        seed: seed used to derive the seed of each restart
+        workers: number of processes. It defaults to the environment variable TRAINING_WORKERS (default: number of CPUs)
+        patience: number of restarts in a row with no improvement after which the training stops (None to run every
+            restart)
+        tol: minimum decrease of the cost that counts as an improvement
+        n_init: number of initializations run by kmodes in each restart
+        categorical: positions of the categorical features
+
+    Returns:
+        tuple with the best model, its labels and the list of (seed, cost, seconds) of the restarts that were checked
+    """
+
+    workers = workers or int(os.environ.get("TRAINING_WORKERS", os.cpu_count() or 1))
+    seeds = np.random.SeedSequence(seed).generate_state(restarts).tolist()
+
+    best = None
+    historial = []
+    sin_mejora = 0
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (data,)) as executor:
+        futures = [executor.submit(fit_restart, s, n_clusters, init, n_init, categorical) for s in seeds]
+        for i, future in enumerate(futures):
+            kproto, segundos = future.result()
+            futures[i] = None
+            historial.append((seeds[i], kproto.cost_, segundos))
+            logger.info("Restart %d/%d (seed %d): cost %.6f in %.2f s", i + 1, restarts, seeds[i], kproto.cost_, segundos)
+
+            if best is None or kproto.cost_ < best.cost_ - tol:
+                best = kproto
+                sin_mejora = 0
+            else:
+                sin_mejora += 1
+
+            if patience is not None and sin_mejora >= patience:
+                logger.info("No improvement in %d restarts, stopping after %d restarts", patience, i + 1)
+                for pendiente in futures[i + 1:]:
+                    pendiente.cancel()
+                break
+
+    logger.info("Best cost %.6f", best.cost_)
+
+    return best, best.labels_, historial
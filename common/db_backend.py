@@ -0,0 +1,343 @@
+"""
+db_backend.py
+    Backends that run the read-only queries of the clustering, the FastAPI app and the motorcycle accidents script: the
+    accidents database (Postgres) or DuckDB, an in-process columnar engine, over local Parquet snapshots of its tables
+"""
+
+import os
+import sys
+import time
+import threading
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Folder of the Parquet snapshots used when the environment variable ACCIDENTS_SNAPSHOT_PATH is not set
+DEFAULT_SNAPSHOT_PATH = "../snapshots"
+
+# Tables read by the clustering, the FastAPI app and the motorcycle accidents script
+SNAPSHOT_TABLES = ["siniestros", "conheridos", "confallecidos", "vehiculos", "corredores_diarios", "version_datos"]
+
+# Arrow type of each column type of the database
+COLUMN_TYPES = {
+    "smallint": pa.int16(),
+    "integer": pa.int32(),
+    "bigint": pa.int64(),
+    "real": pa.float32(),
+    "double precision": pa.float64(),
+    "numeric": pa.float64(),
+    "boolean": pa.bool_(),
+    "character varying": pa.string(),
+    "character": pa.string(),
+    "text": pa.string(),
+    "date": pa.date32(),
+    "timestamp without time zone": pa.timestamp("us"),
+}
+
+# Rows fetched and written at a time when the snapshots are exported
+CHUNK_ROWS = int(os.environ.get("SNAPSHOT_CHUNK_ROWS", 100000))
+
+_backend = None
+_lock = threading.Lock()
+
+class SnapshotError(Exception):
+    """
+    Class that represents a missing Parquet snapshot of a table.
+    """
+
+class QueryCancelled(Exception):
+    """
+    Class that represents queries that were cancelled before they ran, e.g., because the request that needed them timed
+    out.
+    """
+
+def backend_errors():
+    """
+    This function returns the exceptions raised when the backend cannot run the queries: a missing snapshot and, once the
+    Postgres backend was used, the errors of the database. psycopg2 is only imported by the Postgres backend, so it is not
+    loaded when the queries run with DuckDB.
+
+    Returns:
+        tuple of exception classes
+    """
+
+    errores = (SnapshotError,)
+    psycopg2 = sys.modules.get("psycopg2")
+    if psycopg2 is not None:
+        errores += (psycopg2.Error,)
+
+    return errores
+
+def check_cancelled(cancel):
+    """
+    This function raises QueryCancelled if the queries were cancelled.
+
+    Args:
+        cancel: threading.Event that is set to cancel the queries (or None)
+    """
+    if cancel is not None and cancel.is_set():
+        raise QueryCancelled("The queries were cancelled")
+
+class PostgresBackend:
+    """
+    Class that runs the queries in the accidents database with connections borrowed from the pool (see db_connection.py).
+    """
+
+    name = "postgres"
+
+    def __init__(self):
+        # psycopg2 is only needed by this backend, so we import the pool here
+        from db_connection import init_pool
+        init_pool()
+
+    def read_sql(self, query):
+        """
+        This method runs a query with a connection borrowed from the pool.
+
+        Args:
+            query: query string
+
+        Returns:
+            DataFrame (column names in lowercase)
+        """
+        from db_connection import get_connection
+        with get_connection() as db_conn:
+            return pd.read_sql(query, con = db_conn)
+
+    def read_many(self, queries, cancel = None):
+        """
+        This method runs several queries one after another with a single connection borrowed from the pool.
+
+        Args:
+            queries: dict with the queries
+            cancel: threading.Event checked before each query (see check_cancelled())
+
+        Returns:
+            dict with a DataFrame per query
+        """
+
+        from db_connection import get_connection
+
+        frames = {}
+        with get_connection() as db_conn:
+            for name, query in queries.items():
+                check_cancelled(cancel)
+                frames[name] = pd.read_sql(query, con = db_conn)
+
+        return frames
+
+    def close(self):
+        """
+        This method closes every connection of the pool.
+        """
+        from db_connection import close_pool
+        close_pool()
+
+class DuckDBBackend:
+    """
+    Class that runs the queries with DuckDB over the Parquet snapshots of the tables (see export_snapshots()). Each table
+    is a view of its Parquet file, so the files are scanned by column and in parallel, and a new snapshot is read by the
+    next query without restarting. The queries are written for Postgres, and the ones of this repo run as they are in
+    DuckDB; the column names of the results are turned to lowercase, as Postgres does with unquoted names.
+    """
+
+    name = "duckdb"
+
+    def __init__(self, path = None, tables = None):
+        """
+        Args:
+            path: folder of the snapshots. It defaults to the environment variable ACCIDENTS_SNAPSHOT_PATH (default
+                ../snapshots)
+            tables: tables with a view (SNAPSHOT_TABLES by default). Tables with no snapshot are left out, so queries on
+                them fail
+        """
+
+        import duckdb
+
+        self.path = path or os.environ.get("ACCIDENTS_SNAPSHOT_PATH", DEFAULT_SNAPSHOT_PATH)
+        self.tables = [table for table in (tables or SNAPSHOT_TABLES) if os.path.exists(snapshot_file(table, self.path))]
+        if len(self.tables) == 0:
+            raise SnapshotError("No Parquet snapshots in " + os.path.abspath(self.path))
+
+        self._conn = duckdb.connect(":memory:")
+        for table in self.tables:
+            archivo = os.path.abspath(snapshot_file(table, self.path)).replace("'", "''")
+            self._conn.execute("CREATE VIEW " + table + " AS SELECT * FROM read_parquet('" + archivo + "')")
+
+    def read_sql(self, query):
+        """
+        This method runs a query. Every call uses its own cursor of the DuckDB database, so queries can run at the same
+        time from several threads.
+
+        Args:
+            query: query string
+
+        Returns:
+            DataFrame (column names in lowercase)
+        """
+
+        cursor = self._conn.cursor()
+        try:
+            resultado = cursor.execute(query).df()
+        finally:
+            cursor.close()
+        resultado.columns = [column.lower() for column in resultado.columns]
+
+        return resultado
+
+    def read_many(self, queries, cancel = None):
+        """
+        This method runs several queries one after another.
+
+        Args:
+            queries: dict with the queries
+            cancel: threading.Event checked before each query (see check_cancelled())
+
+        Returns:
+            dict with a DataFrame per query
+        """
+
+        frames = {}
+        for name, query in queries.items():
+            check_cancelled(cancel)
+            frames[name] = self.read_sql(query)
+
+        return frames
+
+    def close(self):
+        """
+        This method closes the DuckDB database.
+        """
+        self._conn.close()
+
+BACKENDS = {"postgres": PostgresBackend, "duckdb": DuckDBBackend}
+
+def init_backend(name = None, **kwargs):
+    """
+    This function creates the backend that runs the queries. It does nothing if the backend already exists.
+
+    Args:
+        name: "postgres" or "duckdb". It defaults to the environment variable ACCIDENTS_DB_BACKEND (default "postgres")
+        kwargs: arguments of the backend (e.g., path of DuckDBBackend)
+
+    Returns:
+        PostgresBackend or DuckDBBackend
+    """
+
+    global _backend
+
+    with _lock:
+        if _backend is None:
+            name = name or os.environ.get("ACCIDENTS_DB_BACKEND", "postgres")
+            if name not in BACKENDS:
+                raise ValueError("Unknown backend " + name + ", expected one of " + ", ".join(BACKENDS))
+            _backend = BACKENDS[name](**kwargs)
+
+    return _backend
+
+def close_backend():
+    """
+    This function closes the backend, so the next query creates it again.
+    """
+
+    global _backend
+
+    with _lock:
+        if _backend is not None:
+            _backend.close()
+            _backend = None
+
+def snapshot_file(table, path = None):
+    """
+    This function returns the path of the Parquet snapshot of a table.
+
+    Args:
+        table: table name
+        path: folder of the snapshots (the environment variable ACCIDENTS_SNAPSHOT_PATH by default)
+
+    Returns:
+        path string
+    """
+    return os.path.join(path or os.environ.get("ACCIDENTS_SNAPSHOT_PATH", DEFAULT_SNAPSHOT_PATH), table + ".parquet")
+
+def export_snapshot(db_conn, table, path = None, chunk_rows = None):
+    """
+    This function writes a table of the database into its Parquet snapshot. The rows are fetched with a server-side
+    cursor and written chunk_rows at a time, so the memory used does not grow with the size of the table, and the
+    snapshot replaces the previous one only once it is complete.
+
+    Args:
+        db_conn: database connection
+        table: table name
+        path: folder of the snapshots (the environment variable ACCIDENTS_SNAPSHOT_PATH by default)
+        chunk_rows: rows fetched and written at a time (the environment variable SNAPSHOT_CHUNK_ROWS by default)
+
+    Returns:
+        number of rows
+    """
+
+    chunk_rows = chunk_rows or CHUNK_ROWS
+    archivo = snapshot_file(table, path)
+    os.makedirs(os.path.dirname(archivo) or ".", exist_ok = True)
+
+    cursor = db_conn.cursor()
+    cursor.execute("""
+    SELECT column_name, data_type FROM information_schema.columns
+    WHERE table_name = %s
+    ORDER BY ordinal_position
+    """, (table.lower(),))
+    schema = pa.schema([(column, COLUMN_TYPES.get(tipo, pa.string())) for column, tipo in cursor.fetchall()])
+    cursor.close()
+    if len(schema) == 0:
+        raise SnapshotError("Table " + table + " does not exist")
+
+    filas = 0
+    cursor = db_conn.cursor(name = "snapshot_" + table)
+    cursor.itersize = chunk_rows
+    try:
+        cursor.execute("SELECT " + ", ".join(schema.names) + " FROM " + table)
+        with pq.ParquetWriter(archivo + ".tmp", schema, compression = "zstd") as escritor:
+            while True:
+                chunk = cursor.fetchmany(chunk_rows)
+                if len(chunk) == 0:
+                    break
+                columnas = list(zip(*chunk))
+                escritor.write_table(pa.table([pa.array(columnas[i], type = schema.field(i).type) for i in \
+                    range(len(schema))], schema = schema))
+                filas += len(chunk)
+    finally:
+        cursor.close()
+    os.replace(archivo + ".tmp", archivo)
+
+    return filas
+
+def export_snapshots(path = None, tables = None, chunk_rows = None):
+    """
+    This function writes the tables read by the clustering, the FastAPI app and the motorcycle accidents script into
+    Parquet snapshots (see export_snapshot()), which DuckDBBackend reads. It should run after every load of the data
+    pipeline.
+
+    Args:
+        path: folder of the snapshots (the environment variable ACCIDENTS_SNAPSHOT_PATH by default)
+        tables: tables to export (SNAPSHOT_TABLES by default)
+        chunk_rows: rows fetched and written at a time (the environment variable SNAPSHOT_CHUNK_ROWS by default)
+
+    Returns:
+        dict with the number of rows of each table
+    """
+
+    # The snapshots are exported from the database, so we import the pool here
+    from db_connection import get_connection
+
+    filas = {}
+    with get_connection() as db_conn:
+        for table in tables or SNAPSHOT_TABLES:
+            inicio = time.perf_counter()
+            filas[table] = export_snapshot(db_conn, table, path, chunk_rows)
+            print(table + ": " + str(filas[table]) + " rows in " + str(round(time.perf_counter() - inicio, 1)) + " s")
+
+    return filas
+
+if __name__ == "__main__":
+    ##### We export the snapshots into the folder given as argument (ACCIDENTS_SNAPSHOT_PATH by default)
+    export_snapshots(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,138 @@
+"""
+db_connection.py
+    Pool of connections to the accidents database shared by the functions that query it
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import pool
+
+# Connection parameters used when the environment variable ACCIDENTS_DB_DSN is not set
+DEFAULT_DSN = "dbname=accidents_smb user=dev password=dev host=127.0.0.1 port=5432"
+
+_pool = None
+_slots = None
+_last_used = {}
+_lock = threading.Lock()
+
+def init_pool(dsn = None, minconn = None, maxconn = None):
+    """
+    This function creates the pool of connections to the database. It does nothing if the pool already exists. The
+    arguments default to the environment variables ACCIDENTS_DB_DSN, DB_POOL_MIN (default 1) and DB_POOL_MAX (default 10).
+
+    Args:
+        dsn: database connection string, e.g., "dbname=accidents_smb user=dev password=dev host=127.0.0.1 port=5432"
+        minconn: number of connections opened when the pool is created
+        maxconn: maximum number of connections opened at the same time
+
+    Returns:
+        ThreadedConnectionPool
+    """
+
+    global _pool, _slots
+
+    with _lock:
+        if _pool is None:
+            dsn = dsn or os.environ.get("ACCIDENTS_DB_DSN", DEFAULT_DSN)
+            minconn = minconn if minconn is not None else int(os.environ.get("DB_POOL_MIN", 1))
+            maxconn = maxconn if maxconn is not None else int(os.environ.get("DB_POOL_MAX", 10))
+            _pool = pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+            # The pool fails instead of waiting when all its connections are in use, so we make callers wait for a free
+            # connection instead
+            _slots = threading.BoundedSemaphore(maxconn)
+
+    return _pool
+
+def close_pool():
+    """
+    This function closes every connection of the pool.
+    """
+
+    global _pool, _slots
+
+    with _lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _slots = None
+            _last_used.clear()
+
+def _is_healthy(conn):
+    """
+    This function checks whether a connection can still be used. Connections used recently are assumed to be healthy, while
+    connections idle for more than DB_POOL_CHECK_INTERVAL seconds (default 30) are checked with a trivial query.
+
+    Args:
+        conn: connection to check
+
+    Returns:
+        bool
+    """
+
+    if conn.closed:
+        return False
+    if time.monotonic() - _last_used.get(id(conn), 0) < float(os.environ.get("DB_POOL_CHECK_INTERVAL", 30)):
+        return True
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+@contextmanager
+def get_connection(timeout = None):
+    """
+    This function borrows a connection from the pool and returns it to the pool once the with block ends. Broken
+    connections are closed and replaced by new ones. Any transaction left open is rolled back, so callers that write to
+    the database must commit inside the with block.
+
+        with get_connection() as db_conn:
+            df = pd.read_sql(query, con = db_conn)
+
+    Args:
+        timeout: number of seconds to wait for a free connection. It defaults to the environment variable DB_POOL_TIMEOUT
+            (default 30)
+
+    Returns:
+        psycopg2 connection
+    """
+
+    db_pool = init_pool()
+    slots = _slots
+    timeout = timeout if timeout is not None else float(os.environ.get("DB_POOL_TIMEOUT", 30))
+    if not slots.acquire(timeout = timeout):
+        raise pool.PoolError("No database connection became available in " + str(timeout) + " seconds")
+
+    try:
+        conn = db_pool.getconn()
+        if not _is_healthy(conn):
+            db_pool.putconn(conn, close = True)
+            _last_used.pop(id(conn), None)
+            conn = db_pool.getconn()
+
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            broken = broken or conn.closed != 0
+            if not broken:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            if broken:
+                _last_used.pop(id(conn), None)
+            else:
+                _last_used[id(conn)] = time.monotonic()
+            db_pool.putconn(conn, close = broken)
+    finally:
+        slots.release()
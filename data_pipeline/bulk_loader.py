@@ -0,0 +1,146 @@
+"""
+bulk_loader.py
+    Loads DataFrames into the accidents database with COPY FROM STDIN. The rows are sent in chunks written as CSV, so the
+    memory used does not grow with the size of the table, and a re-load can replace the rows already in the table through
+    a staging table
+"""
+
+import io
+import os
+import time
+import psycopg2
+
+# Rows per COPY command
+CHUNK_ROWS = int(os.environ.get("BULK_CHUNK_ROWS", 100000))
+
+# Text of the NULL values in the CSV chunks. It is not an empty string, so empty strings are not loaded as NULL
+NULL = "\\N"
+
+def integer_columns(cursor, table):
+    """
+    This function returns the integer columns of a table.
+
+    Args:
+        cursor: database cursor
+        table: table name
+
+    Returns:
+        set with the column names (lowercase)
+    """
+
+    cursor.execute("""
+    SELECT column_name FROM information_schema.columns
+    WHERE table_name = %s AND data_type IN ('smallint', 'integer', 'bigint')
+    """, (table.lower(),))
+
+    return {row[0] for row in cursor.fetchall()}
+
+def has_unique_key(cursor, table, key):
+    """
+    This function checks whether a table has a primary key or unique index on exactly the given columns.
+
+    Args:
+        cursor: database cursor
+        table: table name
+        key: list of column names
+
+    Returns:
+        bool
+    """
+
+    cursor.execute("""
+    SELECT 1 FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indrelid
+    WHERE c.relname = %s AND i.indisunique AND
+        (SELECT array_agg(a.attname::TEXT ORDER BY a.attname::TEXT) FROM pg_attribute a
+        WHERE a.attrelid = c.oid AND a.attnum = ANY(i.indkey)) = %s::TEXT[]
+    """, (table.lower(), sorted(column.lower() for column in key)))
+
+    return cursor.fetchone() is not None
+
+def copy_dataframe(cursor, df, table, chunk_rows = None):
+    """
+    This function sends the rows of a DataFrame to a table with one COPY FROM STDIN command per chunk of rows. Float columns
+    loaded into integer columns (i.e., integers with missing values) are sent as integers, since COPY does not accept
+    decimals in integer columns.
+
+    Args:
+        cursor: database cursor
+        df: DataFrame whose columns have the names of the columns of the table
+        table: table name
+        chunk_rows: rows per chunk (the environment variable BULK_CHUNK_ROWS by default)
+    """
+
+    chunk_rows = chunk_rows or CHUNK_ROWS
+    enteras_tabla = integer_columns(cursor, table)
+    enteras = [column for column in df.columns if column.lower() in enteras_tabla and df[column].dtype.kind == "f"]
+    query = "COPY " + table + "(" + ",".join(df.columns) + ") FROM STDIN WITH (FORMAT csv, NULL '" + NULL + "')"
+
+    for desde in range(0, len(df), chunk_rows):
+        chunk = df.iloc[desde:desde + chunk_rows]
+        if enteras:
+            chunk = chunk.astype({column: "Int64" for column in enteras})
+        buffer = io.StringIO()
+        chunk.to_csv(buffer, header = False, index = False, na_rep = NULL)
+        buffer.seek(0)
+        cursor.copy_expert(query, buffer)
+
+def load_dataframe(conn, df, table, key = None, chunk_rows = None):
+    """
+    This function loads a DataFrame into a table with COPY (see copy_dataframe()) in a single transaction and prints the
+    number of rows loaded per second. A failed load is rolled back and its error raised.
+
+    If key is given, the rows are copied into a temporary staging table and then merged into the table, so loading the same
+    rows again does not duplicate them: when the table has a primary key or unique index on the key columns, the rows with
+    a key already in the table are updated (INSERT ... ON CONFLICT, which does not fire the ON DELETE CASCADE of the tables
+    that reference it); otherwise, the rows of the table with the keys of the DataFrame are deleted and the new ones
+    inserted. Rows of the DataFrame with the same key are loaded once.
+
+    Args:
+        conn: database connection
+        df: DataFrame whose columns have the names of the columns of the table
+        table: table name
+        key: list with the columns that identify a row (None to append the rows)
+        chunk_rows: rows per chunk (the environment variable BULK_CHUNK_ROWS by default)
+
+    Returns:
+        number of rows loaded per second
+    """
+
+    inicio = time.perf_counter()
+    cursor = conn.cursor()
+    try:
+        if key is None:
+            copy_dataframe(cursor, df, table, chunk_rows)
+        else:
+            staging = table + "_staging"
+            columnas = ",".join(df.columns)
+            claves = ",".join(key)
+            cursor.execute("CREATE TEMPORARY TABLE " + staging + " (LIKE " + table + " INCLUDING DEFAULTS) ON COMMIT DROP")
+            copy_dataframe(cursor, df, staging, chunk_rows)
+            # Temporary tables have no statistics until they are analyzed, which leads to slow plans for the merge
+            cursor.execute("ANALYZE " + staging)
+
+            filas = "SELECT DISTINCT ON (" + claves + ") " + columnas + " FROM " + staging
+            if has_unique_key(cursor, table, key):
+                actualizar = [column for column in df.columns if column.lower() not in {k.lower() for k in key}]
+                cursor.execute("INSERT INTO " + table + "(" + columnas + ") " + filas + " ON CONFLICT (" + claves + \
+                    ") DO " + ("UPDATE SET " + ",".join(column + " = EXCLUDED." + column for column in actualizar) if \
+                    actualizar else "NOTHING"))
+            else:
+                cursor.execute("DELETE FROM " + table + " t USING (SELECT DISTINCT " + claves + " FROM " + staging + \
+                    ") s WHERE " + " AND ".join("t." + k + " = s." + k for k in key))
+                cursor.execute("INSERT INTO " + table + "(" + columnas + ") " + filas)
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    segundos = time.perf_counter() - inicio
+    filas_segundo = len(df) / segundos if segundos > 0 else float("inf")
+    print(str(len(df)) + " rows loaded into " + table + " in " + str(round(segundos, 1)) + " s (" + \
+        str(int(filas_segundo)) + " rows/s)")
+
+    return filas_segundo
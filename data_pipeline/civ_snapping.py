@@ -0,0 +1,269 @@
+"""
+civ_snapping.py
+    Assigns the accidents with no CIV (stored as 0) to the nearest corridor of the Malla Vial, so they are not dropped by
+    the clustering. The corridor geometries are kept in a spatial index (STRtree) and the accidents are matched in batches
+    with a single nearest-neighbor query per batch, up to a maximum distance. The assigned CIV is stored in siniestros
+    along with its distance (column DISTANCIA_CIV, see migrations/003_distancia_civ.sql), so it is computed once per load.
+
+    The data pipeline assigns the accidents it loads. To assign the accidents already stored in the database and refresh
+    the daily corridor counts, navigate to the folder data_pipeline and run:
+
+        python civ_snapping.py
+
+    To compare the spatial index with a search over every corridor on a sample of the accidents, run:
+
+        python civ_snapping.py benchmark
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+import psycopg2
+import shapely
+import geopandas as gpd
+# The database modules shared by every folder are in the folder common at the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from db_connection import get_connection
+from db_backend import export_snapshots
+from bulk_loader import copy_dataframe
+
+MALLA_PATH = "../clustering/Malla_Vial_Integral_Bogota_r2.geojson"
+
+# Projected coordinate system of the distances (MAGNA-SIRGAS / Colombia Bogota zone, in meters)
+CRS = "EPSG:3116"
+
+# Maximum distance (in meters) from an accident to its corridor (0 for no maximum) and accidents matched at a time
+MAX_DISTANCE = float(os.environ.get("SNAP_MAX_DISTANCE", 50))
+BATCH_ROWS = int(os.environ.get("SNAP_BATCH_ROWS", 100000))
+
+class CorridorSnapper:
+    """
+    Class that keeps the corridor geometries of the Malla Vial in an STRtree and finds the nearest corridor of batches of
+    accidents. Only corridors with a name are kept (the same ones as the corridor index of data_creation.py), so every
+    assigned CIV can be used by the clustering.
+    """
+
+    def __init__(self, malla_path = None):
+        """
+        Args:
+            malla_path: path to the Malla Vial GeoJSON file (MALLA_PATH by default)
+        """
+
+        malla = gpd.read_file(malla_path or MALLA_PATH, columns = ["MVICIV", "MVINOMBRE"])
+        malla = malla[malla["MVICIV"].notna() & malla.geometry.notna() & ~malla.geometry.is_empty]
+
+        ### The corridor index keeps the name of the first record of each CIV, so we keep the CIV values whose first
+            ### record has a name (see build_malla_index() in data_creation.py)
+        con_nombre = malla.drop_duplicates("MVICIV")
+        con_nombre = con_nombre.loc[con_nombre["MVINOMBRE"].notna(), "MVICIV"]
+        malla = malla[malla["MVICIV"].isin(con_nombre)].to_crs(CRS)
+
+        self.civ = malla["MVICIV"].to_numpy(np.int64)
+        self.geometrias = np.asarray(malla.geometry.values)
+        self.tree = shapely.STRtree(self.geometrias)
+
+    def snap(self, longitud, latitud, max_distance = None, batch_rows = None):
+        """
+        This method returns the CIV of the nearest corridor of each accident and its distance. Accidents with no corridor
+        within max_distance (or with no coordinates) get CIV 0 and distance NaN.
+
+        Args:
+            longitud: array with the longitude of the accidents (WGS 84)
+            latitud: array with the latitude of the accidents (WGS 84)
+            max_distance: maximum distance in meters (the environment variable SNAP_MAX_DISTANCE by default, 0 for no
+                maximum)
+            batch_rows: accidents matched at a time (the environment variable SNAP_BATCH_ROWS by default)
+
+        Returns:
+            tuple with the array of CIV values and the array of distances in meters
+        """
+
+        max_distance = MAX_DISTANCE if max_distance is None else max_distance
+        batch_rows = batch_rows or BATCH_ROWS
+        longitud = np.asarray(longitud, dtype = np.float64)
+        latitud = np.asarray(latitud, dtype = np.float64)
+
+        civ = np.zeros(len(longitud), dtype = np.int64)
+        distancia = np.full(len(longitud), np.nan)
+        validas = np.flatnonzero(np.isfinite(longitud) & np.isfinite(latitud))
+
+        for desde in range(0, len(validas), batch_rows):
+            filas = validas[desde:desde + batch_rows]
+            puntos = gpd.GeoSeries(gpd.points_from_xy(longitud[filas], latitud[filas], crs = "EPSG:4326")).to_crs(CRS) \
+                .values
+            # One nearest corridor per accident (ties are broken arbitrarily). Accidents with no corridor within the
+            # maximum distance are left out of the result
+            pares, distancias = self.tree.query_nearest(np.asarray(puntos), max_distance = max_distance or None, \
+                return_distance = True, all_matches = False)
+            civ[filas[pares[0]]] = self.civ[pares[1]]
+            distancia[filas[pares[0]]] = distancias
+
+        return civ, distancia
+
+def snap_accidents(accidents_df, snapper = None, max_distance = None):
+    """
+    This function assigns the accidents of a DataFrame with CIV 0 to the nearest corridor (see CorridorSnapper.snap()) and
+    fills the column DISTANCIA_CIV, which is NaN for the rest of the accidents.
+
+    Args:
+        accidents_df: DataFrame with the columns CIV, LONGITUD and LATITUD
+        snapper: CorridorSnapper (one is created by default)
+        max_distance: maximum distance in meters (the environment variable SNAP_MAX_DISTANCE by default)
+
+    Returns:
+        DataFrame
+    """
+
+    snapper = snapper or CorridorSnapper()
+    sin_civ = (accidents_df["CIV"].fillna(0) == 0).to_numpy()
+
+    civ, distancia = snapper.snap(accidents_df["LONGITUD"].to_numpy()[sin_civ], \
+        accidents_df["LATITUD"].to_numpy()[sin_civ], max_distance)
+    accidents_df = accidents_df.copy()
+    accidents_df.loc[sin_civ, "CIV"] = civ
+    accidents_df["DISTANCIA_CIV"] = np.nan
+    accidents_df.loc[sin_civ, "DISTANCIA_CIV"] = distancia
+
+    return accidents_df
+
+def date_ranges(fechas):
+    """
+    This function groups dates into ranges of consecutive days.
+
+    Args:
+        fechas: list of dates
+
+    Returns:
+        list of tuples with the first and last date of each range (both included), sorted by date
+    """
+
+    dias = pd.Series(pd.to_datetime(fechas)).drop_duplicates().sort_values(ignore_index = True)
+    rango = (dias.diff() != pd.Timedelta(days = 1)).cumsum().to_numpy()
+
+    return [(grupo.iloc[0].date(), grupo.iloc[-1].date()) for _, grupo in dias.groupby(rango)]
+
+def snap_database(desde = None, hasta = None, snapper = None, max_distance = None, again = False):
+    """
+    This function assigns the accidents stored in siniestros with CIV 0 (or NULL) to the nearest corridor (see
+    CorridorSnapper.snap()) and refreshes the daily corridor counts (table corredores_diarios) of the dates with changes, in
+    a single transaction. The update raises the data version of the database (see migrations/004_version_datos.sql), so the FastAPI
+    app drops the results computed before, and the Parquet snapshots are exported again when the environment variable
+    ACCIDENTS_SNAPSHOT_PATH is set (see db_backend.export_snapshots()).
+
+    Args:
+        desde: start date string (yyyy-mm-dd, included). All the accidents by default
+        hasta: end date string (yyyy-mm-dd, included). All the accidents by default
+        snapper: CorridorSnapper (one is created by default)
+        max_distance: maximum distance in meters (the environment variable SNAP_MAX_DISTANCE by default)
+        again: whether the accidents assigned before are assigned again (e.g., after the Malla Vial is updated)
+
+    Returns:
+        number of accidents assigned to a corridor
+    """
+
+    snapper = snapper or CorridorSnapper()
+    fechas = ("FECHA >= '" + desde + "' AND " if desde else "") + ("FECHA <= '" + hasta + "' AND " if hasta else "")
+
+    with get_connection() as db_conn:
+        cursor = db_conn.cursor()
+        try:
+            limpiadas = []
+            if again:
+                cursor.execute("WITH limpiados AS (UPDATE siniestros SET CIV = 0, DISTANCIA_CIV = NULL WHERE " + fechas + \
+                    "DISTANCIA_CIV IS NOT NULL RETURNING FECHA) SELECT DISTINCT FECHA FROM limpiados")
+                limpiadas = [fila[0] for fila in cursor.fetchall()]
+            accidents_df = pd.read_sql("SELECT FORMULARIO, LONGITUD, LATITUD, FECHA FROM siniestros WHERE " + fechas + \
+                "(CIV = 0 OR CIV IS NULL)", con = db_conn)
+
+            civ, distancia = snapper.snap(accidents_df["longitud"], accidents_df["latitud"], max_distance)
+            asignados = accidents_df.assign(CIV = civ, DISTANCIA_CIV = distancia)[civ != 0]
+
+            # We copy the assigned CIV values into a staging table and update siniestros from it. Every statement on
+            # siniestros raises the data version, so we skip the update when no accident was assigned
+            if len(asignados) > 0:
+                cursor.execute("CREATE TEMPORARY TABLE civ_staging (FORMULARIO VARCHAR, CIV INT, DISTANCIA_CIV REAL) " \
+                    "ON COMMIT DROP")
+                copy_dataframe(cursor, asignados[["formulario", "CIV", "DISTANCIA_CIV"]].rename(columns = {"formulario": \
+                    "FORMULARIO"}), "civ_staging")
+                cursor.execute("ANALYZE civ_staging")
+                cursor.execute("""
+                UPDATE siniestros SET CIV = civ_staging.CIV, DISTANCIA_CIV = civ_staging.DISTANCIA_CIV
+                FROM civ_staging
+                WHERE siniestros.FORMULARIO = civ_staging.FORMULARIO
+                """)
+
+            # The daily corridor counts change on the dates of the accidents assigned and of the ones whose CIV was
+                # cleared, so we only refresh those dates (one range of consecutive dates at a time)
+            rangos = date_ranges(list(asignados["fecha"]) + limpiadas)
+            for inicio, fin in rangos:
+                cursor.execute("SELECT refrescar_corredores_diarios(%s, %s)", (inicio, fin))
+            cambios = len(rangos) > 0
+            db_conn.commit()
+        except psycopg2.Error:
+            db_conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    print(str(len(asignados)) + " of " + str(len(accidents_df)) + " accidents with no CIV assigned to a corridor")
+
+    # We refresh the Parquet snapshots read by the clustering, the FastAPI app and the motorcycle accidents script when they
+    # run with DuckDB, as the data pipeline does after each load
+    if cambios and os.environ.get("ACCIDENTS_SNAPSHOT_PATH"):
+        export_snapshots()
+
+    return len(asignados)
+
+def benchmark(snapper = None, muestra = 2000, max_distance = None, seed = 0):
+    """
+    This function times the spatial index against a search over every corridor on a random sample of the accidents with
+    no CIV and checks that both find corridors at the same distance.
+
+    Args:
+        snapper: CorridorSnapper (one is created by default)
+        muestra: number of accidents of the sample
+        max_distance: maximum distance in meters (the environment variable SNAP_MAX_DISTANCE by default)
+        seed: seed of the sample
+
+    Returns:
+        dict with the accidents per second of both searches and the number of accidents whose distance differs
+    """
+
+    snapper = snapper or CorridorSnapper()
+    max_distance = MAX_DISTANCE if max_distance is None else max_distance
+    with get_connection() as db_conn:
+        accidents_df = pd.read_sql("SELECT LONGITUD, LATITUD FROM siniestros WHERE (CIV = 0 OR CIV IS NULL) AND " \
+            "DISTANCIA_CIV IS NULL AND LONGITUD IS NOT NULL AND LATITUD IS NOT NULL", con = db_conn)
+    accidents_df = accidents_df.iloc[np.random.default_rng(seed).permutation(len(accidents_df))[:muestra]]
+    longitud = accidents_df["longitud"].to_numpy()
+    latitud = accidents_df["latitud"].to_numpy()
+
+    inicio = time.perf_counter()
+    civ, distancia = snapper.snap(longitud, latitud, max_distance)
+    indice = time.perf_counter() - inicio
+
+    ##### Search over every corridor: the distance from each accident to every corridor geometry
+    inicio = time.perf_counter()
+    puntos = np.asarray(gpd.GeoSeries(gpd.points_from_xy(longitud, latitud, crs = "EPSG:4326")).to_crs(CRS).values)
+    distancia_todos = np.full(len(puntos), np.nan)
+    for i, punto in enumerate(puntos):
+        distancias = shapely.distance(punto, snapper.geometrias)
+        distancia_todos[i] = distancias.min() if distancias.min() <= (max_distance or np.inf) else np.nan
+    todos = time.perf_counter() - inicio
+
+    diferentes = int((~np.isclose(distancia, distancia_todos, equal_nan = True)).sum())
+    resultado = {"accidents": len(puntos), "corridors": len(snapper.geometrias), "index_per_second": len(puntos) / \
+        indice, "all_per_second": len(puntos) / todos, "different": diferentes}
+    print(resultado)
+
+    return resultado
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        benchmark()
+    else:
+        inicio = time.perf_counter()
+        snap_database()
+        print("Done in " + str(round(time.perf_counter() - inicio, 1)) + " s")
@@ -0,0 +1,335 @@
+"""
+gis_fetcher.py
+    This script pulls the layers of the ArcGIS service of accidents of the Secretary of Mobility of Bogotá. The rows of a
+    query are split into pages of OBJECTID ranges (or result offsets) that are pulled at the same time by a pool of threads,
+    with retries, and the pages are handed over as DataFrames as soon as they arrive, so they can be transformed without
+    writing the responses to files. The pages already handed over are recorded in a checkpoint file, so an interrupted
+    pull resumes from the pages that were missing.
+
+    To pull a layer into a CSV file, navigate to the folder data_pipeline and run, e.g.:
+
+        python gis_fetcher.py accidents "ANO_OCURRENCIA_ACC = 2022" accidents_2022.csv
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import urllib.request
+import urllib.parse
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+
+GIS_URL = os.environ.get("GIS_URL", \
+    "https://sig.simur.gov.co/arcgis/rest/services/Accidentalidad/WSAcidentalidad_Publico/FeatureServer")
+
+# Layer number, fields and whether the geometry is pulled of each layer of the service
+LAYERS = {
+    "accidents": (0, "OBJECTID, FORMULARIO, LOCALIDAD, CIV, PK_CALZADA, CLASE_ACC, GRAVEDAD, FECHA_HORA_ACC", True),
+    "killed_people": (1, "OBJECTID, FORMULARIO, LOCALIDAD, CLASE_ACC, CONDICION, GENERO, EDAD, MUERTE_POSTERIOR, " \
+        "FECHA_POSTERIOR_MUERTE, FECHA_HORA_ACC", True),
+    "injured_people": (2, "OBJECTID, FORMULARIO, LOCALIDAD, CLASE_ACC, CONDICION, GENERO, EDAD, FECHA_HORA_ACC", True),
+    "vehicles": (4, "OBJECTID, FORMULARIO, CODIGO_VEHICULO, CLASE, SERVICIO, MODALIDAD, ENFUGA", False),
+    "causes": (5, "OBJECTID, FORMULARIO, CODIGO_VEHICULO, CODIGO_CAUSA, NOMBRE, TIPO, TIPO_CAUSA", False),
+    "actors": (6, "OBJECTID, FORMULARIO, CODIGO_VICTIMA, CODIGO_VEHICULO, CONDICION, GENERO, EDAD, ESTADO, " \
+        "MUERTE_POSTERIOR, FECHA_POSTERIOR_MUERTE", False),
+}
+
+# The service returns at most 50,000 rows per query and large queries sometimes get no response, so the pages are smaller
+PAGE_ROWS = int(os.environ.get("GIS_PAGE_ROWS", 30000))
+WORKERS = int(os.environ.get("GIS_WORKERS", 4))
+RETRIES = int(os.environ.get("GIS_RETRIES", 5))
+TIMEOUT = float(os.environ.get("GIS_TIMEOUT", 300))
+
+class GISServiceError(Exception):
+    """
+    Class that represents an error returned by the GIS service in the body of a response.
+    """
+
+def query(layer, params, url = None, retries = None, timeout = None):
+    """
+    This function runs a query on a layer of the GIS service and returns the parsed JSON response. Failed requests
+    (connection errors, timeouts, server errors and errors in the body of the response) are retried with exponential
+    backoff.
+
+    Args:
+        layer: layer number
+        params: dictionary with the parameters of the query
+        url: URL of the service (GIS_URL by default)
+        retries: number of retries (the environment variable GIS_RETRIES by default)
+        timeout: seconds to wait for a response (the environment variable GIS_TIMEOUT by default)
+
+    Returns:
+        dictionary
+    """
+
+    url = (url or GIS_URL).rstrip("/") + "/" + str(layer) + "/query"
+    retries = RETRIES if retries is None else retries
+    data = urllib.parse.urlencode(dict(params, f = "json")).encode("utf-8")
+
+    for intento in range(retries + 1):
+        try:
+            with urllib.request.urlopen(url, data, timeout = timeout or TIMEOUT) as response:
+                respuesta = json.loads(response.read())
+            if "error" in respuesta:
+                raise GISServiceError(respuesta["error"])
+            return respuesta
+        except urllib.error.HTTPError as error:
+            # Client errors will not go away by asking again (except for throttling)
+            if (error.code < 500 and error.code != 429) or intento == retries:
+                raise
+        except (urllib.error.URLError, TimeoutError, ConnectionError, json.JSONDecodeError, GISServiceError):
+            if intento == retries:
+                raise
+        time.sleep(min(2 ** intento, 60) * (1 + random.random()))
+
+def features_frame(respuesta):
+    """
+    This function turns the features of a response into a DataFrame, removing "attributes." from the column names (the
+    coordinates are kept in the columns geometry.x and geometry.y).
+
+    Args:
+        respuesta: dictionary with the response of the service
+
+    Returns:
+        DataFrame
+    """
+
+    features_df = pd.json_normalize(respuesta.get("features", []))
+    features_df.rename(columns = {column: column.replace("attributes.", "") for column in features_df.columns}, \
+        inplace = True)
+
+    return features_df
+
+def plan_pages(layer, where, page_rows = None, url = None, by = "objectid"):
+    """
+    This function splits the rows that match a query into pages.
+
+    With by = "objectid", the OBJECTID values of the rows are pulled first (the service returns all of them in one
+    response) and each page is a range of OBJECTID values with page_rows rows at most, so gaps in OBJECTID do not matter.
+    With by = "offset", the number of rows is pulled first and each page is a range of positions of the rows sorted by
+    OBJECTID (resultOffset), which requires the layer to support pagination.
+
+    Args:
+        layer: layer number
+        where: where clause of the query
+        page_rows: rows per page (the environment variable GIS_PAGE_ROWS by default)
+        url: URL of the service (GIS_URL by default)
+        by: "objectid" or "offset"
+
+    Returns:
+        list of [by, start, end, rows] pages
+    """
+
+    page_rows = page_rows or PAGE_ROWS
+    if by == "objectid":
+        ids = sorted(query(layer, {"where": where, "returnIdsOnly": "true"}, url).get("objectIds") or [])
+        return [["objectid", ids[desde], ids[min(desde + page_rows, len(ids)) - 1], min(page_rows, len(ids) - desde)] \
+            for desde in range(0, len(ids), page_rows)]
+
+    filas = query(layer, {"where": where, "returnCountOnly": "true"}, url)["count"]
+    return [["offset", desde, min(desde + page_rows, filas), min(desde + page_rows, filas) - desde] for desde in \
+        range(0, filas, page_rows)]
+
+def fetch_page(layer, where, page, fields, geometry, url = None):
+    """
+    This function pulls a page of rows. If the service returns fewer rows than asked for because of its limit of rows per
+    query, the rest of the page is pulled with more queries (halving the OBJECTID range or moving the offset).
+
+    Args:
+        layer: layer number
+        where: where clause of the query
+        page: [by, start, end, rows] page (see plan_pages())
+        fields: fields to pull
+        geometry: whether the geometry is pulled
+        url: URL of the service (GIS_URL by default)
+
+    Returns:
+        list with the features of the page
+    """
+
+    by, desde, hasta, filas = page
+    params = {"outFields": fields, "returnGeometry": "true" if geometry else "false"}
+
+    if by == "objectid":
+        respuesta = query(layer, dict(params, where = "(" + where + ") AND OBJECTID BETWEEN " + str(desde) + " AND " + \
+            str(hasta)), url)
+        features = respuesta.get("features", [])
+        if respuesta.get("exceededTransferLimit") and hasta > desde:
+            mitad = (desde + hasta) // 2
+            features = fetch_page(layer, where, ["objectid", desde, mitad, None], fields, geometry, url) + \
+                fetch_page(layer, where, ["objectid", mitad + 1, hasta, None], fields, geometry, url)
+        return features
+
+    features = []
+    while desde < hasta:
+        respuesta = query(layer, dict(params, where = where, orderByFields = "OBJECTID", resultOffset = desde, \
+            resultRecordCount = hasta - desde), url)
+        pagina = respuesta.get("features", [])
+        if len(pagina) == 0:
+            break
+        features += pagina
+        desde += len(pagina)
+
+    return features
+
+def _read_checkpoint(path, clave):
+    """
+    This function reads the checkpoint of a pull. The checkpoint is only used if it belongs to the same query.
+
+    Args:
+        path: path of the checkpoint file
+        clave: dictionary that identifies the query
+
+    Returns:
+        dictionary with the pages of the pull and the pages already handed over, or None
+    """
+
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        checkpoint = json.load(f)
+
+    return checkpoint if checkpoint.get("query") == clave else None
+
+def _write_checkpoint(path, checkpoint):
+    """
+    This function writes the checkpoint of a pull, replacing the previous one only once it is complete.
+
+    Args:
+        path: path of the checkpoint file
+        checkpoint: dictionary with the query, the pages of the pull and the pages already handed over
+    """
+
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+def fetch_layer(name, where, checkpoint = None, workers = None, page_rows = None, url = None, by = "objectid"):
+    """
+    This function pulls the rows of a layer that match a where clause and yields them as DataFrames, one per page, as the
+    pages arrive (not in order). The pages are pulled at the same time by a pool of threads, with at most twice as many
+    pages in memory as threads.
+
+    If a checkpoint path is given, the pages that were handed over (i.e., the loop that consumes this generator asked for
+    the next page) are recorded there, and a new pull of the same query only pulls the missing pages. The checkpoint is
+    removed once every page was handed over.
+
+    Args:
+        name: name of the layer (see LAYERS)
+        where: where clause of the query
+        checkpoint: path of the checkpoint file (None for no checkpoint)
+        workers: number of threads (the environment variable GIS_WORKERS by default)
+        page_rows: rows per page (the environment variable GIS_PAGE_ROWS by default)
+        url: URL of the service (GIS_URL by default)
+        by: "objectid" or "offset" (see plan_pages())
+
+    Returns:
+        generator of DataFrames
+    """
+
+    layer, fields, geometry = LAYERS[name]
+    workers = workers or WORKERS
+    clave = {"layer": name, "where": where, "by": by}
+
+    estado = _read_checkpoint(checkpoint, clave)
+    if estado is None:
+        estado = {"query": clave, "pages": plan_pages(layer, where, page_rows, url, by), "done": []}
+        if checkpoint is not None:
+            _write_checkpoint(checkpoint, estado)
+    hechas = {tuple(page) for page in estado["done"]}
+    pendientes = [page for page in estado["pages"] if tuple(page) not in hechas]
+
+    with ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "gis") as executor:
+        en_curso = {}
+        try:
+            while pendientes or en_curso:
+                while pendientes and len(en_curso) < 2 * workers:
+                    page = pendientes.pop(0)
+                    en_curso[executor.submit(fetch_page, layer, where, page, fields, geometry, url)] = page
+                listas, _ = wait(en_curso, return_when = FIRST_COMPLETED)
+                for future in listas:
+                    page = en_curso.pop(future)
+                    yield features_frame({"features": future.result()})
+                    if checkpoint is not None:
+                        estado["done"].append(page)
+                        _write_checkpoint(checkpoint, estado)
+        finally:
+            for future in en_curso:
+                future.cancel()
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.unlink(checkpoint)
+
+def layer_columns(name):
+    """
+    This function returns the columns of the DataFrames of a layer: its fields (see LAYERS) and, for the layers with
+    geometry, the coordinates.
+
+    Args:
+        name: name of the layer (see LAYERS)
+
+    Returns:
+        list of column names
+    """
+
+    _, fields, geometry = LAYERS[name]
+    columnas = [field.strip() for field in fields.split(",")]
+
+    return columnas + (["geometry.x", "geometry.y"] if geometry else [])
+
+def fetch_csv(name, where, path, **kwargs):
+    """
+    This function pulls the rows of a layer that match a where clause into a CSV file, appending each page to the file as
+    it arrives. The order of the columns of the pages returned by the service may differ, so every page is written with
+    the columns of layer_columns(). The checkpoint (path + ".checkpoint") lets an interrupted pull resume: the rows of the
+    pages that were written are not pulled again.
+
+    Args:
+        name: name of the layer (see LAYERS)
+        where: where clause of the query
+        path: path of the CSV file
+        kwargs: arguments of fetch_layer()
+
+    Returns:
+        number of rows written
+    """
+
+    columnas = layer_columns(name)
+    filas = 0
+    for pagina in fetch_layer(name, where, checkpoint = path + ".checkpoint", **kwargs):
+        pagina.reindex(columns = columnas).to_csv(path, mode = "a", header = not os.path.exists(path) or \
+            os.path.getsize(path) == 0, index = False)
+        filas += len(pagina)
+        print(str(filas) + " rows")
+
+    return filas
+
+def fetch_frame(name, where, **kwargs):
+    """
+    This function pulls the rows of a layer that match a where clause into a single DataFrame sorted by OBJECTID.
+
+    Args:
+        name: name of the layer (see LAYERS)
+        where: where clause of the query
+        kwargs: arguments of fetch_layer()
+
+    Returns:
+        DataFrame
+    """
+
+    paginas = [pagina for pagina in fetch_layer(name, where, **kwargs) if len(pagina) > 0]
+    if len(paginas) == 0:
+        return pd.DataFrame()
+
+    return pd.concat(paginas, ignore_index = True).sort_values("OBJECTID", ignore_index = True)
+
+if __name__ == "__main__":
+    name, where, path = sys.argv[1:4]
+
+    ##### We append each page to the CSV file as it arrives (see fetch_csv())
+    inicio = time.perf_counter()
+    fetch_csv(name, where, path)
+    print("Done in " + str(round(time.perf_counter() - inicio, 1)) + " s")
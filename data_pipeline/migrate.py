@@ -0,0 +1,76 @@
+"""
+migrate.py
+    This script applies the pending migrations from the folder migrations to the accidents database. Migrations are .sql
+    files applied in the order given by their version prefix (001_, 002_, ...). The applied versions are recorded in the
+    table schema_migrations, so running the script twice does nothing the second time.
+
+    Run it after creating the database (initial_etl/4_database_creation.ipynb) and every time a new migration is added
+"""
+
+import os
+import sys
+import glob
+# The database modules shared by every folder are in the folder common at the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from db_connection import get_connection
+
+MIGRATIONS_PATH = "migrations"
+
+def pending_migrations(db_conn):
+    """
+    This function returns the migrations that have not been applied to the database.
+
+    Args:
+        db_conn: database connection
+
+    Returns:
+        list with the paths of the pending migrations, sorted by version
+    """
+
+    cursor = db_conn.cursor()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations(
+        VERSION VARCHAR(10) PRIMARY KEY,
+        NOMBRE VARCHAR(100),
+        APLICADA TIMESTAMP DEFAULT now()
+    )
+    """)
+    cursor.execute("SELECT VERSION FROM schema_migrations")
+    applied = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    db_conn.commit()
+
+    migrations = sorted(glob.glob(os.path.join(MIGRATIONS_PATH, "*.sql")))
+    return [path for path in migrations if os.path.basename(path).split("_")[0] not in applied]
+
+def apply_migration(db_conn, path):
+    """
+    This function applies a migration and records it in schema_migrations in the same transaction, so a failed
+    migration leaves the database untouched.
+
+    Args:
+        db_conn: database connection
+        path: path of the migration
+    """
+
+    name = os.path.basename(path)
+    with open(path, "r") as f:
+        sql = f.read()
+
+    cursor = db_conn.cursor()
+    try:
+        cursor.execute(sql)
+        cursor.execute("INSERT INTO schema_migrations(VERSION, NOMBRE) VALUES (%s, %s)", (name.split("_")[0], name))
+        db_conn.commit()
+    except Exception:
+        db_conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+if __name__ == "__main__":
+    with get_connection() as db_conn:
+        for path in pending_migrations(db_conn):
+            print("Applying " + path)
+            apply_migration(db_conn, path)
+        print("The database is up to date")
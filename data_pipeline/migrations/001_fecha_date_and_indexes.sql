@@ -0,0 +1,38 @@
+-- 001_fecha_date_and_indexes.sql
+--     Adds a DATE column with the accident date to siniestros and indexes it, so that date windows can be filtered with
+--     range predicates instead of substring(FECHA_ACC, 1, 10). It also indexes the FORMULARIO join key of the tables that
+--     reference siniestros
+
+-- We add the date column and backfill it from FECHA_ACC (yyyy-mm-dd...)
+ALTER TABLE siniestros ADD COLUMN IF NOT EXISTS FECHA DATE;
+UPDATE siniestros SET FECHA = substring(FECHA_ACC, 1, 10)::DATE WHERE FECHA IS NULL AND FECHA_ACC IS NOT NULL;
+
+-- We keep the date column in sync with FECHA_ACC for the rows inserted (or updated) by the data pipeline
+CREATE OR REPLACE FUNCTION siniestros_fecha() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.FECHA := substring(NEW.FECHA_ACC, 1, 10)::DATE;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS siniestros_fecha_trigger ON siniestros;
+CREATE TRIGGER siniestros_fecha_trigger
+    BEFORE INSERT OR UPDATE OF FECHA_ACC ON siniestros
+    FOR EACH ROW EXECUTE FUNCTION siniestros_fecha();
+
+-- B-tree index on the date column for the date window filters
+CREATE INDEX IF NOT EXISTS siniestros_fecha_idx ON siniestros (FECHA);
+
+-- B-tree indexes on the FORMULARIO join key
+CREATE INDEX IF NOT EXISTS conheridos_formulario_idx ON conheridos (FORMULARIO);
+CREATE INDEX IF NOT EXISTS confallecidos_formulario_idx ON confallecidos (FORMULARIO);
+CREATE INDEX IF NOT EXISTS vehiculos_formulario_idx ON vehiculos (FORMULARIO);
+CREATE INDEX IF NOT EXISTS actores_formulario_idx ON actores (FORMULARIO);
+CREATE INDEX IF NOT EXISTS causas_formulario_idx ON causas (FORMULARIO);
+
+ANALYZE siniestros;
+ANALYZE conheridos;
+ANALYZE confallecidos;
+ANALYZE vehiculos;
+ANALYZE actores;
+ANALYZE causas;
@@ -0,0 +1,76 @@
+-- 002_corredores_diarios.sql
+--     Adds the table corredores_diarios with the number of accidents, killed people, injured people, killed vulnerable
+--     people and injured vulnerable people per corridor (CIV) per day per hour, i.e., the counts data_for_clustering()
+--     needs. Summing this table over a date window gives the same counts as aggregating the raw tables, but the cost of
+--     doing so depends on the number of corridors instead of the number of accidents.
+--
+--     The data pipeline refreshes the table with refrescar_corredores_diarios() for the dates it loads, so only those dates
+--     are recomputed
+
+CREATE TABLE IF NOT EXISTS corredores_diarios(
+    CIV INT,
+    FECHA DATE,
+    DIA_OCURRENCIA_ACC VARCHAR(25),
+    HORA_OCURRENCIA_ACC SMALLINT,
+    ACCIDENTES INT,
+    MUERTES INT,
+    HERIDOS INT,
+    MUERTES_VULNERABLES INT,
+    HERIDOS_VULNERABLES INT,
+    CONSTRAINT CORREDORES_DIARIOS_PK PRIMARY KEY (FECHA, CIV, DIA_OCURRENCIA_ACC, HORA_OCURRENCIA_ACC)
+);
+
+-- Recomputes the rows of corredores_diarios between the dates desde and hasta (both included). Every accident contributes
+-- its injured people once if its severity is 'CON HERIDOS' and once more if it has killed people, which mirrors how
+-- data_for_clustering() adds up the injured people from its queries (see corridor_counts_query() in data_creation.py)
+CREATE OR REPLACE FUNCTION refrescar_corredores_diarios(desde DATE, hasta DATE) RETURNS VOID AS $$
+BEGIN
+    DELETE FROM corredores_diarios WHERE FECHA >= desde AND FECHA <= hasta;
+
+    INSERT INTO corredores_diarios
+    WITH ventana AS (
+        SELECT FORMULARIO, CIV, FECHA, DIA_OCURRENCIA_ACC, HORA_OCURRENCIA_ACC, GRAVEDAD
+        FROM siniestros
+        WHERE FECHA >= desde AND FECHA <= hasta AND
+            CIV <> 0 AND DIA_OCURRENCIA_ACC IS NOT NULL AND HORA_OCURRENCIA_ACC IS NOT NULL
+    ),
+    heridos AS (
+        SELECT conheridos.FORMULARIO, COUNT(conheridos.FORMULARIO) AS heridos,
+            COUNT(conheridos.FORMULARIO) FILTER (WHERE conheridos.CONDICION IN ('PEATON', 'CICLISTA', 'MOTOCICLISTA'))
+                AS heridos_vulnerables
+        FROM conheridos
+        JOIN ventana ON ventana.FORMULARIO = conheridos.FORMULARIO
+        GROUP BY conheridos.FORMULARIO
+    ),
+    fallecidos AS (
+        SELECT confallecidos.FORMULARIO, COUNT(confallecidos.FORMULARIO) AS muertes,
+            COUNT(confallecidos.FORMULARIO) FILTER (WHERE confallecidos.CONDICION IN ('PEATON', 'CICLISTA', 'MOTOCICLISTA'))
+                AS muertes_vulnerables
+        FROM confallecidos
+        JOIN ventana ON ventana.FORMULARIO = confallecidos.FORMULARIO
+        GROUP BY confallecidos.FORMULARIO
+    ),
+    por_siniestro AS (
+        SELECT ventana.CIV, ventana.FECHA, ventana.DIA_OCURRENCIA_ACC, ventana.HORA_OCURRENCIA_ACC,
+            COALESCE(fallecidos.muertes, 0) AS muertes,
+            COALESCE(fallecidos.muertes_vulnerables, 0) AS muertes_vulnerables,
+            COALESCE(heridos.heridos, 0) AS heridos,
+            COALESCE(heridos.heridos_vulnerables, 0) AS heridos_vulnerables,
+            (CASE WHEN ventana.GRAVEDAD = 'CON HERIDOS' THEN 1 ELSE 0 END) +
+                (CASE WHEN fallecidos.FORMULARIO IS NOT NULL THEN 1 ELSE 0 END) AS veces_heridos
+        FROM ventana
+        LEFT JOIN heridos ON heridos.FORMULARIO = ventana.FORMULARIO
+        LEFT JOIN fallecidos ON fallecidos.FORMULARIO = ventana.FORMULARIO
+    )
+    SELECT CIV, FECHA, DIA_OCURRENCIA_ACC, HORA_OCURRENCIA_ACC,
+        COUNT(*), SUM(muertes), SUM(heridos*veces_heridos), SUM(muertes_vulnerables),
+        SUM(heridos_vulnerables*veces_heridos)
+    FROM por_siniestro
+    GROUP BY CIV, FECHA, DIA_OCURRENCIA_ACC, HORA_OCURRENCIA_ACC;
+END;
+$$ LANGUAGE plpgsql;
+
+-- We fill the table with the data already loaded
+SELECT refrescar_corredores_diarios(MIN(FECHA), MAX(FECHA)) FROM siniestros;
+
+ANALYZE corredores_diarios;
@@ -0,0 +1,8 @@
+-- 003_distancia_civ.sql
+--     Adds the column DISTANCIA_CIV to siniestros. Accidents pulled with no CIV (stored as 0) are assigned the CIV of the
+--     nearest Malla Vial corridor by the data pipeline (see civ_snapping.py), and DISTANCIA_CIV keeps the distance from the
+--     accident to that corridor, in meters. It is NULL for the CIV values that came from the GIS service, so the assigned
+--     ones can be told apart (or undone with UPDATE siniestros SET CIV = 0, DISTANCIA_CIV = NULL WHERE DISTANCIA_CIV IS
+--     NOT NULL)
+
+ALTER TABLE siniestros ADD COLUMN IF NOT EXISTS DISTANCIA_CIV REAL;
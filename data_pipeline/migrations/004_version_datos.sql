@@ -0,0 +1,34 @@
+-- 004_version_datos.sql
+--     Adds the table version_datos with a single number that goes up every time a statement changes the rows of the
+--     accident tables. The latest accident date and the number of accidents do not change when a re-load updates rows
+--     (see bulk_loader.py) or when the CIV of accidents is assigned (see civ_snapping.py), so the load watermark of the
+--     FastAPI app (see data_watermark() in data_creation.py) includes this number to notice those changes as well
+
+CREATE TABLE IF NOT EXISTS version_datos(
+    VERSION BIGINT NOT NULL
+);
+
+INSERT INTO version_datos(VERSION) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM version_datos);
+
+CREATE OR REPLACE FUNCTION aumentar_version_datos() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE version_datos SET VERSION = VERSION + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Statement-level triggers fire once per statement (INSERT, UPDATE, DELETE, TRUNCATE and COPY), however many rows it changes
+DO $$
+DECLARE
+    tabla TEXT;
+BEGIN
+    FOREACH tabla IN ARRAY ARRAY['siniestros', 'conheridos', 'confallecidos', 'vehiculos', 'causas', 'actores',
+        'corredores_diarios'] LOOP
+        IF to_regclass(tabla) IS NOT NULL THEN
+            EXECUTE 'DROP TRIGGER IF EXISTS ' || tabla || '_version_datos ON ' || tabla;
+            EXECUTE 'CREATE TRIGGER ' || tabla || '_version_datos AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON ' ||
+                tabla || ' FOR EACH STATEMENT EXECUTE FUNCTION aumentar_version_datos()';
+        END IF;
+    END LOOP;
+END;
+$$;
@@ -4,20 +4,49 @@ ml_api.py
     new 3-year accident data
 """
 
-import io
-from calendar import isleap
-from pydantic import BaseModel
+import os
+import sys
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from pydantic import BaseModel, Field
 import pandas as pd
-from fastapi import FastAPI, Form, Depends
-from fastapi.responses import StreamingResponse
-from ml_functions import load_scaler, load_model, load_data
+from fastapi import FastAPI, Form, Depends, Header, HTTPException
+from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+# The database modules shared by every folder are in the folder common at the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from db_backend import init_backend, close_backend, check_cancelled, backend_errors
+from ml_functions import load_native_model, load_data, load_data_batch, normalize_date, load_prediction_cache, \
+    window_engine_enabled, load_window_engine, negotiate_format, stream_chunks, MEDIA_TYPES
 
-# Load the MinMaxScaler and the K-Prototypes model
-scaler = load_scaler()
-model = load_model()
+# The K-Prototypes model and the MinMaxScaler (exported into a compact array artifact, see clustering/model_export.py) are
+# loaded when the app starts rather than when this module is imported, so workers start serving as soon as possible.
+# The endpoint /ready/ reports whether the model, the database and the WindowEngine (when enabled) are ready
+model = None
+readiness = {"model": False, "database": False}
+
+# Keep the latest results in memory. Dashboard refreshes request the same month-end dates over and over again
+prediction_cache = load_prediction_cache()
+
+# The prediction pipeline is synchronous (database queries, pandas and the model), so we run it in a bounded pool of
+# threads to keep the event loop free. The pool size and the timeout per request (in seconds) can be set with the
+# environment variables PREDICT_WORKERS and PREDICT_TIMEOUT
+def load_executor():
+    """
+    This function returns the pool of threads of the predictions, with PREDICT_WORKERS threads (4 by default).
+
+    Returns:
+        ThreadPoolExecutor
+    """
+    return ThreadPoolExecutor(max_workers = int(os.environ.get("PREDICT_WORKERS", 4)), thread_name_prefix = "predict")
+
+executor = load_executor()
+predict_timeout = float(os.environ.get("PREDICT_TIMEOUT", 120))
 
 # Define the input data model. The user only needs to input the date to retrieve 3-year data
-# up to such date
+# up to such date. The number of years of data can be changed as well
 class InputDate(BaseModel):
     """
     Class that defines the model input typing.
@@ -25,73 +54,318 @@ class InputDate(BaseModel):
     year: int = Form(ge = 2018, le = 2023)
     month: int = Form(ge = 1, le = 12)
     day: int = Form(ge = 1, le = 31)
+    years: int = Form(3, ge = 1, le = 5)
+
+class BatchDate(BaseModel):
+    """
+    Class that defines the typing of each date of a batch prediction.
+    """
+    year: int = Field(ge = 2018, le = 2023)
+    month: int = Field(ge = 1, le = 12)
+    day: int = Field(ge = 1, le = 31)
+
+# Define the input data model of the batch predictions. Reporting jobs request several dates (e.g., every month-end of
+# several years) at once
+class InputDates(BaseModel):
+    """
+    Class that defines the batch model input typing.
+    """
+    dates: List[BatchDate] = Field(min_length = 1, max_length = 120)
+    years: int = Field(3, ge = 1, le = 5)
+    format: Optional[str] = Field(None, pattern = "^(csv|parquet|arrow)$")
+    
+def model_features(data):
+    """
+    This function takes the features used for the prediction, in the order used to fit the model.
+
+    Args:
+        data: DataFrame returned by load_data()
+
+    Returns:
+        DataFrame with the features
+    """
+    return data[["HORARIO", "accidentes", "muertes", "heridos", "vulnerables"]]
+
+def label_corridors(data, clusters):
+    """
+    This function appends the priority levels to the data and sorts the highway corridors by priority.
+
+    Args:
+        data: DataFrame returned by load_data()
+        clusters: labels predicted for the rows of data
+
+    Returns:
+        DataFrame with the highway corridors and their priority levels
+    """
+
+    # We append the predictions to the data
+    data = pd.concat((data, pd.DataFrame(clusters)), axis = 1)
+
+    # When the labels are converted into a DataFrame, the column is called 0. We rename it
+    data.rename({0: "Prioridad"}, axis = 1, inplace = True)
     
+    # From the analyses run when creating the model, we know what the labels in "clusters" represent.
+    # However, if the K-Prototypes model is re-estimated, "dictp" must be revised
+    dictp = {0: "3 NA", 1: "2 Complementario", 2: "1 Priorizado"}
+    data.replace({"Prioridad": dictp}, inplace = True)
+    data.sort_values(by = ["Prioridad", "vulnerables", "muertes", "muertes_vulnerables", "heridos_vulnerables"], \
+        ascending = [True, False, False, False, False], inplace = True)
+
+    return data
+
+def prioritized_corridors(year, month, day, years = 3, cancel = None):
+    """
+    This function predicts the priority levels of the highway corridors using 3-year data up to the date year-month-day.
+
+    Args:
+        year: date argument
+        month: date argument
+        day: date argument
+        years: number of years of data up to the date (default 3)
+        cancel: threading.Event that is set to cancel the prediction, checked before each query and before the clustering
+
+    Returns:
+        DataFrame with the highway corridors and their priority levels
+    """
+
+    # We load the 3-year data for the prediction
+    data = load_data(year, month, day, years = years, cancel = cancel)
+    check_cancelled(cancel)
+
+    # We run the prediction. The model scales the continuous features with the stored MinMaxScaler
+    clusters = model.predict(model_features(data))
+
+    return label_corridors(data, clusters)
+
+def prioritized_corridors_batch(dates, years = 3, cancel = None):
+    """
+    This function predicts the priority levels of the highway corridors for several dates at once. The data of every date
+    is derived from a single read of the database and the model runs once on the features of all the dates.
+
+    Args:
+        dates: list of normalized dates (year, month, day)
+        years: number of years of data up to each date (default 3)
+        cancel: threading.Event that is set to cancel the prediction, checked before each query and before the clustering
+
+    Returns:
+        DataFrame with the date (FECHA), the highway corridors and their priority levels
+    """
+
+    # We load the data of every date. Dates with no data are left out
+    cargados = load_data_batch(dates, years = years, cancel = cancel)
+    datas = [(date, data) for date, data in zip(dates, cargados) if len(data) > 0]
+    if len(datas) == 0:
+        # No date has data, so we return the columns with no rows (a file with the header only)
+        data = label_corridors(cargados[0], pd.Series(dtype = "int64"))
+        data.insert(0, "FECHA", pd.Series(dtype = object))
+        return data
+    check_cancelled(cancel)
+
+    # The prediction runs once on the features of all the dates
+    clusters = model.predict(pd.concat([model_features(data) for _, data in datas], ignore_index = True))
+
+    results = []
+    inicio = 0
+    for (year, month, day), data in datas:
+        data = label_corridors(data, clusters[inicio:inicio + len(data)])
+        data.insert(0, "FECHA", str(pd.Timestamp(year = year, month = month, day = day))[0:10])
+        results.append(data)
+        inicio += len(data)
+
+    return pd.concat(results, ignore_index = True)
+
+def prioritized_corridors_cached(year, month, day, years = 3, cancel = None):
+    """
+    This function returns the priority levels of the highway corridors using 3-year data up to the date year-month-day.
+    The result is taken from the cache when possible.
+
+    Args:
+        year: date argument
+        month: date argument
+        day: date argument
+        years: number of years of data up to the date (default 3)
+        cancel: threading.Event that is set to cancel the prediction (see prioritized_corridors())
+
+    Returns:
+        DataFrame with the highway corridors and their priority levels
+    """
+
+    # We only run the prediction if there is no valid result for the date in the cache
+    date = (year, month, day, years)
+    data = prediction_cache.get(date)
+    if data is None:
+        # We take the watermark before running the prediction, so the result is dropped if new data is loaded meanwhile
+        watermark = prediction_cache.watermark()
+        data = prioritized_corridors(*date, cancel = cancel)
+        prediction_cache.put(date, data, watermark)
+
+    return data
+
+async def run_prediction(func, *args):
+    """
+    This function runs a prediction in the pool of threads and waits for it up to predict_timeout seconds. A prediction
+    that takes longer is cancelled: if it has not started yet, it is removed from the queue of the pool, and if it is
+    running, it stops before its next query or before the clustering, so it releases its thread and database connection.
+
+    Args:
+        func: prediction function, which takes the event that cancels it as its last argument
+        args: arguments of the prediction function
+
+    Returns:
+        result of the prediction function
+    """
+
+    cancel = threading.Event()
+    future = asyncio.get_running_loop().run_in_executor(executor, func, *args, cancel)
+    try:
+        return await asyncio.wait_for(future, timeout = predict_timeout)
+    except asyncio.TimeoutError:
+        # wait_for() cancels the future, which drops the job if it is still queued. The running job checks the event
+        cancel.set()
+        raise HTTPException(status_code = 504, detail = "The prediction took longer than " + str(predict_timeout) + \
+            " seconds")
+
+def streaming_response(data, fmt):
+    """
+    This function returns the response that streams the predictions in the given format. The content is generated in
+    batches of rows while it is sent, so it is never held in memory as a whole.
+
+    Args:
+        data: DataFrame with the predictions
+        fmt: output format ("csv", "parquet" or "arrow")
+
+    Returns:
+        StreamingResponse
+    """
+
+    # Return the predictions as a file for download
+        # https://www.slingacademy.com/article/how-to-return-a-csv-file-in-fastapi/
+    response = StreamingResponse(stream_chunks(data, fmt), media_type = MEDIA_TYPES[fmt])
+    extension = {"csv": "csv", "parquet": "parquet", "arrow": "arrows"}[fmt]
+    response.headers["Content-Disposition"] = "attachment; filename=prioritized_corridors." + extension
+    return response
+
 # Create an instance of the FastAPI app
 app = FastAPI()
 
+# Compress the responses of the clients that accept gzip (Accept-Encoding: gzip)
+app.add_middleware(GZipMiddleware, minimum_size = 1000)
+
+@app.on_event("startup")
+def startup_app():
+    """
+    This function loads the model and opens the backend of the queries (the pool of database connections or the DuckDB
+    database over the Parquet snapshots, see db_backend.py) when the app starts. It also builds the WindowEngine when it
+    is enabled, so that the first request does not wait for it. The app still starts if the database is not available:
+    the backend is opened again by the first request that needs it.
+    """
+
+    global model
+
+    model = load_native_model()
+    readiness["model"] = True
+
+    try:
+        init_backend()
+        readiness["database"] = True
+        if window_engine_enabled():
+            readiness["window_engine"] = False
+            load_window_engine()
+            readiness["window_engine"] = True
+    except backend_errors() as error:
+        readiness["error"] = str(error)
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    """
+    This function cancels the pending predictions, releases the pool of threads and closes the backend of the queries
+    when the app stops.
+    """
+    executor.shutdown(wait = False, cancel_futures = True)
+    close_backend()
+
+@app.get("/ready/")
+def ready():
+    """
+    GET method to check whether the app is ready to serve predictions, e.g., for the readiness probe of a deployment.
+
+    Returns:
+        dict with the readiness of the model, the database and the WindowEngine (status code 503 if any is not ready)
+    """
+
+    # If the database was not available when the app started, we try again
+    if not readiness["database"]:
+        try:
+            init_backend()
+            readiness["database"] = True
+            readiness.pop("error", None)
+            if window_engine_enabled():
+                readiness["window_engine"] = False
+                load_window_engine()
+                readiness["window_engine"] = True
+        except backend_errors() as error:
+            readiness["error"] = str(error)
+
+    content = dict(readiness)
+    ok = all(value for key, value in readiness.items() if key != "error")
+    content["status"] = "ready" if ok else "starting"
+    return JSONResponse(content = content, status_code = 200 if ok else 503)
+
 # Define the endpoint to accept input data and return a prediction
 @app.post("/predict/")
-async def predict(input_data: InputDate = Depends()):
+async def predict(input_data: InputDate = Depends(), accept: Optional[str] = Header(None)):
     """
     POST method to predict priority levels of highway corridors for implementing road safety operations
     using the clustering model K-Prototypes. Be aware the earliest date you can input is Jan 1 2018.
     
     Args:
-        input_data: InputDate with the year, month and day information to load 3-year data up to such date
+        input_data: InputDate with the year, month and day information to load 3-year data (or the given number of
+            years) up to such date
+        accept: Accept header. Clients can ask for application/vnd.apache.parquet or application/vnd.apache.arrow.stream
+            instead of .csv
         
     Returns:
-        .csv file with the highway corridors and their priority levels
+        .csv (or .parquet or Arrow IPC stream) file with the highway corridors and their priority levels
     """
 
+    if model is None:
+        raise HTTPException(status_code = 503, detail = "The model is still loading")
+
     if input_data.year == 2023 and input_data.month > 1:
         return {"Note:": "Be aware the database with accident data has info up to Jan 2023"}
     
-    # Some months only have 30 days, so we make sure their last day is 30 in case the user inputs 31
-    if input_data.month in (4, 6, 9, 11) and input_data.day == 31:
-        input_data.day = 30
-    # We do the same for Feb for non-leap years
-    if input_data.month == 2 and not isleap(input_data.year) and input_data.day > 28:
-        input_data.day = 28
-    # We do the same for Feb for leap years
-    if input_data.month == 2 and isleap(input_data.year) and input_data.day > 29:
-        input_data.day = 29
+    # Some months only have 30 days (and Feb has 28 or 29), so we normalize the date before using it as the cache key
+    date = normalize_date(input_data.year, input_data.month, input_data.day)
 
-    # We load the 3-year data for the prediction
-    data = load_data(**dict(input_data))
+    # We run the prediction off the event loop so that other requests are not blocked while it runs
+    data = await run_prediction(prioritized_corridors_cached, *date, input_data.years)
 
-    # We take the features we use for the prediction
-    data_cluster = data[["HORARIO", "accidentes", "muertes", "heridos", "vulnerables"]].copy()
+    return streaming_response(data, negotiate_format(accept))
 
-    # We scale the continuous features
-    data_cluster[["accidentes", "muertes", "heridos"]] = scaler.fit_transform(data_cluster[["accidentes", "muertes", \
-        "heridos"]])
+@app.post("/predict/batch/")
+async def predict_batch(input_data: InputDates, accept: Optional[str] = Header(None)):
+    """
+    POST method to predict priority levels of highway corridors for several dates at once. Be aware the earliest date you
+    can input is Jan 1 2018.
 
-    # We run the prediction
-    clusters = model.predict(data_cluster, categorical = [0, 4])
+    Args:
+        input_data: InputDates with the list of dates, the number of years of data up to each date and the output format
+            (csv, parquet or arrow). The format defaults to the one asked for in the Accept header
+        accept: Accept header
 
-    # We append the predictions to the data
-    data = pd.concat((data, pd.DataFrame(clusters)), axis = 1)
+    Returns:
+        .csv, .parquet or Arrow IPC stream file with the dates, the highway corridors and their priority levels
+    """
 
-    del data_cluster, clusters
+    if model is None:
+        raise HTTPException(status_code = 503, detail = "The model is still loading")
 
-    # When the labels are converted into a DataFrame, the column is called 0. We rename it
-    data.rename({0: "Prioridad"}, axis = 1, inplace = True)
-    
-    # From the analyses run when creating the model, we know what the labels in "clusters" represent.
-    # However, if the K-Prototypes model is re-estimated, "dictp" must be revised
-    dictp = {0: "3 NA", 1: "2 Complementario", 2: "1 Priorizado"}
-    data.replace({"Prioridad": dictp}, inplace = True)
-    data.sort_values(by = ["Prioridad", "vulnerables", "muertes", "muertes_vulnerables", "heridos_vulnerables"], \
-        ascending = [True, False, False, False, False], inplace = True)
+    if any(date.year == 2023 and date.month > 1 for date in input_data.dates):
+        return {"Note:": "Be aware the database with accident data has info up to Jan 2023"}
 
-    # Return the predictions as a dictionary
-    #return data.to_dict("index")
-    
-    # Return the predictions as a .csv file for download
-        # https://www.slingacademy.com/article/how-to-return-a-csv-file-in-fastapi/
-    stream = io.StringIO()
-    data.to_csv(stream, index = False)
-    response = StreamingResponse(
-        iter([stream.getvalue()]), media_type = "text/csv")
-    response.headers["Content-Disposition"] = "attachment; filename=prioritized_corridors.csv"
-    return response
+    # We normalize the dates and drop the repeated ones
+    dates = list(dict.fromkeys(normalize_date(date.year, date.month, date.day) for date in input_data.dates))
+
+    data = await run_prediction(prioritized_corridors_batch, dates, input_data.years)
+
+    return streaming_response(data, input_data.format or negotiate_format(accept))
@@ -3,8 +3,16 @@ ml_functions.py
     Supporting functions for the FastAPI app
 """
 
-import joblib
-from data_creation import data_for_clustering
+import io
+import os
+import time
+import threading
+from collections import OrderedDict
+from calendar import isleap
+import pandas as pd
+from data_creation import data_for_clustering, data_watermark
+from db_backend import check_cancelled
+from native_model import NativeKPrototypes
 
 def load_scaler():
     """
@@ -13,6 +21,8 @@ def load_scaler():
     Returns:
         Loaded MinMaxScaler
     """
+    # joblib (and the scikit-learn pickle) is not needed by the app, so we import it here
+    import joblib
     return joblib.load("../clustering/scaler.mod")
 
 def load_model():
@@ -22,19 +32,385 @@ def load_model():
     Returns:
         Loaded K-Prototypes model
     """
+    # joblib (and kmodes) is not needed by the app, so we import it here
+    import joblib
     return joblib.load("../clustering/kprototypes.mod")
 
-def load_data(year, month, day):
+def load_native_model():
     """
-    This function creates the DataFrame used for the prioritization clustering. The DataFrame includes 3-year data up
-    to the day defined by the date year-month-day. 
+    This function returns the K-Prototypes model and MinMaxScaler exported into kprototypes.npz (see
+    clustering/model_export.py), which predicts with NumPy only.
+
+    Returns:
+        NativeKPrototypes
+    """
+    return NativeKPrototypes("../clustering/kprototypes.npz")
+
+_window_engine = None
+_window_engine_lock = threading.Lock()
+
+def window_engine_enabled():
+    """
+    This function tells whether the clustering data is computed with the in-memory WindowEngine. It is enabled by setting
+    the environment variable WINDOW_ENGINE to 1.
+
+    Returns:
+        bool
+    """
+    return os.environ.get("WINDOW_ENGINE", "0") == "1"
+
+def load_window_engine():
+    """
+    This function returns the WindowEngine, building it the first time it is needed.
+
+    Returns:
+        WindowEngine
+    """
+
+    global _window_engine
+
+    with _window_engine_lock:
+        if _window_engine is None:
+            # The engine is only needed when it is enabled, so we import it here
+            from window_engine import WindowEngine
+            _window_engine = WindowEngine()
+        return _window_engine
+
+def reset_window_engine():
+    """
+    This function drops the WindowEngine so that it is built again with the latest data the next time it is needed.
+    """
+
+    global _window_engine
+
+    with _window_engine_lock:
+        _window_engine = None
+
+def load_data(year, month, day, years = 3, cancel = None):
+    """
+    This function creates the DataFrame used for the prioritization clustering. The DataFrame includes the given number of
+    years of data (3 by default) up to the day defined by the date year-month-day. 
 
     Args:
         year: date argument
         month: date argument
         day: date argument
+        years: number of years of data up to the date
+        cancel: threading.Event that is set to cancel the queries (see data_creation.read_queries())
     
     Returns:
         DataFrame
     """
-    return data_for_clustering(year, month, day)
+
+    check_cancelled(cancel)
+    if window_engine_enabled():
+        return load_window_engine().data_for_clustering(year, month, day, years = years)
+    return data_for_clustering(year, month, day, years = years, cancel = cancel)
+
+def load_data_batch(dates, years = 3, cancel = None):
+    """
+    This function creates the DataFrames used for the prioritization clustering for several dates at once. When the counts
+    are summed from the table corredores_diarios (CLUSTERING_BACKEND set to "aggregate"), the daily counts are read from
+    the database once for the union of the windows and each window is derived from them. When the WindowEngine is
+    enabled, they are taken from it. Otherwise, the data of each date is computed with the backend given by
+    CLUSTERING_BACKEND (see data_creation.data_for_clustering()), so it matches the data of the Predict endpoint.
+
+    Args:
+        dates: list of dates (year, month, day)
+        years: number of years of data up to each date
+        cancel: threading.Event that is set to cancel the queries (see data_creation.read_queries())
+
+    Returns:
+        list of DataFrames, one per date
+    """
+
+    check_cancelled(cancel)
+    if window_engine_enabled():
+        engine = load_window_engine()
+    elif os.environ.get("CLUSTERING_BACKEND", "pandas") == "aggregate":
+        # The engine is only used by this request, so it does not read the load watermark
+        from window_engine import WindowEngine
+        fechas = [pd.Timestamp(year = year, month = month, day = day) for year, month, day in dates]
+        engine = WindowEngine(desde = str(min(fechas) - pd.DateOffset(years = years))[0:10], \
+            hasta = str(max(fechas))[0:10], watermark = False)
+    else:
+        return [data_for_clustering(year, month, day, years = years, cancel = cancel) for year, month, day in dates]
+
+    datas = []
+    for year, month, day in dates:
+        check_cancelled(cancel)
+        datas.append(engine.data_for_clustering(year, month, day, years = years))
+
+    return datas
+
+def normalize_date(year, month, day):
+    """
+    This function makes sure the day is a valid day of the month, e.g., it turns Apr 31 into Apr 30 and Feb 29 into Feb 28
+    for non-leap years.
+
+    Args:
+        year: date argument
+        month: date argument
+        day: date argument
+
+    Returns:
+        tuple with the normalized year, month and day
+    """
+
+    # Some months only have 30 days, so we make sure their last day is 30 in case the user inputs 31
+    if month in (4, 6, 9, 11) and day == 31:
+        day = 30
+    # We do the same for Feb for non-leap years
+    if month == 2 and not isleap(year) and day > 28:
+        day = 28
+    # We do the same for Feb for leap years
+    if month == 2 and isleap(year) and day > 29:
+        day = 29
+
+    return year, month, day
+
+class PredictionCache:
+    """
+    Class that keeps the latest prediction results in memory. Results are keyed by the normalized date and number of years, the least recently
+    used result is dropped once the cache is full and results expire after a given number of seconds. All results are
+    dropped when the load watermark of the database changes, i.e., when the data pipeline loads new data.
+    """
+
+    def __init__(self, maxsize = 32, ttl = 3600, watermark_interval = 60, watermark_func = data_watermark, \
+        on_watermark_change = None):
+        """
+        Args:
+            maxsize: maximum number of results kept in memory
+            ttl: number of seconds a result is kept in memory
+            watermark_interval: minimum number of seconds between two checks of the database watermark
+            watermark_func: function that returns the database watermark
+            on_watermark_change: function called (with no arguments) when the watermark changes, e.g., to drop other data
+                kept in memory
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.watermark_interval = watermark_interval
+        self.watermark_func = watermark_func
+        self.on_watermark_change = on_watermark_change
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self._watermark = None
+        self._watermark_checked = None
+
+    def _check_watermark(self):
+        """
+        This method queries the database watermark (at most once every watermark_interval seconds) and drops every result
+        if the watermark changed. If the query fails, its exception is raised and the watermark is queried again by the
+        next call.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            if self._watermark_checked is not None and now - self._watermark_checked < self.watermark_interval:
+                return
+
+        # We query the database outside the lock so that other requests can still read the cache
+        watermark = self.watermark_func()
+
+        with self._lock:
+            # The check only counts once the watermark was read
+            self._watermark_checked = now
+            changed = watermark != self._watermark
+            first_check = self._watermark is None
+            if changed:
+                self._results.clear()
+                self._watermark = watermark
+
+        if changed and not first_check and self.on_watermark_change is not None:
+            self.on_watermark_change()
+
+    def get(self, key):
+        """
+        This method returns the result stored for a given key.
+
+        Args:
+            key: normalized date and number of years (year, month, day, years)
+
+        Returns:
+            The stored result or None if there is no valid result for the key
+        """
+
+        self._check_watermark()
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is None:
+                return None
+            result, stored_at, watermark = entry
+            if watermark != self._watermark or time.monotonic() - stored_at > self.ttl:
+                del self._results[key]
+                return None
+            self._results.move_to_end(key)
+            return result
+
+    def watermark(self):
+        """
+        This method returns the database watermark of the stored results, as of the latest check (see get()).
+
+        Returns:
+            The watermark (None before the first check)
+        """
+        with self._lock:
+            return self._watermark
+
+    def put(self, key, result, watermark = None):
+        """
+        This method stores the result for a given key, dropping the least recently used results if the cache is full. The
+        result is not stored if the watermark changed while it was computed, since it may come from the previous data.
+
+        Args:
+            key: normalized date and number of years (year, month, day, years)
+            result: result to store
+            watermark: watermark taken (see watermark()) before the result was computed. None stores the result with the
+                current watermark
+        """
+
+        with self._lock:
+            if watermark is not None and watermark != self._watermark:
+                return
+            self._results[key] = (result, time.monotonic(), self._watermark)
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last = False)
+
+    def clear(self):
+        """
+        This method drops every stored result.
+        """
+        with self._lock:
+            self._results.clear()
+
+def load_prediction_cache():
+    """
+    This function returns the cache for the prediction results. The cache limits can be set with the environment variables
+    PREDICT_CACHE_SIZE (number of results), PREDICT_CACHE_TTL (seconds) and PREDICT_CACHE_WATERMARK_INTERVAL (seconds).
+
+    Returns:
+        PredictionCache
+    """
+    return PredictionCache(
+        maxsize = int(os.environ.get("PREDICT_CACHE_SIZE", 32)),
+        ttl = float(os.environ.get("PREDICT_CACHE_TTL", 3600)),
+        watermark_interval = float(os.environ.get("PREDICT_CACHE_WATERMARK_INTERVAL", 60)),
+        # The WindowEngine holds the data of the previous load, so we drop it as well
+        on_watermark_change = reset_window_engine,
+    )
+
+# Output formats of the predictions and their media types
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+def negotiate_format(accept):
+    """
+    This function picks the output format from the Accept header of a request. Clients that do not ask for Parquet or Arrow
+    get .csv, so browsers and the Swagger UI keep working as before.
+
+    Args:
+        accept: value of the Accept header (or None)
+
+    Returns:
+        str with the format ("csv", "parquet" or "arrow")
+    """
+
+    accept = (accept or "").lower()
+    if "parquet" in accept:
+        return "parquet"
+    if "arrow" in accept:
+        return "arrow"
+    return "csv"
+
+def csv_chunks(data, chunk_rows = 5000):
+    """
+    This function yields the .csv content of a DataFrame in batches of rows, so the content is never held in memory as a
+    whole.
+
+    Args:
+        data: DataFrame
+        chunk_rows: number of rows per batch
+
+    Returns:
+        generator of str
+    """
+
+    yield data.iloc[0:0].to_csv(index = False)
+    for inicio in range(0, len(data), chunk_rows):
+        yield data.iloc[inicio:inicio + chunk_rows].to_csv(index = False, header = False)
+
+def arrow_chunks(data, chunk_rows = 5000):
+    """
+    This function yields the content of a DataFrame in the Arrow IPC streaming format, one record batch at a time.
+
+    Args:
+        data: DataFrame
+        chunk_rows: number of rows per record batch
+
+    Returns:
+        generator of bytes
+    """
+
+    # pyarrow is only needed for this format, so we import it here
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(data, preserve_index = False)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        for batch in table.to_batches(max_chunksize = chunk_rows):
+            writer.write_batch(batch)
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+def parquet_chunks(data, chunk_rows = 5000):
+    """
+    This function yields the .parquet content of a DataFrame, one row group at a time.
+
+    Args:
+        data: DataFrame
+        chunk_rows: number of rows per row group
+
+    Returns:
+        generator of bytes
+    """
+
+    # pyarrow is only needed for this format, so we import it here
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(data, preserve_index = False)
+    sink = io.BytesIO()
+    with pq.ParquetWriter(sink, table.schema) as writer:
+        for batch in table.to_batches(max_chunksize = chunk_rows):
+            writer.write_batch(batch)
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+def stream_chunks(data, fmt, chunk_rows = None):
+    """
+    This function yields the content of a DataFrame in the given format in batches of rows. The number of rows per batch
+    defaults to the environment variable PREDICT_CHUNK_ROWS (default 5000).
+
+    Args:
+        data: DataFrame
+        fmt: output format ("csv", "parquet" or "arrow")
+        chunk_rows: number of rows per batch
+
+    Returns:
+        generator of str or bytes
+    """
+
+    chunk_rows = chunk_rows or int(os.environ.get("PREDICT_CHUNK_ROWS", 5000))
+    if fmt == "parquet":
+        return parquet_chunks(data, chunk_rows)
+    if fmt == "arrow":
+        return arrow_chunks(data, chunk_rows)
+    return csv_chunks(data, chunk_rows)
@@ -0,0 +1,69 @@
+"""
+native_model.py
+    K-Prototypes predictor that works on the compact array artifact written by clustering/model_export.py
+"""
+
+import numpy as np
+import pandas as pd
+
+class NativeKPrototypes:
+    """
+    Class that predicts the clusters of a fitted K-Prototypes model with NumPy only. It gives the same labels as the
+    predict() method of kmodes: each row goes to the cluster with the lowest cost, the cost being the squared Euclidean
+    distance to the numerical centroid plus gamma times the number of categorical features that differ from the mode
+    (categories unseen when fitting the model never match). The continuous features are scaled with the stored MinMax
+    scaler, i.e., the scaler is not fitted again on the data to predict.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: path of the .npz file written by export_model()
+        """
+
+        with np.load(path, allow_pickle = False) as artifact:
+            self.centroides = artifact["centroides"]
+            self.modas = artifact["modas"]
+            self.gamma = float(artifact["gamma"])
+            self.categoricas = artifact["categoricas"].tolist()
+            self.minimo = artifact["minimo"]
+            self.escala = artifact["escala"]
+            self.categorias = [pd.Index(artifact["categorias_" + str(i)]) for i in range(len(self.categoricas))]
+
+    def transform(self, numericas):
+        """
+        This method scales the continuous features the way the stored MinMax scaler does.
+
+        Args:
+            numericas: matrix with the continuous features
+
+        Returns:
+            matrix with the scaled features
+        """
+        numericas = np.array(numericas, dtype = np.float64)
+        numericas *= self.escala
+        numericas += self.minimo
+        return numericas
+
+    def predict(self, data):
+        """
+        This method predicts the cluster of each row of the (unscaled) features.
+
+        Args:
+            data: DataFrame with the features in the order used to fit the model
+
+        Returns:
+            array with the cluster of each row
+        """
+
+        numericas = [i for i in range(data.shape[1]) if i not in self.categoricas]
+        xnum = self.transform(data.iloc[:, numericas].to_numpy())
+        # Categories are encoded as their position in the table of categories of the model (-1 if unseen)
+        xcat = np.column_stack([categorias.get_indexer(np.asarray(data.iloc[:, i])) for categorias, i in \
+            zip(self.categorias, self.categoricas)])
+
+        # Cost of every row for every cluster, computed in one batched pass
+        costo = ((xnum[:, np.newaxis, :] - self.centroides[np.newaxis, :, :]) ** 2).sum(axis = 2) + \
+            self.gamma * (xcat[:, np.newaxis, :] != self.modas[np.newaxis, :, :]).sum(axis = 2)
+
+        return costo.argmin(axis = 1)
@@ -0,0 +1,145 @@
+"""
+window_engine.py
+    In-memory engine that computes the clustering data for any date window from prefix sums of the daily counts
+"""
+
+import numpy as np
+import pandas as pd
+from data_creation import COUNT_COLUMNS, COUNT_DTYPE, HORARIO_DTYPE, VULNERABLES_DTYPE, corridor_dtype, corridor_codes, \
+    horario_codes, read_query, data_watermark, vulnerable_array
+
+class WindowEngine:
+    """
+    Class that keeps the daily counts per corridor (MVINOMBRE) per hour block (HORARIO) in memory as prefix sums, so the
+    counts of any date window are the difference of two prefix sums instead of a new aggregation. It returns the same
+    DataFrame as data_for_clustering() for any date and number of years.
+
+    The daily counts are read once from the table corredores_diarios. Most corridors only have accidents on a few days, so
+    the prefix sums are kept per (corridor, hour block, day with accidents) rather than for every calendar day: the rows are
+    sorted by corridor, hour block and day, and the counts of a window are found with a binary search on both of its ends.
+    """
+
+    def __init__(self, desde = None, hasta = None, watermark = True):
+        """
+        Args:
+            desde: start date string (yyyy-mm-dd). Only the counts after this date are read (all of them by default)
+            hasta: end date string (yyyy-mm-dd). Only the counts up to this date are read (all of them by default)
+            watermark: whether the load watermark of the data is read (see data_watermark()). Engines that are built for a
+                single request and dropped afterwards do not need it
+        """
+        self.watermark = data_watermark() if watermark else None
+
+        ##### We bring the daily counts per corridor (CIV) per hour. Day of week is dropped later on, so we do not need it
+        query = """
+        SELECT CIV, FECHA, HORA_OCURRENCIA_ACC,
+            SUM(ACCIDENTES)::BIGINT AS accidentes,
+            SUM(MUERTES)::BIGINT AS muertes,
+            SUM(HERIDOS)::BIGINT AS heridos,
+            SUM(MUERTES_VULNERABLES)::BIGINT AS muertes_vulnerables,
+            SUM(HERIDOS_VULNERABLES)::BIGINT AS heridos_vulnerables
+        FROM corredores_diarios
+        WHERE FECHA > '""" + (desde or "-infinity") + """' AND
+            FECHA <= '""" + (hasta or "infinity") + """'
+        GROUP BY CIV, FECHA, HORA_OCURRENCIA_ACC
+        """
+        diarios = read_query(query)
+        diarios.rename(columns = {"civ": "CIV", "fecha": "FECHA", "hora_ocurrencia_acc": "HORA_OCURRENCIA_ACC"}, \
+            inplace = True)
+
+        ##### We append the corridor names and the hour blocks (as codes in their category dictionaries), removing corridors
+            ##### with no name and hours with no block
+        con_nombre, corredor = corridor_codes(diarios["CIV"])
+        horario = horario_codes(diarios["HORA_OCURRENCIA_ACC"].to_numpy()[con_nombre])
+        valores = diarios[COUNT_COLUMNS].to_numpy(np.int64)[con_nombre]
+        fechas = pd.to_datetime(diarios["FECHA"])[con_nombre]
+
+        ##### Corridors with no deaths in the dates read are never kept (see data_for_clustering()), so we leave them out
+        self.bloques = len(HORARIO_DTYPE.categories)
+        self.corredores = len(corridor_dtype().categories)
+        muertes = np.bincount(corredor, weights = valores[:, 1], minlength = self.corredores)
+        conservar = (muertes[corredor] > 0) & (horario >= 0)
+        clave = corredor[conservar] * self.bloques + horario[conservar]
+        valores = valores[conservar]
+        fechas = fechas[conservar]
+
+        ##### We number the days from the first date with data
+        self.inicio = fechas.min() if len(fechas) > 0 else pd.Timestamp("1970-01-01")
+        dia = (fechas - self.inicio).dt.days.to_numpy(np.int64)
+        self.dias = int(dia.max()) + 1 if len(dia) > 0 else 1
+
+        ##### We sort the rows by corridor, hour block and day and compute the prefix sums of the counts
+        codigo = clave * self.dias + dia
+        orden = np.argsort(codigo, kind = "stable")
+        self.codigo = codigo[orden]
+        self.acumulado = np.vstack([np.zeros((1, len(COUNT_COLUMNS)), dtype = np.int64), \
+            np.cumsum(valores[orden], axis = 0)])
+        self.claves = np.unique(clave)
+
+    def _dia(self, fecha):
+        """
+        This method returns the number of the day a date falls on, clipped to the days with data.
+
+        Args:
+            fecha: date string (yyyy-mm-dd)
+
+        Returns:
+            int
+        """
+        return int(np.clip((pd.to_datetime(fecha) - self.inicio).days, -1, self.dias - 1))
+
+    def window_counts(self, fecha, fecha2):
+        """
+        This method returns the counts per corridor per hour block of the accidents that happened after fecha2 and up to
+        fecha (both are date strings yyyy-mm-dd).
+
+        Args:
+            fecha: end date string (yyyy-mm-dd)
+            fecha2: start date string (yyyy-mm-dd)
+
+        Returns:
+            tuple with the corridor and hour block keys and the matrix of counts (one column per count in COUNT_COLUMNS)
+        """
+
+        base = self.claves * self.dias
+        hasta = np.searchsorted(self.codigo, base + self._dia(fecha), side = "right")
+        desde = np.searchsorted(self.codigo, base + self._dia(fecha2), side = "right")
+
+        return self.claves, self.acumulado[hasta] - self.acumulado[desde]
+
+    def data_for_clustering(self, year, month, day, years = 3):
+        """
+        This method returns the same DataFrame as data_for_clustering() computed from the prefix sums.
+
+        Args:
+            year: date argument
+            month: date argument
+            day: date argument
+            years: number of years of data up to the date (default 3)
+
+        Returns:
+            DataFrame
+        """
+
+        fecha = pd.Timestamp(year = int(year), month = int(month), day = int(day))
+        fecha2 = fecha - pd.DateOffset(years = years)
+        claves, cuentas = self.window_counts(str(fecha)[0:10], str(fecha2)[0:10])
+
+        ##### We keep the corridors and hour blocks with accidents in the window
+        con_accidentes = cuentas[:, 0] > 0
+        claves = claves[con_accidentes]
+        cuentas = cuentas[con_accidentes]
+
+        ##### We keep corridors with deaths in the window
+        corredor = claves // self.bloques
+        muertes = np.bincount(corredor, weights = cuentas[:, 1], minlength = self.corredores)
+        con_muertes = muertes[corredor] > 0
+        claves = claves[con_muertes]
+        cuentas = cuentas[con_muertes]
+
+        cluster_df = pd.DataFrame(cuentas.astype(COUNT_DTYPE), columns = COUNT_COLUMNS)
+        cluster_df.insert(0, "MVINOMBRE", pd.Categorical.from_codes(claves // self.bloques, dtype = corridor_dtype()))
+        cluster_df.insert(1, "HORARIO", pd.Categorical.from_codes(claves % self.bloques, dtype = HORARIO_DTYPE))
+        cluster_df["vulnerables"] = pd.Categorical(vulnerable_array(cluster_df["muertes_vulnerables"], \
+            cluster_df["heridos_vulnerables"]), dtype = VULNERABLES_DTYPE)
+
+        return cluster_df
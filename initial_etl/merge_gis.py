@@ -0,0 +1,335 @@
+"""
+merge_gis.py
+    This script merges the JSON files pulled from the ArcGIS service (1_pull_data_from_gis.ipynb) into Parquet files, one
+    folder per layer and, for the layers with dates (accidents, injured people and killed people), one subfolder per year.
+    The JSON files are parsed incrementally, a batch of rows at a time, so the memory used does not depend on the size of
+    the files, and the files are processed at the same time by a pool of processes. The columns are typed with the field
+    types of the service and the files are compressed.
+
+    3_data_preparation_db.ipynb reads the merged layers with read_layer(), only the years and accidents it needs, and writes
+    the prepared layers with write_layer() into PREPARED_PATH, with the same layout, which 4_database_creation.ipynb reads.
+    To merge every layer, navigate to the folder initial_etl and run:
+
+        python merge_gis.py
+"""
+
+import os
+import sys
+import glob
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+
+SHAPEFILES_PATH = "shapefiles"
+PARQUET_PATH = os.path.join(SHAPEFILES_PATH, "parquet")
+PREPARED_PATH = os.path.join(SHAPEFILES_PATH, "prepared")
+
+# Folder of the JSON files of each layer (see 1_pull_data_from_gis.ipynb) and whether its files are split by year
+LAYERS = {
+    "accidents": ("accidents", True),
+    "injured_people": ("injured", True),
+    "killed_people": ("killed", True),
+    "vehicles": ("vehicles", False),
+    "causes": ("causes", False),
+    "actors": ("actors", False),
+}
+
+# Arrow type of each field type of the service. Dates are kept as milliseconds since 1970 (UTC), as in the service
+FIELD_TYPES = {
+    "esriFieldTypeOID": pa.int64(),
+    "esriFieldTypeInteger": pa.int64(),
+    "esriFieldTypeSmallInteger": pa.int32(),
+    "esriFieldTypeDouble": pa.float64(),
+    "esriFieldTypeSingle": pa.float32(),
+    "esriFieldTypeString": pa.string(),
+    "esriFieldTypeDate": pa.int64(),
+}
+
+BATCH_ROWS = int(os.environ.get("MERGE_BATCH_ROWS", 50000))
+
+def iter_features(path, cabecera, chunk_chars = 1 << 20):
+    """
+    This function reads the features of a JSON response of the service one at a time. The file is read in chunks and the
+    features already parsed are dropped from memory every time a chunk is read. The other members of the response (e.g.,
+    fields) are stored in cabecera as they are read.
+
+    Args:
+        path: path of the JSON file
+        cabecera: dictionary where the members of the response other than features are stored
+        chunk_chars: number of characters read at a time
+
+    Returns:
+        generator of dictionaries (one per feature)
+    """
+
+    decoder = json.JSONDecoder()
+    espacios = " \t\n\r"
+
+    with open(path, "r", encoding = "utf-8") as f:
+        # Positions are counted from the start of the file. The buffer holds the text from the position base on, and the
+        # text before the position marca was already parsed
+        estado = {"buffer": "", "base": 0, "marca": 0, "fin": False}
+
+        def leer():
+            texto = f.read(chunk_chars)
+            estado["fin"] = texto == ""
+            # We drop the text already parsed only when more text is read, so the buffer is not copied for every feature
+            estado["buffer"] = estado["buffer"][estado["marca"] - estado["base"]:] + texto
+            estado["base"] = estado["marca"]
+            return not estado["fin"]
+
+        def caracter(pos):
+            return estado["buffer"][pos - estado["base"]:pos - estado["base"] + 1]
+
+        def saltar(pos):
+            # We skip the whitespace and return the position of the next character, reading more text if needed
+            while True:
+                buffer, base = estado["buffer"], estado["base"]
+                while pos - base < len(buffer) and buffer[pos - base] in espacios:
+                    pos += 1
+                if pos - base < len(buffer) or not leer():
+                    return pos
+
+        def valor(pos):
+            # A value is only complete if something follows it (e.g., a number cut at the end of the buffer is not)
+            while True:
+                try:
+                    objeto, fin = decoder.raw_decode(estado["buffer"], pos - estado["base"])
+                    if fin < len(estado["buffer"]) or estado["fin"]:
+                        return objeto, fin + estado["base"]
+                except json.JSONDecodeError:
+                    if estado["fin"]:
+                        raise
+                leer()
+
+        def esperar(pos, simbolo):
+            pos = saltar(pos)
+            if caracter(pos) != simbolo:
+                raise ValueError("Expected " + simbolo + " at character " + str(pos) + " of " + path)
+            return pos + 1
+
+        pos = esperar(0, "{")
+        while True:
+            pos = saltar(pos)
+            if caracter(pos) == "}":
+                return
+            clave, pos = valor(pos)
+            pos = esperar(pos, ":")
+            if clave != "features":
+                cabecera[clave], pos = valor(saltar(pos))
+            else:
+                pos = esperar(pos, "[")
+                while True:
+                    pos = saltar(pos)
+                    if caracter(pos) == "]":
+                        pos += 1
+                        break
+                    feature, pos = valor(pos)
+                    yield feature
+                    pos = saltar(pos)
+                    if caracter(pos) == ",":
+                        pos += 1
+                    estado["marca"] = pos
+            pos = saltar(pos)
+            if caracter(pos) == ",":
+                pos += 1
+
+def features_table(features, cabecera):
+    """
+    This function turns a batch of features into an Arrow table with one column per attribute (typed with the fields of
+    the response) and the columns geometry.x and geometry.y when the features have a geometry.
+
+    Args:
+        features: list of features
+        cabecera: members of the response other than features (see iter_features())
+
+    Returns:
+        Arrow table
+    """
+
+    tipos = {field["name"]: FIELD_TYPES.get(field.get("type")) for field in cabecera.get("fields", [])}
+    columnas = list(tipos)
+    # Attributes missing in the fields of the response are appended in the order they appear
+    for feature in features:
+        for column in feature.get("attributes", {}):
+            if column not in tipos:
+                tipos[column] = None
+                columnas.append(column)
+
+    arrays = {column: pa.array([feature.get("attributes", {}).get(column) for feature in features], \
+        type = tipos[column]) for column in columnas}
+    if any("geometry" in feature for feature in features):
+        for eje in ("x", "y"):
+            arrays["geometry." + eje] = pa.array([(feature.get("geometry") or {}).get(eje) for feature in features], \
+                type = pa.float64())
+
+    return pa.table(arrays)
+
+def feature_years(table):
+    """
+    This function returns the year of the accident (Bogotá time, i.e., UTC - 5) of each row of a batch, or -1 when the date
+    is missing.
+
+    Args:
+        table: Arrow table with the column FECHA_HORA_ACC (milliseconds since 1970, UTC)
+
+    Returns:
+        array of ints
+    """
+
+    fechas = table.column("FECHA_HORA_ACC").to_numpy(zero_copy_only = False)
+    fechas = np.asarray(fechas, dtype = np.float64)
+    years = np.full(len(fechas), -1, dtype = np.int64)
+    con_fecha = ~np.isnan(fechas)
+    years[con_fecha] = (fechas[con_fecha].astype(np.int64) - 5 * 3600 * 1000).astype("datetime64[ms]").astype( \
+        "datetime64[Y]").astype(np.int64) + 1970
+
+    return years
+
+def merge_file(path, layer, output = None, batch_rows = None):
+    """
+    This function writes the features of a JSON file into Parquet files of the layer (one per year for the layers with
+    dates), named after the JSON file, so merging a file again replaces its Parquet files.
+
+    Args:
+        path: path of the JSON file
+        layer: name of the layer (see LAYERS)
+        output: folder of the Parquet files (PARQUET_PATH by default)
+        batch_rows: rows parsed and written at a time (the environment variable MERGE_BATCH_ROWS by default)
+
+    Returns:
+        number of rows
+    """
+
+    output = os.path.join(output or PARQUET_PATH, layer)
+    batch_rows = batch_rows or BATCH_ROWS
+    por_ano = LAYERS[layer][1]
+    nombre = os.path.splitext(os.path.basename(path))[0] + ".parquet"
+
+    cabecera = {}
+    escritores = {}
+    filas = 0
+
+    def escribir(features):
+        table = features_table(features, cabecera)
+        partes = {None: table}
+        if por_ano:
+            years = feature_years(table)
+            partes = {year: table.filter(pa.array(years == year)) for year in np.unique(years)}
+        for year, parte in partes.items():
+            if year not in escritores:
+                carpeta = output if year is None else os.path.join(output, "ANO=" + str(year))
+                os.makedirs(carpeta, exist_ok = True)
+                escritores[year] = pq.ParquetWriter(os.path.join(carpeta, nombre), parte.schema, compression = "zstd")
+            escritores[year].write_table(parte.cast(escritores[year].schema))
+
+    try:
+        batch = []
+        for feature in iter_features(path, cabecera):
+            batch.append(feature)
+            if len(batch) == batch_rows:
+                escribir(batch)
+                filas += len(batch)
+                batch = []
+        if batch or not escritores:
+            escribir(batch)
+            filas += len(batch)
+    finally:
+        for escritor in escritores.values():
+            escritor.close()
+
+    return filas
+
+def merge_layer(layer, source = None, output = None, workers = None):
+    """
+    This function merges the JSON files of a layer into Parquet files (see merge_file()), several files at the same time.
+
+    Args:
+        layer: name of the layer (see LAYERS)
+        source: folder with a subfolder of JSON files per layer (SHAPEFILES_PATH by default)
+        output: folder of the Parquet files (PARQUET_PATH by default)
+        workers: number of processes (the environment variable MERGE_WORKERS by default, or the number of CPUs)
+
+    Returns:
+        number of rows
+    """
+
+    files = sorted(glob.glob(os.path.join(source or SHAPEFILES_PATH, LAYERS[layer][0], "*.json")))
+    workers = workers or int(os.environ.get("MERGE_WORKERS", os.cpu_count() or 1))
+
+    with ProcessPoolExecutor(max_workers = max(1, min(workers, len(files)))) as executor:
+        filas = sum(executor.map(merge_file, files, [layer] * len(files), [output] * len(files)))
+    print(layer + ": " + str(len(files)) + " files, " + str(filas) + " rows")
+
+    return filas
+
+def read_layer(layer, output = None, columns = None, years = None, formularios = None):
+    """
+    This function reads the Parquet files of a layer into a DataFrame sorted by OBJECTID. Only the subfolders of the given
+    years and the rows of the given accidents are read.
+
+    Args:
+        layer: name of the layer (see LAYERS)
+        output: folder of the Parquet files (PARQUET_PATH by default)
+        columns: columns to read (all of them by default)
+        years: years to read, for the layers split by year (all of them by default)
+        formularios: FORMULARIO values of the accidents to read (all of them by default)
+
+    Returns:
+        DataFrame
+    """
+
+    carpeta = os.path.join(output or PARQUET_PATH, layer)
+    # The year of each subfolder is read as the column ANO, which is only used to filter the files
+    partitioning = ds.partitioning(pa.schema([("ANO", pa.int64())]), flavor = "hive")
+    dataset = ds.dataset(carpeta, format = "parquet", partitioning = partitioning)
+    # Files of JSON responses with different fields are read with all the columns
+    schema = pa.unify_schemas([fragment.physical_schema for fragment in dataset.get_fragments()])
+    dataset = ds.dataset(carpeta, format = "parquet", partitioning = partitioning, schema = schema.append( \
+        pa.field("ANO", pa.int64())))
+
+    filtro = None
+    if years is not None:
+        filtro = ds.field("ANO").isin([int(year) for year in years])
+    if formularios is not None:
+        por_formulario = ds.field("FORMULARIO").isin(pa.array(list(formularios), type = pa.string()))
+        filtro = por_formulario if filtro is None else filtro & por_formulario
+    layer_df = dataset.to_table(columns = columns or schema.names, filter = filtro).to_pandas()
+    if "OBJECTID" in layer_df.columns:
+        layer_df.sort_values("OBJECTID", inplace = True, ignore_index = True)
+
+    return layer_df
+
+def write_layer(layer_df, layer, output = None, years = None):
+    """
+    This function writes a DataFrame into Parquet files with the layout of the merged layers (see merge_file()), so
+    read_layer() reads them, replacing the files written before.
+
+    Args:
+        layer_df: DataFrame
+        layer: name of the layer (see LAYERS)
+        output: folder of the Parquet files (PREPARED_PATH by default)
+        years: array with the year of each row, to write one subfolder per year (None to write a single file). Missing years
+            are written as -1, as in merge_file()
+    """
+
+    carpeta = os.path.join(output or PREPARED_PATH, layer)
+    shutil.rmtree(carpeta, ignore_errors = True)
+
+    partes = {None: layer_df}
+    if years is not None:
+        years = np.asarray(years, dtype = np.float64)
+        years = np.where(np.isnan(years), -1, years).astype(np.int64)
+        partes = {year: layer_df[years == year] for year in np.unique(years)}
+    for year, parte in partes.items():
+        destino = carpeta if year is None else os.path.join(carpeta, "ANO=" + str(year))
+        os.makedirs(destino, exist_ok = True)
+        parte.to_parquet(os.path.join(destino, layer + ".parquet"), index = False, compression = "zstd")
+
+if __name__ == "__main__":
+    for layer in (sys.argv[1:] or LAYERS):
+        merge_layer(layer)
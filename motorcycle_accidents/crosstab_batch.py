@@ -0,0 +1,221 @@
+"""
+crosstab_batch.py
+    This script generates the crosstab heatmaps of crosstab_heatmaps.py for every month-end of a range of months, each one
+    with the data of the years up to the month-end (rolling windows). The counts per month are brought from the database
+    once and the counts of each window are their sum, and the heatmaps are rendered at the same time by a pool of
+    processes. Heatmaps whose counts did not change since they were rendered are not rendered again.
+
+    To generate the heatmaps of every month-end from Jan 2018 to Dec 2023, navigate to the folder motorcycle_accidents
+    and run:
+
+        python crosstab_batch.py 2018-01 2023-12
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
+# The database modules shared by every folder are in the folder common at the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from db_backend import init_backend
+from date_creation import create_dates
+from crosstab_heatmaps import crosstab_query, normalize_crosstab, plot_crosstab
+
+# Folder of the heatmaps and name of the file that records the counts each heatmap was rendered with
+OUTPUT_PATH = "heatmaps"
+MANIFEST = "manifest.json"
+
+def month_ends(desde, hasta):
+    """
+    This function returns the last day of every month between two months (both included).
+
+    Args:
+        desde: first month string (yyyy-mm)
+        hasta: last month string (yyyy-mm)
+
+    Returns:
+        list of date strings (yyyy-mm-dd)
+    """
+    return [str(mes.end_time)[0:10] for mes in pd.period_range(desde, hasta, freq = "M")]
+
+def period(fecha):
+    """
+    This function returns the period of a date used to count the vehicles per month: (year * 12 + month - 1) * 2, plus 1
+    on Feb 29. Feb 29 has a period of its own because the windows of create_dates() that end on Feb 28 start on Feb 28 of
+    a leap year, so every window of a month-end is a range of whole periods.
+
+    Args:
+        fecha: date string (yyyy-mm-dd)
+
+    Returns:
+        int
+    """
+
+    fecha = pd.Timestamp(fecha)
+
+    return (fecha.year * 12 + fecha.month - 1) * 2 + int(fecha.month == 2 and fecha.day == 29)
+
+def monthly_counts(fecha, fecha2):
+    """
+    This function returns the number of vehicles involved in accidents with motorcycles (see crosstab_query()) per period
+    (see period()) between the dates fecha2 (excluded) and fecha (included), as an array with one crosstab per period.
+
+    Args:
+        fecha: end date string (yyyy-mm-dd)
+        fecha2: start date string (yyyy-mm-dd)
+
+    Returns:
+        tuple with the first period (the one of fecha2), the array of counts (periods x rows x columns), the rows (severity
+        and accident type) and the columns (vehicle type) of the crosstabs
+    """
+
+    counts = init_backend().read_sql(crosstab_query(fecha, fecha2, monthly = True))
+
+    filas = pd.MultiIndex.from_frame(counts[["gravedad", "clase_acc"]].drop_duplicates()).sort_values()
+    columnas = pd.Index(np.sort(counts["clase_veh"].unique()), name = "clase_veh")
+    primero = period(fecha2)
+
+    cubo = np.zeros((period(fecha) - primero + 1, len(filas), len(columnas)), dtype = np.int64)
+    np.add.at(cubo, (counts["periodo"].to_numpy() - primero, filas.get_indexer(pd.MultiIndex.from_frame( \
+        counts[["gravedad", "clase_acc"]])), columnas.get_indexer(counts["clase_veh"])), counts["vehiculos"].to_numpy())
+
+    return primero, cubo, filas, columnas
+
+def window_crosstabs(fechas, years = 3):
+    """
+    This function returns the crosstab of counts of the window of the given number of years up to each month-end (see
+    create_dates()). The counts per period are brought once (see monthly_counts()) and the counts of each window are the
+    difference of two prefix sums over the periods.
+
+    Args:
+        fechas: month-end date strings (yyyy-mm-dd), e.g., the ones returned by month_ends()
+        years: number of years of each window
+
+    Returns:
+        dict with the crosstab of counts of each month-end
+    """
+
+    ventanas = {fecha: create_dates(*fecha.split("-"), years = years) for fecha in fechas}
+
+    ##### We bring the counts per period of every window at once
+    primero, cubo, filas, columnas = monthly_counts(max(fechas), min(fecha2 for _, fecha2 in ventanas.values()))
+    acumulado = np.concatenate([np.zeros((1,) + cubo.shape[1:], dtype = np.int64), np.cumsum(cubo, axis = 0)])
+
+    crosstabs = {}
+    for fecha, (_, fecha2) in ventanas.items():
+        counts = pd.DataFrame(acumulado[period(fecha) - primero + 1] - acumulado[period(fecha2) - primero + 1], \
+            index = filas, columns = columnas)
+        # pd.crosstab() only has the rows and columns with vehicles
+        crosstabs[fecha] = counts.loc[counts.sum(axis = 1) > 0, counts.sum(axis = 0) > 0]
+
+    return crosstabs
+
+def fingerprint(counts):
+    """
+    This function returns a hash of a crosstab of counts, used to tell whether a heatmap is up to date.
+
+    Args:
+        counts: crosstab of counts
+
+    Returns:
+        hexadecimal string
+    """
+    return hashlib.sha256(counts.to_csv().encode("utf-8")).hexdigest()
+
+def render_window(counts, date_interval, paths):
+    """
+    This function renders the all-normalized and row-normalized heatmaps of a window (see crosstab_heatmaps.py).
+
+    Args:
+        counts: crosstab of counts of the window
+        date_interval: list with end and start dates (see create_dates())
+        paths: dict with the path of the png image of each normalization ("all" and "index")
+
+    Returns:
+        number of seconds spent rendering
+    """
+
+    inicio = time.perf_counter()
+    crosstabs = normalize_crosstab(counts)
+    plot_crosstab(crosstabs["all"], "Total %", date_interval, paths["all"])
+    plot_crosstab(crosstabs["index"], "Row %", date_interval, paths["index"])
+
+    return time.perf_counter() - inicio
+
+def _write_manifest(path, manifest):
+    """
+    This function writes the manifest of the heatmaps, replacing the previous one only once it is complete.
+
+    Args:
+        path: path of the manifest file
+        manifest: dictionary with the hash of the counts of each heatmap
+    """
+
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+    os.replace(path + ".tmp", path)
+
+def render_batch(desde, hasta, output = None, years = 3, workers = None, force = False):
+    """
+    This function renders the heatmaps of every month-end between two months (both included) in a pool of processes. The
+    heatmaps of a month-end are rendered again only if their png images are missing or the counts of the window changed
+    since they were rendered (e.g., the data pipeline loaded late accidents), which is recorded in the manifest file of
+    the output folder.
+
+    Args:
+        desde: first month string (yyyy-mm)
+        hasta: last month string (yyyy-mm)
+        output: folder of the heatmaps (OUTPUT_PATH by default)
+        years: number of years of each window
+        workers: number of processes. It defaults to the environment variable CROSSTAB_WORKERS (default: number of CPUs)
+        force: whether every heatmap is rendered again
+
+    Returns:
+        dict with the number of windows rendered and skipped
+    """
+
+    output = output or OUTPUT_PATH
+    workers = workers or int(os.environ.get("CROSSTAB_WORKERS", os.cpu_count() or 1))
+    os.makedirs(output, exist_ok = True)
+
+    manifest_path = os.path.join(output, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+    fechas = month_ends(desde, hasta)
+    pendientes = {}
+    for fecha, counts in window_crosstabs(fechas, years).items():
+        paths = {normalize: os.path.join(output, "crosstab_heatmap_" + nombre + "_" + fecha + ".png") for normalize, \
+            nombre in (("all", "all"), ("index", "rows"))}
+        huella = fingerprint(counts)
+        if not force and manifest.get(fecha) == huella and all(os.path.exists(path) for path in paths.values()):
+            continue
+        pendientes[fecha] = (counts, create_dates(*fecha.split("-"), years = years), paths, huella)
+
+    if pendientes:
+        with ProcessPoolExecutor(max_workers = max(1, min(workers, len(pendientes)))) as executor:
+            futures = {executor.submit(render_window, counts, date_interval, paths): fecha for fecha, (counts, \
+                date_interval, paths, _) in pendientes.items()}
+            for future in as_completed(futures):
+                fecha = futures[future]
+                segundos = future.result()
+                # The manifest is written after every window, so an interrupted batch does not render them again
+                manifest[fecha] = pendientes[fecha][3]
+                _write_manifest(manifest_path, manifest)
+                print(fecha + ": rendered in " + str(round(segundos, 2)) + " s")
+
+    print(str(len(pendientes)) + " windows rendered, " + str(len(fechas) - len(pendientes)) + " up to date")
+
+    return {"rendered": len(pendientes), "skipped": len(fechas) - len(pendientes)}
+
+if __name__ == "__main__":
+    desde, hasta = sys.argv[1:3]
+    render_batch(desde, hasta, sys.argv[3] if len(sys.argv) > 3 else None)
@@ -1,110 +1,156 @@
 """
 crosstab_heatmaps.py
     This script takes accidents where motorcycles were involved and generate crosstab heatmaps that show the degree to
-    which each vehicle type was responsible for different combinations Severity-Accident type   
+    which each vehicle type was responsible for different combinations Severity-Accident type
 """
 
+import os
+import sys
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-import psycopg2
+# The database modules shared by every folder are in the folder common at the root of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from db_backend import init_backend
 from date_creation import create_dates
 
-##### The methodology works by bringing 3-year data. Before running the script, the person who runs it can modify the date
-    ##### information below (year, month, day) and the script would automatically bring the 3-year data up to such date
-date_interval = create_dates(2022, 12, 31)
-
-# We connect to the database
-db_conn = psycopg2.connect(
-   database = "accidents_smb", user = "dev", password = "dev", host = "127.0.0.1", port = "5432"
-)
-
-##################################################
-###
-### For every vehicle involved in an accident with a motorcycle (except for motorcycles), we append the type and
-### severity of the accident
-###
-##################################################
-# 1. Select accidents where a motorcycle was involved
-# 2. Select the vehicles (different from the motorcycle) involved in the accident
-query = """
-WITH moto_accidents AS (
-    SELECT DISTINCT vehiculos.FORMULARIO FROM
-    vehiculos
-    JOIN siniestros ON siniestros.FORMULARIO = vehiculos.FORMULARIO
-    WHERE substring(siniestros.FECHA_ACC, 1, 10) > '""" + date_interval[1] + """' AND
-        substring(siniestros.FECHA_ACC, 1, 10) <= '""" + date_interval[0] + """' AND
-        vehiculos.CLASE LIKE 'MOTOCICLETA'
-)
-SELECT siniestros.FORMULARIO, siniestros.CLASE_ACC, siniestros.GRAVEDAD, vehiculos.CLASE AS CLASE_VEH
-FROM siniestros
-JOIN moto_accidents ON moto_accidents.FORMULARIO = siniestros.FORMULARIO
-JOIN vehiculos ON vehiculos.FORMULARIO = siniestros.FORMULARIO
-WHERE vehiculos.CLASE NOT LIKE 'MOTOCICLETA'
-"""
-accidents1 = pd.read_sql(query, con = db_conn)
-
-##################################################
-###
-### For every motorcycle involved with other motorcycles in an accident, we append the type and
-### severity of the accident
-###
-##################################################
-# 1. Select accidents where more than 1 motorcycle was involved
-# 2. Select the motorcycles involved in the accident
-query = """
-WITH moto_accidents AS (
-    SELECT vehiculos.FORMULARIO, COUNT(vehiculos.FORMULARIO) FROM
-    vehiculos
-    JOIN siniestros ON siniestros.FORMULARIO = vehiculos.FORMULARIO
-    WHERE substring(siniestros.FECHA_ACC, 1, 10) > '""" + date_interval[1] + """' AND
-        substring(siniestros.FECHA_ACC, 1, 10) <= '""" + date_interval[0] + """' AND
-        vehiculos.CLASE LIKE 'MOTOCICLETA'
-    GROUP BY vehiculos.FORMULARIO
-    HAVING COUNT(vehiculos.FORMULARIO) > 1 
-)
-SELECT siniestros.FORMULARIO, siniestros.CLASE_ACC, siniestros.GRAVEDAD, vehiculos.CLASE AS CLASE_VEH
-FROM siniestros
-JOIN moto_accidents ON moto_accidents.FORMULARIO = siniestros.FORMULARIO
-JOIN vehiculos ON vehiculos.FORMULARIO = siniestros.FORMULARIO
-WHERE vehiculos.CLASE LIKE 'MOTOCICLETA'
-"""
-accidents2 = pd.read_sql(query, con = db_conn)
-
-# We close the database connection
-db_conn.close()
-
-# We concatenate the results from both queries above
-accidents3 = pd.concat(objs = [accidents1, accidents2], axis = 0)
-
-##### We delete intermediate info
-del accidents1
-del accidents2
-
-# For accidents where a motorcycle was involved, we generate a heatmap from a crosstab that shows the interaction
-# between the vehicles involved and the accident severity and type. The crosstab is all-normalized, i.e., across all
-# combinations Severity-Accident type, the heatmap shows the degree to which each vehicle type was responsible for each
-# combination. We save the heatmap in a png image 
-accidents_crosstab = pd.crosstab(index = [accidents3["gravedad"], accidents3["clase_acc"]], \
-    columns = accidents3["clase_veh"], normalize = "all")*100
-plt.figure(figsize = (12, 5))
-sns.heatmap(accidents_crosstab, cmap = "Reds", cbar_kws = {"label": "Total %"})
-plt.title("Vehicles involved and severity and type of accidents for motorcycle accidents: " + date_interval[1] + \
-    " to " + date_interval[0], fontsize = 16, y = 1.05)
-plt.xlabel("Vehicle type", fontsize = 13)
-plt.ylabel("Severity and accident type", fontsize = 13)
-plt.savefig("crosstab_heatmap_all.png", bbox_inches = "tight")
-
-# For accidents where a motorcycle was involved, we generate a heatmap from a crosstab that shows the interaction
-# between the vehicles involved and the accident severity and type. The crosstab is row-normalized, i.e., for each
-# combination Severity-Accident type, the heatmap shows the degree to which each vehicle type was responsible for such
-# combination. We save the heatmap in a png image 
-accidents_crosstab = pd.crosstab(index = [accidents3["gravedad"], accidents3["clase_acc"]], \
-    columns = accidents3["clase_veh"], normalize = "index")*100
-plt.figure(figsize = (12, 5))
-sns.heatmap(accidents_crosstab, cmap = "Reds", cbar_kws= {"label": "Row %"})
-plt.title("Vehicles involved and severity and type of accidents for motorcycle accidents: " + date_interval[1] + \
-    " to " + date_interval[0], fontsize = 16, y = 1.05)
-plt.xlabel("Vehicle type", fontsize = 13)
-plt.ylabel("Severity and accident type", fontsize = 13)
-plt.savefig("crosstab_heatmap_rows.png", bbox_inches = "tight")
\ No newline at end of file
+def crosstab_query(fecha, fecha2, monthly = False):
+    """
+    This function returns the query that counts the vehicles involved in accidents with motorcycles between the dates
+    fecha2 (excluded) and fecha (included) per severity, accident type and vehicle type. Every vehicle different from a
+    motorcycle is counted, and motorcycles are counted only in accidents where more than one motorcycle was involved.
+
+    Args:
+        fecha: end date string (yyyy-mm-dd)
+        fecha2: start date string (yyyy-mm-dd)
+        monthly: whether the vehicles are also counted per month of the accident (column periodo, see
+            crosstab_batch.period())
+
+    Returns:
+        query string
+    """
+
+    # Feb 29 is counted apart from the rest of its month, since windows may start on Feb 28 of a leap year
+    mes = "((EXTRACT(YEAR FROM siniestros.FECHA) * 12 + EXTRACT(MONTH FROM siniestros.FECHA) - 1) * 2 + CASE WHEN " \
+        "EXTRACT(MONTH FROM siniestros.FECHA) = 2 AND EXTRACT(DAY FROM siniestros.FECHA) = 29 THEN 1 ELSE 0 END)::INT " \
+        "AS PERIODO, " if monthly else ""
+    mes_grupo = "PERIODO, " if monthly else ""
+
+    # 1. Count the motorcycles involved in each accident
+    # 2. Count the vehicles (different from the motorcycle, or other motorcycles) of accidents with motorcycles
+    return """
+    WITH moto_accidents AS (
+        SELECT vehiculos.FORMULARIO, COUNT(vehiculos.FORMULARIO) AS motos FROM
+        vehiculos
+        JOIN siniestros ON siniestros.FORMULARIO = vehiculos.FORMULARIO
+        WHERE siniestros.FECHA > '""" + fecha2 + """' AND
+            siniestros.FECHA <= '""" + fecha + """' AND
+            vehiculos.CLASE = 'MOTOCICLETA'
+        GROUP BY vehiculos.FORMULARIO
+    )
+    SELECT """ + mes + """siniestros.GRAVEDAD, siniestros.CLASE_ACC, vehiculos.CLASE AS CLASE_VEH, COUNT(*) AS vehiculos
+    FROM siniestros
+    JOIN moto_accidents ON moto_accidents.FORMULARIO = siniestros.FORMULARIO
+    JOIN vehiculos ON vehiculos.FORMULARIO = siniestros.FORMULARIO
+    WHERE (vehiculos.CLASE <> 'MOTOCICLETA' OR (vehiculos.CLASE = 'MOTOCICLETA' AND moto_accidents.motos > 1)) AND
+        siniestros.GRAVEDAD IS NOT NULL AND siniestros.CLASE_ACC IS NOT NULL
+    GROUP BY """ + mes_grupo + """siniestros.GRAVEDAD, siniestros.CLASE_ACC, vehiculos.CLASE
+    """
+
+def crosstab_counts(fecha, fecha2):
+    """
+    This function returns the number of vehicles involved in accidents with motorcycles (see crosstab_query()) as a
+    crosstab, with one row per severity and accident type and one column per vehicle type.
+
+    Args:
+        fecha: end date string (yyyy-mm-dd)
+        fecha2: start date string (yyyy-mm-dd)
+
+    Returns:
+        DataFrame
+    """
+
+    # We run the query in the backend given by the environment variable ACCIDENTS_DB_BACKEND (see db_backend.py): the
+    # database, with a connection borrowed from the pool, or DuckDB over the Parquet snapshots of its tables
+    counts = init_backend().read_sql(crosstab_query(fecha, fecha2))
+
+    return counts.pivot_table(index = ["gravedad", "clase_acc"], columns = "clase_veh", values = "vehiculos", \
+        aggfunc = "sum", fill_value = 0)
+
+def normalize_crosstab(counts):
+    """
+    This function normalizes a crosstab of counts the way pd.crosstab() does, as percentages.
+
+    Args:
+        counts: crosstab of counts (see crosstab_counts())
+
+    Returns:
+        dict with the all-normalized ("all") and row-normalized ("index") crosstabs
+    """
+    return {
+        "all": counts / counts.to_numpy().sum() * 100,
+        "index": counts.div(counts.sum(axis = 1), axis = 0) * 100,
+    }
+
+def motorcycle_crosstabs(fecha, fecha2):
+    """
+    This function returns the crosstabs of the vehicles involved in accidents with motorcycles between the dates fecha2
+    (excluded) and fecha (included), e.g., the dates returned by create_dates().
+
+    Args:
+        fecha: end date string (yyyy-mm-dd)
+        fecha2: start date string (yyyy-mm-dd)
+
+    Returns:
+        dict with the crosstab of counts ("counts") and the all-normalized ("all") and row-normalized ("index") crosstabs
+    """
+
+    counts = crosstab_counts(fecha, fecha2)
+
+    return dict(normalize_crosstab(counts), counts = counts)
+
+def plot_crosstab(crosstab, label, date_interval, path):
+    """
+    This function saves the heatmap of a normalized crosstab in a png image.
+
+    Args:
+        crosstab: normalized crosstab (see normalize_crosstab())
+        label: label of the color bar
+        date_interval: list with end and start dates (see create_dates())
+        path: path of the png image
+    """
+
+    plt.figure(figsize = (12, 5))
+    sns.heatmap(crosstab, cmap = "Reds", cbar_kws = {"label": label})
+    plt.title("Vehicles involved and severity and type of accidents for motorcycle accidents: " + date_interval[1] + \
+        " to " + date_interval[0], fontsize = 16, y = 1.05)
+    plt.xlabel("Vehicle type", fontsize = 13)
+    plt.ylabel("Severity and accident type", fontsize = 13)
+    plt.savefig(path, bbox_inches = "tight")
+    plt.close()
+
+if __name__ == "__main__":
+    ##### The methodology works by bringing 3-year data. Before running the script, the person who runs it can modify the
+        ##### date information below (year, month, day) and the script would automatically bring the 3-year data up to such
+        ##### date
+    date_interval = create_dates(2022, 12, 31)
+
+    ##################################################
+    ###
+    ### For every vehicle involved in an accident with a motorcycle (except for motorcycles, which are only counted in
+    ### accidents with more than one motorcycle), we count the type and severity of the accident
+    ###
+    ##################################################
+    accidents_crosstab = motorcycle_crosstabs(date_interval[0], date_interval[1])
+
+    # For accidents where a motorcycle was involved, we generate a heatmap from a crosstab that shows the interaction
+    # between the vehicles involved and the accident severity and type. The crosstab is all-normalized, i.e., across all
+    # combinations Severity-Accident type, the heatmap shows the degree to which each vehicle type was responsible for each
+    # combination. We save the heatmap in a png image
+    plot_crosstab(accidents_crosstab["all"], "Total %", date_interval, "crosstab_heatmap_all.png")
+
+    # For accidents where a motorcycle was involved, we generate a heatmap from a crosstab that shows the interaction
+    # between the vehicles involved and the accident severity and type. The crosstab is row-normalized, i.e., for each
+    # combination Severity-Accident type, the heatmap shows the degree to which each vehicle type was responsible for such
+    # combination. We save the heatmap in a png image
+    plot_crosstab(accidents_crosstab["index"], "Row %", date_interval, "crosstab_heatmap_rows.png")
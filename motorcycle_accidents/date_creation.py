@@ -5,14 +5,16 @@ date_creation.py
 
 import pandas as pd
 
-def create_dates(year, month, day):
+def create_dates(year, month, day, years = 3):
     """
-    This function returns date strings to retrieve 3-year data up to day defined by the date year-month-day. 
+    This function returns date strings to retrieve the given number of years of data (3 by default) up to day defined by
+    the date year-month-day. 
 
     Args:
         year: date argument
         month: date argument
         day: date argument
+        years: number of years of data up to the date (default 3)
     
     Returns:
         list with end and start dates
@@ -28,6 +30,6 @@ def create_dates(year, month, day):
         day = str(day)
 
     fecha = str(year) + "-" + str(month) + "-" + str(day)
-    fecha2 = str(pd.to_datetime(fecha) - pd.DateOffset(years = 3))[0:10]
+    fecha2 = str(pd.to_datetime(fecha) - pd.DateOffset(years = years))[0:10]
 
     return [fecha, fecha2]
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""
+conftest.py
+    Makes the modules of the FastAPI app, the data pipeline, the initial ETL and the folder common importable from the
+    tests, as they are when the scripts run from their own folder, and provides synthetic accident tables and a synthetic
+    Malla Vial index. The tests run from the root of the repository with:
+
+        python -m pytest tests
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for folder in ("common", "fastapi_api", "data_pipeline", "initial_etl"):
+    sys.path.append(os.path.join(ROOT, folder))
+
+def synthetic_tables(accidentes = 3000, seed = 0):
+    """
+    This function returns small synthetic versions of the tables siniestros, conheridos and confallecidos, with the
+    columns read by the clustering queries. The accidents of the CIV values 25 to 30 have no killed people.
+
+    Args:
+        accidentes: number of accidents
+        seed: seed of the random values
+
+    Returns:
+        dict with a DataFrame per table
+    """
+
+    rng = np.random.default_rng(seed)
+    dias = ["LUNES", "MARTES", "MIÉRCOLES", "JUEVES", "VIERNES", "SÁBADO", "DOMINGO"]
+    condiciones = ["PEATON", "CICLISTA", "MOTOCICLISTA", "CONDUCTOR", "PASAJERO"]
+
+    fechas = pd.Timestamp("2019-01-01") + pd.to_timedelta(rng.integers(0, 4 * 365, accidentes), unit = "D")
+    siniestros = pd.DataFrame({
+        "FORMULARIO": ["A" + str(i).zfill(6) for i in range(accidentes)],
+        # CIV 0 means no corridor, and CIV values above 30 are not in the synthetic Malla Vial (see synthetic_malla())
+        "CIV": rng.integers(0, 36, accidentes),
+        "FECHA": fechas.date,
+        "DIA_OCURRENCIA_ACC": np.asarray(dias)[fechas.dayofweek],
+        "HORA_OCURRENCIA_ACC": rng.integers(0, 24, accidentes),
+        "GRAVEDAD": rng.choice(["SOLO DANOS", "CON HERIDOS", "CON MUERTOS"], accidentes, p = [0.5, 0.35, 0.15]),
+    })
+    siniestros.loc[siniestros["CIV"].between(25, 30) & (siniestros["GRAVEDAD"] == "CON MUERTOS"), "GRAVEDAD"] = \
+        "CON HERIDOS"
+
+    def personas(formularios, maximo):
+        veces = rng.integers(0, maximo + 1, len(formularios))
+        formulario = np.repeat(np.asarray(formularios), veces)
+        return pd.DataFrame({"OBJECTID": np.arange(len(formulario)), "FORMULARIO": formulario, \
+            "CONDICION": rng.choice(condiciones, len(formulario))})
+
+    # Accidents with killed people may also have injured people
+    conheridos = personas(siniestros.loc[siniestros["GRAVEDAD"] != "SOLO DANOS", "FORMULARIO"], 3)
+    confallecidos = personas(siniestros.loc[siniestros["GRAVEDAD"] == "CON MUERTOS", "FORMULARIO"], 2)
+
+    return {"siniestros": siniestros, "conheridos": conheridos, "confallecidos": confallecidos}
+
+@pytest.fixture(scope = "session")
+def synthetic_snapshots(tmp_path_factory):
+    """
+    This fixture writes the synthetic tables (see synthetic_tables()) into Parquet snapshots and returns their folder,
+    which DuckDBBackend reads.
+    """
+
+    from db_backend import snapshot_file
+
+    path = str(tmp_path_factory.mktemp("snapshots"))
+    for table, df in synthetic_tables().items():
+        df.to_parquet(snapshot_file(table, path), index = False)
+    pd.DataFrame({"VERSION": [0]}).to_parquet(snapshot_file("version_datos", path), index = False)
+
+    return path
+
+def synthetic_malla_arrays():
+    """
+    This function returns the arrays of the synthetic Malla Vial index (see data_creation.load_malla_arrays()).
+    """
+
+    civ = np.arange(1, 31, dtype = np.int64)
+    nombre = np.where(civ < 25, civ % 12, civ - 13).astype(np.int64)
+    nombres = np.asarray(["CORREDOR " + str(i).zfill(2) for i in range(18)], dtype = object)
+
+    return civ, nombre, nombres
+
+@pytest.fixture
+def synthetic_malla(monkeypatch):
+    """
+    This fixture replaces the Malla Vial index of data_creation.py with a synthetic one: CIV values 1 to 24 share 12
+    corridor names and CIV values 25 to 30 (with no killed people, see synthetic_tables()) have a name each.
+    """
+
+    import data_creation
+
+    civ, nombre, nombres = synthetic_malla_arrays()
+
+    monkeypatch.setattr(data_creation, "load_malla_arrays", lambda *args: (civ, nombre, nombres))
+    data_creation.corridor_dtype.cache_clear()
+    yield
+    data_creation.corridor_dtype.cache_clear()
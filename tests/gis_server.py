@@ -0,0 +1,121 @@
+"""
+gis_server.py
+    Local HTTP server that emulates the query API of the ArcGIS FeatureServer of accidents (the part of it used by
+    data_pipeline/gis_fetcher.py), so the fetcher can be tested without the real service. Every layer has the same
+    synthetic rows, the server returns at most max_records rows per query (setting exceededTransferLimit as the real
+    service does) and it can be told to fail a number of requests.
+
+    To pull from it by hand, navigate to the folder tests and run:
+
+        python gis_server.py 8000
+
+    and set the environment variable GIS_URL to http://127.0.0.1:8000 before running gis_fetcher.py.
+"""
+
+import re
+import sys
+import json
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class GISServer:
+    """
+    Class that runs the emulated service in a thread. The rows have the OBJECTID values 1, 3, 5, ... (so there are gaps)
+    and the where clause of the queries is only read for its OBJECTID BETWEEN range.
+    """
+
+    def __init__(self, rows = 2500, max_records = 1000, port = 0):
+        """
+        Args:
+            rows: number of rows of every layer
+            max_records: maximum number of rows returned by a query
+            port: port of the server (0 picks a free port)
+        """
+        self.ids = [2 * i + 1 for i in range(rows)]
+        self.max_records = max_records
+        self.requests = []
+        # List of failures of the next requests: an HTTP status code or "error" for an error in the body of the response
+        self.failures = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self._server.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def feature(self, objectid, geometry):
+        """
+        This method returns the synthetic feature of an OBJECTID value.
+        """
+        feature = {"attributes": {"OBJECTID": objectid, "FORMULARIO": "A" + str(objectid).zfill(6), "CIV": objectid % 97}}
+        if geometry:
+            feature["geometry"] = {"x": -74.1 + objectid / 1e6, "y": 4.6 + objectid / 1e6}
+        return feature
+
+    def answer(self, params):
+        """
+        This method returns the response to the parameters of a query, or the failure to return instead.
+
+        Returns:
+            tuple with the HTTP status code and the response
+        """
+
+        with self._lock:
+            self.requests.append(params)
+            if self.failures:
+                falla = self.failures.pop(0)
+                if falla == "error":
+                    return 200, {"error": {"code": 500, "message": "Error performing query operation"}}
+                return falla, {}
+
+        ids = self.ids
+        rango = re.search(r"OBJECTID BETWEEN (\d+) AND (\d+)", params.get("where", ""))
+        if rango:
+            ids = [i for i in ids if int(rango.group(1)) <= i <= int(rango.group(2))]
+        if params.get("returnIdsOnly") == "true":
+            return 200, {"objectIdFieldName": "OBJECTID", "objectIds": ids}
+        if params.get("returnCountOnly") == "true":
+            return 200, {"count": len(ids)}
+
+        desde = int(params.get("resultOffset", 0))
+        hasta = desde + min(int(params.get("resultRecordCount", self.max_records)), self.max_records)
+        pagina = ids[desde:hasta]
+        respuesta = {"features": [self.feature(i, params.get("returnGeometry") == "true") for i in pagina]}
+        if len(ids) - desde > len(pagina) and len(pagina) == self.max_records:
+            respuesta["exceededTransferLimit"] = True
+        return 200, respuesta
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+                status, respuesta = server.answer(dict(urllib.parse.parse_qsl(body)))
+                contenido = json.dumps(respuesta).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(contenido)))
+                self.end_headers()
+                self.wfile.write(contenido)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+if __name__ == "__main__":
+    gis_server = GISServer(port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
+    print("Serving on " + gis_server.url)
+    gis_server._server.serve_forever()
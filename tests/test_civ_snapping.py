@@ -0,0 +1,20 @@
+"""
+test_civ_snapping.py
+    Tests of the dates whose daily corridor counts are refreshed after the accidents are assigned to a corridor (see
+    data_pipeline/civ_snapping.py)
+"""
+
+import datetime
+import pytest
+
+civ_snapping = pytest.importorskip("civ_snapping")
+
+def test_dates_are_grouped_into_ranges_of_consecutive_days():
+    fechas = [datetime.date(2022, 1, 3), datetime.date(2022, 1, 1), datetime.date(2022, 1, 2), datetime.date(2022, 1, 2), \
+        datetime.date(2022, 3, 1), datetime.date(2021, 12, 31)]
+
+    assert civ_snapping.date_ranges(fechas) == [(datetime.date(2021, 12, 31), datetime.date(2022, 1, 3)), \
+        (datetime.date(2022, 3, 1), datetime.date(2022, 3, 1))]
+
+def test_no_dates_no_ranges():
+    assert civ_snapping.date_ranges([]) == []
@@ -0,0 +1,42 @@
+"""
+test_corridor_counts.py
+    Tests that the ways of computing the counts per corridor per day of week per hour of the clustering (see
+    fastapi_api/data_creation.py) agree, over synthetic snapshots queried with DuckDB
+"""
+
+import pandas as pd
+import pytest
+import data_creation
+from db_backend import DuckDBBackend
+
+# Windows (end and start dates) of the comparisons
+WINDOWS = [("2022-12-31", "2019-12-31"), ("2021-06-30", "2020-06-30"), ("2020-02-29", "2020-01-31")]
+
+@pytest.fixture
+def duckdb_backend(monkeypatch, synthetic_snapshots):
+    """
+    This fixture makes data_creation.py run its queries with DuckDB over the synthetic snapshots.
+    """
+
+    backend = DuckDBBackend(synthetic_snapshots)
+    monkeypatch.setattr(data_creation, "init_backend", lambda: backend)
+    yield backend
+    backend.close()
+
+def sorted_counts(cant_siniestros):
+    """
+    This function sorts the counts by corridor, day of week and hour, so two DataFrames of counts can be compared.
+    """
+
+    cant_siniestros = cant_siniestros.astype({"DIA_OCURRENCIA_ACC": str})
+    return cant_siniestros.sort_values(["CIV", "DIA_OCURRENCIA_ACC", "HORA_OCURRENCIA_ACC"]).reset_index(drop = True)
+
+@pytest.mark.parametrize("fecha, fecha2", WINDOWS)
+@pytest.mark.parametrize("parallel", [True, False])
+def test_single_query_counts_equal_five_query_counts(duckdb_backend, fecha, fecha2, parallel):
+    cinco = sorted_counts(data_creation.corridor_counts_pandas(fecha, fecha2, parallel = parallel))
+    una = sorted_counts(data_creation.corridor_counts_sql(fecha, fecha2))
+
+    assert len(cinco) > 0
+    assert cinco["muertes"].sum() > 0 and cinco["heridos_vulnerables"].sum() > 0
+    pd.testing.assert_frame_equal(una, cinco, check_dtype = False)
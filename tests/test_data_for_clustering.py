@@ -0,0 +1,159 @@
+"""
+test_data_for_clustering.py
+    Tests that the vectorized feature engineering of data_for_clustering() (see fastapi_api/data_creation.py) gives the
+    same DataFrame as the original implementation, with groupby(), merge() and a row-wise apply(), over synthetic
+    snapshots queried with DuckDB. Running the module compares the time of both implementations on larger synthetic data:
+
+        python tests/test_data_for_clustering.py
+"""
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import pytest
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import conftest
+
+import data_creation
+from db_backend import DuckDBBackend, snapshot_file
+
+WINDOWS = [(2022, 12, 31), (2021, 6, 30), (2020, 2, 29)]
+
+def legacy_features(frames, malla_short_clean):
+    """
+    This function is the original feature engineering of data_for_clustering(), from the frames of the five queries of
+    aggregation_queries() to the DataFrame used for the prioritization clustering.
+
+    Args:
+        frames: dict with the DataFrame of each query (see data_creation.read_queries())
+        malla_short_clean: DataFrame with the columns CIV and MVINOMBRE (see data_creation.load_malla_index())
+
+    Returns:
+        DataFrame
+    """
+
+    llaves = ["CIV", "DIA_OCURRENCIA_ACC", "HORA_OCURRENCIA_ACC"]
+    cant = {}
+    for nombre, columnas in (("accidentes", []), ("heridos", ["heridos"]), ("muertes", ["muertes", "heridos"]), \
+        ("heridosv", ["heridos_vulnerables"]), ("muertesv", ["muertes_vulnerables", "heridos_vulnerables"])):
+        df = frames[nombre].copy()
+        df.columns = [column.upper() if column.upper() in llaves + ["FORMULARIO"] else column for column in df.columns]
+        df["CIV"] = df["CIV"].replace({0: np.nan})
+        df = df[df["CIV"].notna()].copy()
+        if nombre == "accidentes":
+            cant[nombre] = df.groupby(llaves).size().reset_index(name = "accidentes")
+        else:
+            cant[nombre] = df.groupby(llaves)[columnas].sum().reset_index()
+
+    cant_siniestros = pd.merge(cant["accidentes"], cant["heridos"], how = "left", on = llaves).merge(cant["muertes"], \
+        how = "left", on = llaves).merge(cant["heridosv"], how = "left", on = llaves).merge(cant["muertesv"], how = "left", \
+        on = llaves)
+    cant_siniestros.fillna(value = 0, inplace = True)
+    cant_siniestros["heridos"] = cant_siniestros["heridos_x"] + cant_siniestros["heridos_y"]
+    cant_siniestros["heridos_vulnerables"] = cant_siniestros["heridos_vulnerables_x"] + \
+        cant_siniestros["heridos_vulnerables_y"]
+    cant_siniestros.drop(columns = ["heridos_x", "heridos_y", "heridos_vulnerables_x", "heridos_vulnerables_y"], \
+        inplace = True)
+
+    accidentes_malla = cant_siniestros.merge(malla_short_clean, how = "left", on = "CIV")
+    accidentes_malla_clean = accidentes_malla[accidentes_malla["MVINOMBRE"].notna()].copy()
+    info_siniestros = accidentes_malla_clean.groupby(["MVINOMBRE", "DIA_OCURRENCIA_ACC", "HORA_OCURRENCIA_ACC"])\
+        [data_creation.COUNT_COLUMNS].sum().reset_index()
+    info_siniestros["HORARIO"] = info_siniestros["HORA_OCURRENCIA_ACC"].map(data_creation.HORARIOS)
+
+    muertes = info_siniestros.groupby("MVINOMBRE")["muertes"].sum()
+    info_siniestrosm = info_siniestros[~info_siniestros["MVINOMBRE"].isin(muertes[muertes == 0].index.to_list())]
+    info_siniestrosmh = info_siniestrosm.groupby(["MVINOMBRE", "DIA_OCURRENCIA_ACC", "HORARIO"])\
+        [data_creation.COUNT_COLUMNS].sum().reset_index()
+
+    cluster_df = info_siniestrosmh.groupby(["MVINOMBRE", "HORARIO"])[data_creation.COUNT_COLUMNS].sum().reset_index()
+    cluster_df["vulnerables"] = cluster_df.apply(lambda x: data_creation.vulnerable(x["muertes_vulnerables"], \
+        x["heridos_vulnerables"]), axis = 1)
+
+    return cluster_df
+
+def plain(cluster_df):
+    """
+    This function turns the categorical and int32 columns of a clustering DataFrame into plain ones, so the DataFrames of
+    both implementations can be compared.
+    """
+    return cluster_df.astype({"MVINOMBRE": str, "HORARIO": str, "vulnerables": np.int64} | {column: np.int64 for column \
+        in data_creation.COUNT_COLUMNS}).reset_index(drop = True)
+
+def window(year, month, day):
+    """
+    This function returns the end and start date strings of the 3-year window up to a date, as data_for_clustering()
+    computes them.
+    """
+
+    fecha = str(pd.Timestamp(year = year, month = month, day = day))[0:10]
+    return fecha, str(pd.to_datetime(fecha) - pd.DateOffset(years = 3))[0:10]
+
+@pytest.fixture
+def duckdb_backend(monkeypatch, synthetic_snapshots, synthetic_malla):
+    """
+    This fixture makes data_creation.py run its queries with DuckDB over the synthetic snapshots and use the synthetic
+    Malla Vial index.
+    """
+
+    backend = DuckDBBackend(synthetic_snapshots)
+    monkeypatch.setattr(data_creation, "init_backend", lambda: backend)
+    monkeypatch.delenv("CLUSTERING_BACKEND", raising = False)
+    yield backend
+    backend.close()
+
+@pytest.mark.parametrize("year, month, day", WINDOWS)
+def test_vectorized_features_equal_the_original_loop(duckdb_backend, year, month, day):
+    frames = data_creation.read_queries(data_creation.aggregation_queries(*window(year, month, day)))
+    malla = data_creation.load_malla_index.__wrapped__()
+
+    original = plain(legacy_features(frames, malla.astype({"MVINOMBRE": str})))
+    vectorizado = plain(data_creation.data_for_clustering(year, month, day))
+
+    # Some corridor names are left out for having no killed people
+    assert 0 < vectorizado["MVINOMBRE"].nunique() < len(malla["MVINOMBRE"].unique())
+    pd.testing.assert_frame_equal(vectorizado, original)
+    assert list(data_creation.data_for_clustering(year, month, day).dtypes.astype(str)) == ["category", "category"] + \
+        ["int32"] * len(data_creation.COUNT_COLUMNS) + ["category"]
+
+def benchmark(sizes = (30000, 300000, 1000000), repeticiones = 3):
+    """
+    This function prints the best time (of repeticiones runs) of the original and the vectorized feature engineering on
+    synthetic data of each size (number of accidents). The query results are read once, so only pandas is timed.
+    """
+
+    from conftest import synthetic_tables, synthetic_malla_arrays
+
+    arrays = synthetic_malla_arrays()
+    data_creation.load_malla_arrays = lambda *args: arrays
+    data_creation.corridor_dtype.cache_clear()
+    malla = data_creation.load_malla_index.__wrapped__().astype({"MVINOMBRE": str})
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as path:
+            for table, df in synthetic_tables(accidentes = size).items():
+                df.to_parquet(snapshot_file(table, path), index = False)
+            backend = DuckDBBackend(path)
+            frames = backend.read_many(data_creation.aggregation_queries(*window(2022, 12, 31)))
+            backend.close()
+
+        # corridor_counts_pandas() takes the frames already read instead of running the queries
+        data_creation.read_queries = lambda *args, **kwargs: frames
+        tiempos = {}
+        for nombre, funcion in (("original", lambda: legacy_features(frames, malla)), ("vectorized", lambda: \
+            data_creation.clustering_features(data_creation.corridor_counts_pandas(*window(2022, 12, 31))))):
+            mejor = np.inf
+            for _ in range(repeticiones):
+                inicio = time.perf_counter()
+                funcion()
+                mejor = min(mejor, time.perf_counter() - inicio)
+            tiempos[nombre] = round(mejor, 3)
+        print(str(size) + " accidents: " + str(tiempos))
+
+if __name__ == "__main__":
+    benchmark()
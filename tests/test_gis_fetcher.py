@@ -0,0 +1,121 @@
+"""
+test_gis_fetcher.py
+    Tests of the paging, retries and checkpoints of the GIS fetcher (see data_pipeline/gis_fetcher.py) against a local
+    server that emulates the ArcGIS service (see gis_server.py)
+"""
+
+import os
+import json
+import urllib.error
+import pandas as pd
+import pytest
+import gis_fetcher
+from gis_server import GISServer
+
+@pytest.fixture
+def gis_server(monkeypatch):
+    """
+    This fixture runs the emulated service and makes the retries of the fetcher wait no time.
+    """
+
+    server = GISServer().start()
+    esperas = []
+    monkeypatch.setattr(gis_fetcher.time, "sleep", esperas.append)
+    server.esperas = esperas
+    yield server
+    server.stop()
+
+@pytest.mark.parametrize("by, page_rows", [("objectid", 300), ("objectid", 1800), ("offset", 300), ("offset", 1800)])
+def test_every_row_is_pulled_once(gis_server, by, page_rows):
+    # Pages larger than the limit of rows per query of the server are pulled with more queries
+    df = gis_fetcher.fetch_frame("accidents", "1=1", workers = 3, page_rows = page_rows, url = gis_server.url, by = by)
+
+    assert df["OBJECTID"].tolist() == gis_server.ids
+    assert df["FORMULARIO"].tolist() == ["A" + str(i).zfill(6) for i in gis_server.ids]
+    assert {"geometry.x", "geometry.y"} <= set(df.columns)
+
+def test_layers_without_geometry(gis_server):
+    df = gis_fetcher.fetch_frame("vehicles", "1=1", page_rows = 1000, url = gis_server.url)
+
+    assert len(df) == len(gis_server.ids)
+    assert "geometry.x" not in df.columns
+
+def test_failed_requests_are_retried(gis_server):
+    gis_server.failures = [500, 503, "error", 429]
+    df = gis_fetcher.fetch_frame("accidents", "1=1", workers = 2, page_rows = 500, url = gis_server.url)
+
+    assert df["OBJECTID"].tolist() == gis_server.ids
+    assert len(gis_server.esperas) == 4
+
+def test_client_errors_are_not_retried(gis_server):
+    gis_server.failures = [404]
+    with pytest.raises(urllib.error.HTTPError):
+        gis_fetcher.query(0, {"where": "1=1"}, gis_server.url)
+
+    assert len(gis_server.requests) == 1
+
+def test_requests_fail_after_the_retries(gis_server):
+    gis_server.failures = [500] * 3
+    with pytest.raises(urllib.error.HTTPError):
+        gis_fetcher.query(0, {"where": "1=1"}, gis_server.url, retries = 2)
+
+    assert len(gis_server.requests) == 3
+    assert len(gis_server.esperas) == 2
+
+@pytest.mark.parametrize("by", ["objectid", "offset"])
+def test_interrupted_pull_resumes_from_the_missing_pages(gis_server, tmp_path, by):
+    checkpoint = str(tmp_path / "accidents.checkpoint")
+
+    # The pull stops after two pages were handed over, so only the first one was consumed and recorded
+    paginas = []
+    for pagina in gis_fetcher.fetch_layer("accidents", "1=1", checkpoint = checkpoint, workers = 1, page_rows = 500, \
+        url = gis_server.url, by = by):
+        paginas.append(pagina)
+        if len(paginas) == 2:
+            break
+    with open(checkpoint, "r") as f:
+        estado = json.load(f)
+    assert len(estado["pages"]) == 5
+    assert len(estado["done"]) == 1
+
+    gis_server.requests.clear()
+    resto = gis_fetcher.fetch_frame("accidents", "1=1", checkpoint = checkpoint, workers = 2, page_rows = 500, \
+        url = gis_server.url, by = by)
+
+    # The resumed pull does not plan the pages again nor pull the recorded page
+    assert len(gis_server.requests) == 4
+    assert sorted(paginas[0]["OBJECTID"].tolist() + resto["OBJECTID"].tolist()) == gis_server.ids
+    assert not os.path.exists(checkpoint)
+
+def test_checkpoint_of_another_query_is_ignored(gis_server, tmp_path):
+    checkpoint = str(tmp_path / "accidents.checkpoint")
+    with open(checkpoint, "w") as f:
+        json.dump({"query": {"layer": "accidents", "where": "ANO_OCURRENCIA_ACC = 2022", "by": "objectid"}, \
+            "pages": [["objectid", 1, 999, 500]], "done": [["objectid", 1, 999, 500]]}, f)
+
+    df = gis_fetcher.fetch_frame("accidents", "1=1", checkpoint = checkpoint, page_rows = 500, url = gis_server.url)
+
+    assert df["OBJECTID"].tolist() == gis_server.ids
+    assert not os.path.exists(checkpoint)
+
+def test_csv_pages_are_written_with_the_same_columns(gis_server, tmp_path, monkeypatch):
+    # The service may return the columns of each page in a different order
+    features_frame = gis_fetcher.features_frame
+    paginas = []
+
+    def shuffled_frame(respuesta):
+        pagina = features_frame(respuesta)
+        paginas.append(pagina)
+        return pagina[pagina.columns[::-1]] if len(paginas) % 2 == 0 else pagina
+
+    monkeypatch.setattr(gis_fetcher, "features_frame", shuffled_frame)
+    path = str(tmp_path / "accidents.csv")
+    filas = gis_fetcher.fetch_csv("accidents", "1=1", path, workers = 2, page_rows = 500, url = gis_server.url)
+
+    df = pd.read_csv(path)
+    assert len(paginas) == 5
+    assert filas == len(gis_server.ids)
+    assert df.columns.tolist() == gis_fetcher.layer_columns("accidents")
+    assert sorted(df["OBJECTID"].tolist()) == gis_server.ids
+    assert (df["FORMULARIO"] == ["A" + str(i).zfill(6) for i in df["OBJECTID"]]).all()
+    assert (df["CIV"] == df["OBJECTID"] % 97).all()
@@ -0,0 +1,47 @@
+"""
+test_import_time.py
+    Tests of the startup of the FastAPI app (see fastapi_api/ml_api.py): importing the app must stay within a time budget
+    and must not import the modules that are only needed to train the model, to export the snapshots or by one of the
+    backends of the queries
+"""
+
+import os
+import subprocess
+import sys
+
+FASTAPI_API = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fastapi_api")
+
+# Modules that the app only imports on first use
+HEAVY_MODULES = ("sklearn", "joblib", "kmodes", "scipy", "geopandas", "shapely", "duckdb", "matplotlib", "psycopg2")
+
+def run_python(*args):
+    """
+    This function runs a new Python interpreter from the folder fastapi_api, as uvicorn does, and returns it once finished.
+    """
+    return subprocess.run([sys.executable, *args], cwd = FASTAPI_API, capture_output = True, text = True, check = True)
+
+def import_seconds():
+    """
+    This function returns the number of seconds taken by "import ml_api", as reported by python -X importtime (the
+    cumulative time, in microseconds, of the line of the module ml_api).
+    """
+
+    proceso = run_python("-X", "importtime", "-c", "import ml_api")
+    for linea in proceso.stderr.splitlines():
+        campos = [campo.strip() for campo in linea.split("|")]
+        if len(campos) == 3 and campos[2] == "ml_api":
+            return int(campos[1]) / 1e6
+    raise AssertionError("ml_api not found in the output of python -X importtime")
+
+def test_import_time_is_within_budget():
+    # The budget (seconds) can be raised with the environment variable IMPORT_TIME_BUDGET on slow machines
+    budget = float(os.environ.get("IMPORT_TIME_BUDGET", 2.0))
+
+    # The first import also compiles and caches the modules, so we keep the best of a few runs
+    segundos = min(import_seconds() for _ in range(3))
+    assert segundos < budget, f"import ml_api took {segundos:.2f} s, the budget is {budget:.2f} s"
+
+def test_heavy_modules_are_not_imported():
+    proceso = run_python("-c", "import sys, ml_api; print(' '.join(sorted(sys.modules)))")
+    cargados = {modulo.split(".")[0] for modulo in proceso.stdout.split()}
+    assert not cargados.intersection(HEAVY_MODULES), sorted(cargados.intersection(HEAVY_MODULES))
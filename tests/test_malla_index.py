@@ -0,0 +1,51 @@
+"""
+test_malla_index.py
+    Tests of the compact corridor index of the Malla Vial (see build_malla_index() in fastapi_api/data_creation.py)
+"""
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import data_creation
+
+def write_malla(path, corredores = 500):
+    """
+    This function writes a synthetic Malla Vial GeoJSON file with one line per corridor. Every third corridor has no name.
+    """
+
+    features = [{"type": "Feature", "properties": {"MVICIV": civ, "MVINOMBRE": None if civ % 3 == 0 else "CALLE " + \
+        str(civ % 40)}, "geometry": {"type": "LineString", "coordinates": [[-74.1 + civ * 1e-4, 4.6], [-74.1 + civ * 1e-4, \
+        4.61]]}} for civ in range(1, corredores + 1)]
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+def test_concurrent_first_loads_build_the_index_once(tmp_path):
+    malla_path = str(tmp_path / "malla.geojson")
+    index_path = str(tmp_path / "malla_index")
+    write_malla(malla_path)
+
+    construcciones = []
+    build_malla_index = data_creation.build_malla_index
+
+    def contar(*args):
+        construcciones.append(args)
+        build_malla_index(*args)
+
+    data_creation.load_malla_arrays.cache_clear()
+    data_creation.build_malla_index = contar
+    try:
+        # The cache of load_malla_arrays() is bypassed, so every thread goes through the check of the index
+        with ThreadPoolExecutor(max_workers = 8) as executor:
+            resultados = list(executor.map(lambda _: data_creation.load_malla_arrays.__wrapped__(malla_path, \
+                index_path), range(16)))
+    finally:
+        data_creation.build_malla_index = build_malla_index
+
+    assert len(construcciones) == 1
+    civ, nombre, nombres = resultados[0]
+    assert len(civ) == len(nombre) == 334
+    for otro in resultados[1:]:
+        assert np.array_equal(otro[0], civ) and np.array_equal(otro[1], nombre)
+    # Only the three files of the index are left, no temporary files
+    assert sorted(os.listdir(index_path)) == ["civ.npy", "nombre.npy", "nombres.npy"]
@@ -0,0 +1,97 @@
+"""
+test_merge_gis.py
+    Tests that the incremental parser of the JSON files pulled from the ArcGIS service (see initial_etl/merge_gis.py)
+    reads the same features as json.load, whatever the size of the chunks read, and that the merged layers are read back
+    by year and accident
+"""
+
+import os
+import json
+import pandas as pd
+import pytest
+from merge_gis import iter_features, merge_file, read_layer, write_layer
+
+def response(features = 50):
+    """
+    This function returns a synthetic response of the service, with members before and after the features.
+    """
+    return {
+        "displayFieldName": "",
+        "fields": [{"name": "OBJECTID", "type": "esriFieldTypeOID"}, {"name": "FORMULARIO", "type": "esriFieldTypeString"}],
+        "features": [{"attributes": {"OBJECTID": i, "FORMULARIO": "AÑ" + str(i) + " \\\" ]}"}, \
+            "geometry": {"x": -74.1 + i / 1e4, "y": 4.6}} for i in range(features)],
+        "exceededTransferLimit": False,
+    }
+
+@pytest.mark.parametrize("chunk_chars", [1, 7, 64, 1 << 20])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_features_equal_json_load(tmp_path, chunk_chars, indent):
+    path = str(tmp_path / "response.json")
+    with open(path, "w", encoding = "utf-8") as f:
+        json.dump(response(), f, indent = indent, ensure_ascii = False)
+
+    cabecera = {}
+    features = list(iter_features(path, cabecera, chunk_chars))
+
+    esperada = response()
+    assert features == esperada.pop("features")
+    assert cabecera == esperada
+
+def test_response_with_no_features(tmp_path):
+    path = str(tmp_path / "response.json")
+    with open(path, "w", encoding = "utf-8") as f:
+        json.dump(response(0), f)
+
+    cabecera = {}
+    assert list(iter_features(path, cabecera, 16)) == []
+    assert cabecera["fields"][0]["name"] == "OBJECTID"
+
+def accidents_response(desde, hasta):
+    """
+    This function returns a synthetic response of the accidents layer, with one accident per day between the dates desde
+    and hasta.
+    """
+
+    fechas = pd.date_range(desde, hasta, freq = "D")
+    return {
+        "fields": [{"name": "OBJECTID", "type": "esriFieldTypeOID"}, {"name": "FORMULARIO", "type": "esriFieldTypeString"}, \
+            {"name": "FECHA_HORA_ACC", "type": "esriFieldTypeDate"}],
+        # Dates are stored at noon, Bogotá time, in milliseconds since 1970 (UTC)
+        "features": [{"attributes": {"OBJECTID": int(fecha.value // 10**9), "FORMULARIO": "A" + fecha.strftime("%Y%m%d"), \
+            "FECHA_HORA_ACC": int((fecha + pd.Timedelta(hours = 17)).value // 10**6)}} for fecha in fechas],
+    }
+
+def test_layer_is_read_by_year_and_accident(tmp_path):
+    for nombre, desde, hasta in [("a", "2019-11-01", "2020-02-29"), ("b", "2020-12-01", "2021-01-31")]:
+        path = str(tmp_path / (nombre + ".json"))
+        with open(path, "w", encoding = "utf-8") as f:
+            json.dump(accidents_response(desde, hasta), f)
+        merge_file(path, "accidents", str(tmp_path / "parquet"), batch_rows = 20)
+
+    output = str(tmp_path / "parquet")
+    assert sorted(os.listdir(os.path.join(output, "accidents"))) == ["ANO=2019", "ANO=2020", "ANO=2021"]
+
+    todos = read_layer("accidents", output)
+    assert len(todos) == 61 + 60 + 62
+    assert list(todos.columns) == ["OBJECTID", "FORMULARIO", "FECHA_HORA_ACC"]
+    assert todos["OBJECTID"].is_monotonic_increasing
+
+    df = read_layer("accidents", output, years = [2020])
+    assert df["FORMULARIO"].str[1:5].eq("2020").all()
+    assert len(df) == 60 + 31
+
+    df = read_layer("accidents", output, columns = ["FORMULARIO"], years = range(2020, 2022), \
+        formularios = ["A20191130", "A20200101", "A20210131"])
+    assert df["FORMULARIO"].tolist() == ["A20200101", "A20210131"]
+
+def test_written_layer_is_read_back(tmp_path):
+    layer_df = pd.DataFrame({"OBJECTID": [3, 1, 2, 4], "FORMULARIO": ["A3", "A1", "A2", "A4"], \
+        "ANO_OCURRENCIA_ACC": [2021.0, 2020.0, 2020.0, 2021.0], "GENERO": [None, "F", "M", None]})
+    output = str(tmp_path / "prepared")
+
+    # Writing the layer again replaces its files
+    write_layer(layer_df.head(1), "injured_people", output, layer_df.head(1)["ANO_OCURRENCIA_ACC"])
+    write_layer(layer_df, "injured_people", output, layer_df["ANO_OCURRENCIA_ACC"])
+
+    assert read_layer("injured_people", output).equals(layer_df.sort_values("OBJECTID", ignore_index = True))
+    assert read_layer("injured_people", output, years = [2021])["OBJECTID"].tolist() == [3, 4]
@@ -0,0 +1,212 @@
+"""
+test_ml_api_concurrency.py
+    Tests of the bounded pool of threads of the FastAPI app and of the cancellation of the predictions that time out (see
+    fastapi_api/ml_api.py), with a slow query backend over synthetic snapshots
+"""
+
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+import data_creation
+import ml_api
+from db_backend import DuckDBBackend
+from ml_functions import PredictionCache
+
+WORKERS = 2
+REQUESTS = 6
+
+# Number of simultaneous predictions of the concurrency test and seconds each of their queries waits
+CONCURRENT = 4
+DELAY = 0.25
+
+class SlowBackend(DuckDBBackend):
+    """
+    Class that runs the queries over the synthetic snapshots, waiting a given number of seconds before each query. It
+    records the queries run and the largest number of predictions reading data at the same time.
+    """
+
+    def __init__(self, path, delay):
+        super().__init__(path)
+        self.delay = delay
+        self.queries = 0
+        self.started = 0
+        self.active = 0
+        self.max_active = 0
+        self._counter_lock = threading.Lock()
+
+    def read_sql(self, query):
+        time.sleep(self.delay)
+        with self._counter_lock:
+            self.queries += 1
+        return super().read_sql(query)
+
+    def read_many(self, queries, cancel = None):
+        with self._counter_lock:
+            self.started += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            return super().read_many(queries, cancel = cancel)
+        finally:
+            with self._counter_lock:
+                self.active -= 1
+
+class StubModel:
+    """
+    Class that replaces the K-Prototypes model and counts its predictions.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def predict(self, features):
+        self.calls += 1
+        return np.zeros(len(features), dtype = np.int64)
+
+@pytest.fixture
+def slow_app(monkeypatch, synthetic_snapshots, synthetic_malla):
+    """
+    This fixture sets up the app with a pool of WORKERS threads, a timeout of 0.6 seconds, the stub model and a slow
+    backend (0.4 seconds per query, so the five queries of a prediction take 2 seconds). The queries run one after another.
+    """
+
+    backend = SlowBackend(synthetic_snapshots, delay = 0.4)
+    executor = ThreadPoolExecutor(max_workers = WORKERS)
+    model = StubModel()
+
+    monkeypatch.setenv("DB_PARALLEL_QUERIES", "0")
+    monkeypatch.delenv("WINDOW_ENGINE", raising = False)
+    monkeypatch.delenv("CLUSTERING_BACKEND", raising = False)
+    monkeypatch.setattr(data_creation, "init_backend", lambda: backend)
+    monkeypatch.setattr(ml_api, "executor", executor)
+    monkeypatch.setattr(ml_api, "predict_timeout", 0.6)
+    monkeypatch.setattr(ml_api, "model", model)
+    monkeypatch.setattr(ml_api, "prediction_cache", PredictionCache(watermark_func = lambda: 1))
+
+    yield backend, executor, model
+
+    executor.shutdown(wait = True)
+    backend.close()
+
+async def post_dates(dates):
+    """
+    This function sends a request to /predict/ for each date at the same time.
+
+    Args:
+        dates: list of dates (year, month, day)
+
+    Returns:
+        list of responses
+    """
+
+    transport = httpx.ASGITransport(app = ml_api.app)
+    async with httpx.AsyncClient(transport = transport, base_url = "http://test") as client:
+        return await asyncio.gather(*(client.post("/predict/", params = {"year": year, "month": month, "day": day}) \
+            for year, month, day in dates))
+
+def test_slow_predictions_time_out_and_release_the_pool(slow_app):
+    backend, executor, model = slow_app
+
+    dates = [(2022, month, 28) for month in range(1, REQUESTS + 1)]
+    inicio = time.perf_counter()
+    responses = asyncio.run(post_dates(dates))
+    segundos = time.perf_counter() - inicio
+
+    # Every request times out, well before its five queries could run
+    assert [response.status_code for response in responses] == [504] * REQUESTS
+    assert segundos < 1.5
+
+    # Only WORKERS predictions ran at the same time, and the ones still queued when they timed out never started
+    assert backend.max_active <= WORKERS
+    assert backend.started <= WORKERS
+
+    # The running predictions stop before their next query, so the threads are free again in about one query time
+    assert executor.submit(lambda: True).result(timeout = 1)
+    time.sleep(0.5)
+    assert backend.active == 0
+    assert backend.queries < 5 * backend.started
+    assert model.calls == 0
+
+def test_fast_predictions_are_served(slow_app):
+    backend, _, model = slow_app
+    backend.delay = 0
+
+    responses = asyncio.run(post_dates([(2022, 12, 31), (2021, 12, 31)]))
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert responses[0].text.splitlines()[0].startswith("MVINOMBRE,HORARIO")
+    assert len(responses[0].text.splitlines()) > 1
+    assert model.calls == 2
+
+def test_simultaneous_predictions_take_the_time_of_the_slowest(slow_app, monkeypatch):
+    backend, _, model = slow_app
+    backend.delay = DELAY
+    # Each prediction runs its five queries one after another, so it takes at least this long
+    segundos_prediccion = 5 * DELAY
+
+    monkeypatch.setenv("PREDICT_WORKERS", str(CONCURRENT))
+    executor = ml_api.load_executor()
+    monkeypatch.setattr(ml_api, "executor", executor)
+    monkeypatch.setattr(ml_api, "predict_timeout", 60)
+
+    barrera = threading.Barrier(CONCURRENT)
+    responses = [None] * CONCURRENT
+
+    def post(i):
+        client = TestClient(ml_api.app)
+        barrera.wait()
+        responses[i] = client.post("/predict/", params = {"year": 2022, "month": i + 1, "day": 28})
+
+    threads = [threading.Thread(target = post, args = (i,)) for i in range(CONCURRENT)]
+    inicio = time.perf_counter()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        executor.shutdown(wait = True)
+    segundos = time.perf_counter() - inicio
+
+    assert [response.status_code for response in responses] == [200] * CONCURRENT
+    assert backend.max_active == CONCURRENT
+    assert model.calls == CONCURRENT
+    # The predictions overlap: together they take about as long as one of them, not as long as all of them in a row
+    assert segundos < 2 * segundos_prediccion, segundos
+    assert segundos < CONCURRENT * segundos_prediccion / 2, segundos
+
+def test_batch_predictions_equal_single_predictions(slow_app):
+    backend, _, model = slow_app
+    backend.delay = 0
+
+    client = TestClient(ml_api.app)
+    dates = [(2021, 12, 31), (2022, 6, 30)]
+    batch = client.post("/predict/batch/", json = {"dates": [{"year": year, "month": month, "day": day} for year, \
+        month, day in dates], "years": 3})
+
+    # Without the WindowEngine, the data of each date is computed with CLUSTERING_BACKEND, as in the Predict endpoint
+    assert batch.status_code == 200
+    lineas = batch.text.splitlines()
+    for year, month, day in dates:
+        single = client.post("/predict/", params = {"year": year, "month": month, "day": day}).text.splitlines()
+        fecha = str(year) + "-" + str(month).zfill(2) + "-" + str(day).zfill(2)
+        assert [linea for linea in lineas[1:] if linea.startswith(fecha + ",")] == [fecha + "," + linea for linea in \
+            single[1:]]
+    assert lineas[0] == "FECHA," + single[0]
+
+def test_batch_with_no_data_returns_the_header(slow_app):
+    backend, _, model = slow_app
+    backend.delay = 0
+
+    client = TestClient(ml_api.app)
+    response = client.post("/predict/batch/", json = {"dates": [{"year": 2018, "month": 6, "day": 30}], "years": 1})
+
+    assert response.status_code == 200
+    assert response.text.splitlines() == ["FECHA,MVINOMBRE,HORARIO,accidentes,muertes,heridos,muertes_vulnerables," \
+        "heridos_vulnerables,vulnerables,Prioridad"]
+    assert model.calls == 0
@@ -0,0 +1,46 @@
+"""
+test_native_model.py
+    Tests that the NumPy predictor of the FastAPI app (see fastapi_api/native_model.py) gives the same clusters as the
+    stored kmodes K-Prototypes model on the stored data of clustering/raw_data_predict.csv
+"""
+
+import os
+import pandas as pd
+import pytest
+from native_model import NativeKPrototypes
+
+CLUSTERING = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "clustering")
+
+FEATURES = ["HORARIO", "accidentes", "muertes", "heridos", "vulnerables"]
+CONTINUAS = ["accidentes", "muertes", "heridos"]
+
+def stored_features():
+    """
+    This function returns the features of raw_data_predict.csv followed by the same rows with a HORARIO value unseen when
+    fitting the model and by the same rows with an unseen value of vulnerables.
+    """
+
+    features = pd.read_csv(os.path.join(CLUSTERING, "raw_data_predict.csv"))[FEATURES]
+
+    return pd.concat((features, features.assign(HORARIO = "Horario desconocido"), features.assign(vulnerables = 99)), \
+        ignore_index = True)
+
+def test_native_model_equals_kmodes():
+    joblib = pytest.importorskip("joblib")
+    pytest.importorskip("kmodes")
+
+    scaler = joblib.load(os.path.join(CLUSTERING, "scaler.mod"))
+    kproto = joblib.load(os.path.join(CLUSTERING, "kprototypes.mod"))
+    native = NativeKPrototypes(os.path.join(CLUSTERING, "kprototypes.npz"))
+
+    features = stored_features()
+    # The unseen categories are encoded as -1 (see NativeKPrototypes.predict())
+    assert native.categorias[0].get_indexer(["Horario desconocido"])[0] == -1
+    assert native.categorias[1].get_indexer([99])[0] == -1
+
+    escaladas = features.copy()
+    escaladas[CONTINUAS] = scaler.transform(features[CONTINUAS])
+    esperados = kproto.predict(escaladas, categorical = [0, 4])
+
+    assert len(features) == 3 * 499
+    assert native.predict(features).tolist() == list(esperados)
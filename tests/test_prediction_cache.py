@@ -0,0 +1,58 @@
+"""
+test_prediction_cache.py
+    Tests of the cache of the prediction results of the FastAPI app (see fastapi_api/ml_functions.py)
+"""
+
+import pytest
+from ml_functions import PredictionCache
+
+def watermark_cache(marcas):
+    """
+    This function returns a cache that checks the watermark in every call, read from the dictionary marcas.
+    """
+    return PredictionCache(watermark_interval = 0, watermark_func = lambda: marcas["actual"])
+
+def test_result_is_stored_with_the_watermark():
+    marcas = {"actual": 1}
+    cache = watermark_cache(marcas)
+
+    assert cache.get((2022, 12, 31, 3)) is None
+    cache.put((2022, 12, 31, 3), "resultado", cache.watermark())
+    assert cache.get((2022, 12, 31, 3)) == "resultado"
+
+    # A new load drops the result
+    marcas["actual"] = 2
+    assert cache.get((2022, 12, 31, 3)) is None
+
+def test_result_computed_before_a_watermark_change_is_not_stored():
+    marcas = {"actual": 1}
+    cache = watermark_cache(marcas)
+
+    assert cache.get((2022, 12, 31, 3)) is None
+    watermark = cache.watermark()
+
+    # New data is loaded and another request sees it while the first prediction is running
+    marcas["actual"] = 2
+    assert cache.get((2022, 11, 30, 3)) is None
+
+    cache.put((2022, 12, 31, 3), "resultado viejo", watermark)
+    assert cache.get((2022, 12, 31, 3)) is None
+
+def test_failed_watermark_read_is_retried():
+    llamadas = []
+
+    def watermark_func():
+        llamadas.append(1)
+        if len(llamadas) == 1:
+            raise ConnectionError("database unavailable")
+        return 1
+
+    # The watermark is checked at most once an hour, but the failed read does not count as a check
+    cache = PredictionCache(watermark_interval = 3600, watermark_func = watermark_func)
+    with pytest.raises(ConnectionError):
+        cache.get((2022, 12, 31, 3))
+
+    assert cache.get((2022, 12, 31, 3)) is None
+    assert cache.watermark() == 1
+    assert cache.get((2022, 12, 31, 3)) is None
+    assert len(llamadas) == 2